@@ -0,0 +1,98 @@
+"""Deterministic inputs for `suite.py`, so that it runs offline and gives comparable numbers across commits
+
+- `StandInEncoder`: Tiny randomly initialized (but seeded) network with the same interface as the `ViTModel`
+- `stand_in_feature_extractor`: `ViTImageProcessor` with the same settings as the manga-ocr one, without downloading it
+- `load_fonts` / `load_kanji`: The project's inputs when there are any, otherwise PIL's default font and ASCII characters
+- `synthetic_drawings`: Rendered characters, randomly rotated / shifted / scaled / thickened, labelled with the character
+"""
+import random
+import string
+from pathlib import Path
+
+import torch
+from PIL import Image, ImageFilter, ImageFont
+from transformers import ViTImageProcessor
+
+from config import (
+    FONT_SIZE,
+    MODEL_EMBEDDING_SIZE,
+    MODEL_IMAGE_SIZE,
+)
+from generate_images import draw_kanji, check_has_text, list_fonts, load_kanji_list
+
+SEED = 0
+
+
+class StandInEncoder(torch.nn.Module):
+    """Returns `{"pooler_output": (N, MODEL_EMBEDDING_SIZE)}` like the `ViTModel`, a few milliseconds per image on CPU"""
+    def __init__(self, seed: int = SEED):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.conv = torch.nn.Conv2d(3, 16, kernel_size=8, stride=4)
+        self.projection = torch.nn.Linear(16 * 8 * 8, MODEL_EMBEDDING_SIZE)
+        with torch.no_grad():
+            for parameter in self.parameters():
+                parameter.copy_(torch.randn(parameter.shape, generator=generator) * 0.05)
+        self.eval()
+
+    @property
+    def device(self) -> torch.device:
+        return self.projection.weight.device
+
+    def forward(self, pixel_values: torch.Tensor) -> dict[str, torch.Tensor]:
+        features = torch.nn.functional.adaptive_avg_pool2d(torch.relu(self.conv(pixel_values)), 8)
+        return {"pooler_output": torch.tanh(self.projection(features.flatten(1)))}
+
+
+def stand_in_feature_extractor() -> ViTImageProcessor:
+    return ViTImageProcessor(
+        size={"height": MODEL_IMAGE_SIZE, "width": MODEL_IMAGE_SIZE},
+        image_mean=[0.5, 0.5, 0.5],
+        image_std=[0.5, 0.5, 0.5],
+    )
+
+
+def load_fonts(limit: int | None = None) -> dict[str, ImageFont.FreeTypeFont]:
+    fonts = list_fonts()
+    if not fonts:
+        fonts = {"default": ImageFont.load_default(FONT_SIZE)}
+    return dict(list(sorted(fonts.items()))[:limit])
+
+
+def load_kanji(limit: int | None = None) -> list[str]:
+    kanji_list = load_kanji_list() or list(string.ascii_letters + string.digits)
+    return list(dict.fromkeys(kanji_list))[:limit]
+
+
+def _distort(image: Image.Image, rng: random.Random) -> Image.Image:
+    scale = rng.uniform(0.8, 1.1)
+    size = round(MODEL_IMAGE_SIZE * scale)
+    resized = image.resize((size, size), Image.Resampling.BILINEAR)
+    canvas = Image.new("L", image.size, color=255)
+    offset = (MODEL_IMAGE_SIZE - size) // 2
+    canvas.paste(resized, (offset + rng.randint(-12, 12), offset + rng.randint(-12, 12)))
+    canvas = canvas.rotate(rng.uniform(-10, 10), resample=Image.Resampling.BILINEAR, fillcolor=255)
+    # MinFilter spreads the (black) strokes, as if drawn with a thicker pen
+    thickness = rng.choice([1, 3, 5])
+    return canvas.filter(ImageFilter.MinFilter(thickness)) if thickness > 1 else canvas
+
+
+def synthetic_drawings(fonts: dict[str, ImageFont.FreeTypeFont], kanji_list: list[str], seed: int = SEED) -> list[tuple[str, Image.Image]]:
+    """One distorted rendering per kanji, each in a (randomly chosen) font that supports it"""
+    rng = random.Random(seed)
+    drawings = []
+    for kanji in kanji_list:
+        for font_name in rng.sample(list(fonts), len(fonts)):
+            image = draw_kanji(fonts[font_name], kanji)
+            if check_has_text(image):
+                drawings.append((kanji, _distort(image, rng)))
+                break
+    return drawings
+
+
+def load_drawings(folder: Path) -> list[tuple[str, Image.Image]]:
+    """Labelled drawings named `test_{kanji}*.png`, as in `dataset/test.py`"""
+    return [
+        (file.stem.split("_")[1], Image.open(file, "r").convert("L"))
+        for file in sorted(folder.glob("test_*.png"))
+    ]
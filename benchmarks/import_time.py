@@ -0,0 +1,63 @@
+"""Fails if starting the CLI (or importing the modules used by the lightweight commands) gets too slow
+
+Runs each case in a fresh interpreter with `python -X importtime` and sums the cumulative time of the top-level imports.
+Also fails if one of the heavy libraries (torch, transformers, ...) is imported where it should not be.
+
+Usage: `py benchmarks/import_time.py` from the project root, exits with status 1 if any case is over budget.
+"""
+import os
+import re
+import sys
+import subprocess
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+
+HEAVY_MODULES = {"torch", "transformers", "onnxruntime", "polars"}
+
+# (description, python code, budget in seconds, heavy modules that are allowed)
+CASES = [
+    ("main.py --help", "import sys; sys.argv = ['main.py', '--help']; import runpy; runpy.run_path('main.py', run_name='__main__')", 0.5, set()),
+    ("upload_embeddings imports", "import main, generate_images, embedding_store, manifest, database", 2.0, set()),
+    ("search service startup", "import main, server", 0.5, set()),
+]
+
+_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure(code: str) -> tuple[float, set[str]]:
+    """Returns the total import time in seconds and the set of top-level packages imported"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=SRC,
+        env={**os.environ, "PYTHONPATH": str(SRC)},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise Exception(f"Failed to run {code!r}:\n{result.stderr[-2000:]}")
+
+    total_us = 0
+    packages = set()
+    for match in _LINE.finditer(result.stderr):
+        _self_us, cumulative_us, indent, module = match.groups()
+        packages.add(module.split(".")[0])
+        if len(indent) == 1:  # Top-level import, its cumulative time includes everything it imported
+            total_us += int(cumulative_us)
+    return total_us / 1e6, packages
+
+
+def main() -> int:
+    failed = False
+    print(f"{'case':<30}{'seconds':>10}{'budget':>10}  heavy imports")
+    for description, code, budget, allowed in CASES:
+        seconds, packages = measure(code)
+        heavy = (packages & HEAVY_MODULES) - allowed
+        status = "FAIL" if seconds > budget or heavy else "ok"
+        failed |= status == "FAIL"
+        print(f"{description:<30}{seconds:>10.3f}{budget:>10.2f}  {', '.join(sorted(heavy)) or '-'}  {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
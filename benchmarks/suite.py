@@ -0,0 +1,280 @@
+"""Throughput, latency and retrieval quality benchmarks, printed as JSON to compare results across commits
+
+Measures:
+- `render`: `draw_kanji` and `generate_images_for_font` images per second, and stroke queries rasterized per second (`strokes.py`)
+- `embed`: `get_embeddings` images per second for each batch size and number of torch threads
+- `insert`: `insert` points per second into an in-memory Qdrant (`":memory:"`) and the numpy `MatrixIndex`, with and without prototypes
+- `search`: `search_vector` p50 / p99 latency against both, also restricted to a single font and grouped by kanji,
+  and the throughput of `search_batch` with every query at once
+- `recall`: recall@1/5/10 of labelled drawings against the index of every font
+
+Runs offline by default, with the deterministic stand-in encoder from `fixtures.py`,
+pass `--real-model` to use the model configured in `config.py` instead (the numbers are only comparable with the same setting).
+
+Usage (from the project root, with the `data` folder in the current directory):
+    py benchmarks/suite.py --output before.json
+    py benchmarks/suite.py --compare before.json
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import contextlib
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.append(str(Path(__file__).resolve().parent))
+
+import numpy as np
+import torch
+from qdrant_client import QdrantClient
+
+from config import MODEL, MODEL_EMBEDDING_SIZE, EMBEDDING_QUANTIZATION, FONT_SIZE
+from generate_images import draw_kanji, generate_images_for_font
+from encoder import get_embeddings
+from database import create_collection, insert, search_vector, search_batch, format_search_results
+from matrix_index import MatrixIndex
+from search_filter import SearchFilter
+from strokes import load_strokes
+from fixtures import SEED, StandInEncoder, stand_in_feature_extractor, load_fonts, load_kanji, synthetic_drawings, load_drawings
+
+RECALL_AT = (1, 5, 10)
+
+
+def _timed(function, repeats: int = 1) -> float:
+    """Seconds per call, best of `repeats` (the minimum is the least noisy estimate)"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _latencies(function, inputs: list) -> dict[str, float]:
+    seconds = []
+    for item in inputs:
+        start = time.perf_counter()
+        function(item)
+        seconds.append(time.perf_counter() - start)
+    milliseconds = np.asarray(seconds) * 1000
+    return {
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+        "mean_ms": float(milliseconds.mean()),
+    }
+
+
+def bench_render(fonts: dict, kanji_list: list[str], repeats: int) -> dict:
+    font = next(iter(fonts.values()))
+    draw = _timed(lambda: [draw_kanji(font, kanji) for kanji in kanji_list], repeats)
+    generate = _timed(lambda: generate_images_for_font(font, kanji_list), repeats)
+    # About as many strokes and points as a handwritten kanji
+    generator = np.random.default_rng(SEED)
+    walks = np.cumsum(generator.normal(0, 6, (len(kanji_list), 10, 12, 2)), axis=2) + 150
+    queries = [{"strokes": walk.reshape(10, 24).tolist(), "width": 300, "height": 300} for walk in walks]
+    rasterize = _timed(lambda: [load_strokes(query) for query in queries], repeats)
+    return {
+        "images": len(kanji_list),
+        "draw_kanji_images_per_s": len(kanji_list) / draw,
+        "generate_images_for_font_images_per_s": len(kanji_list) / generate,
+        "rasterize_strokes_per_s": len(kanji_list) / rasterize,
+    }
+
+
+def bench_embed(extractor, encoder, images: list, batch_sizes: list[int], threads: list[int], repeats: int) -> list[dict]:
+    previous_threads = torch.get_num_threads()
+    results = []
+    try:
+        for thread_count in threads:
+            torch.set_num_threads(thread_count)
+            for batch_size in batch_sizes:
+                batch = [images[i % len(images)] for i in range(batch_size)]
+                get_embeddings(extractor, encoder, batch)  # Warm up
+                seconds = _timed(lambda: get_embeddings(extractor, encoder, batch), repeats)
+                results.append({
+                    "threads": thread_count,
+                    "batch_size": batch_size,
+                    "batch_ms": seconds * 1000,
+                    "images_per_s": batch_size / seconds,
+                })
+    finally:
+        torch.set_num_threads(previous_threads)
+    return results
+
+
+def _synthetic_points(count: int, kanji_list: list[str]) -> list[tuple[str, dict[str, torch.Tensor]]]:
+    """`count` random embeddings split into fonts of `len(kanji_list)` points each, as passed to `insert`"""
+    generator = torch.Generator().manual_seed(SEED)
+    vectors = torch.randn(count, MODEL_EMBEDDING_SIZE, generator=generator)
+    fonts = []
+    for font_index, start in enumerate(range(0, count, len(kanji_list))):
+        chunk = vectors[start : start + len(kanji_list)]
+        fonts.append((f"font_{font_index}", dict(zip(kanji_list, chunk))))
+    return fonts
+
+
+def _new_backends() -> dict:
+    qdrant = QdrantClient(":memory:")
+    assert create_collection(qdrant), "Failed to create collection"
+    return {"qdrant": qdrant, "numpy": MatrixIndex(prototype_centroids=None), "numpy_prototypes": MatrixIndex(prototype_centroids=1)}
+
+
+def bench_insert_and_search(kanji_list: list[str], points: int, queries: int) -> tuple[dict, dict]:
+    fonts = _synthetic_points(points, kanji_list)
+    standard_set = set(kanji_list)
+    query_vectors = list(torch.randn(queries, MODEL_EMBEDDING_SIZE, generator=torch.Generator().manual_seed(SEED + 1)))
+
+    font_filter = SearchFilter(fonts=(fonts[0][0],))
+    insert_results, search_results = {}, {}
+    for name, backend in _new_backends().items():
+        seconds = _timed(lambda: [insert(backend, font_name, kanji_dict, standard_set) for font_name, kanji_dict in fonts])
+        insert_results[name] = {"points": points, "points_per_s": points / seconds}
+        search_vector(backend, query_vectors[0], limit=50)  # Warm up
+        search_results[name] = {
+            "points": points,
+            "limit": 50,
+            **_latencies(lambda query: search_vector(backend, query, limit=50), query_vectors),
+            "font_filter": _latencies(lambda query: search_vector(backend, query, limit=50, search_filter=font_filter), query_vectors),
+            "distinct_kanji": _latencies(lambda query: search_vector(backend, query, limit=50, group_by_kanji=True), query_vectors),
+            "batch_queries_per_s": len(query_vectors) / _timed(lambda: search_batch(backend, torch.stack(query_vectors), limit=50)),
+        }
+    return insert_results, search_results
+
+
+def bench_recall(extractor, encoder, fonts: dict, kanji_list: list[str], drawings: list[tuple[str, object]]) -> dict:
+    standard_set = set(kanji_list)
+    backends = _new_backends()
+    for font_name, font in fonts.items():
+        images = generate_images_for_font(font, kanji_list)
+        if not images:
+            continue
+        tensor = get_embeddings(extractor, encoder, list(images.values()))
+        for backend in backends.values():
+            insert(backend, font_name, dict(zip(images, tensor)), standard_set)
+
+    labels = [label for label, _ in drawings]
+    query_vectors = get_embeddings(extractor, encoder, [image for _, image in drawings])
+    results = {}
+    for name, backend in backends.items():
+        hits_at = dict.fromkeys(RECALL_AT, 0)
+        for label, query in zip(labels, query_vectors):
+            ranking = [result.kanji for result in format_search_results(search_vector(backend, query, limit=max(RECALL_AT), group_by_kanji=True))]
+            for k in RECALL_AT:
+                hits_at[k] += label in ranking[:k]
+        results[name] = {"queries": len(labels), **{f"recall@{k}": hits / max(len(labels), 1) for k, hits in hits_at.items()}}
+    return results
+
+
+def _git_commit() -> str | None:
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _flatten(value, prefix: str = "") -> dict[str, float]:
+    """`{"embed": [{"threads": 1, "batch_size": 8, "images_per_s": 10}]}` -> `{"embed.threads=1.batch_size=8.images_per_s": 10}`"""
+    if isinstance(value, dict):
+        flat = {}
+        for key, item in value.items():
+            flat.update(_flatten(item, f"{prefix}{key}."))
+        return flat
+    if isinstance(value, list):
+        flat = {}
+        for item in value:
+            name = ".".join(f"{key}={item[key]}" for key in ("threads", "batch_size") if key in item)
+            flat.update(_flatten({k: v for k, v in item.items() if k not in ("threads", "batch_size")}, f"{prefix}{name}."))
+        return flat
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix.rstrip("."): value}
+    return {}
+
+
+def compare(baseline: dict, current: dict):
+    """Print every metric of both runs side by side, with the relative change"""
+    before, after = _flatten(baseline["results"]), _flatten(current["results"])
+    print(f"{'metric':<70}{'baseline':>12}{'current':>12}{'change':>10}", file=sys.stderr)
+    for metric in sorted(before.keys() & after.keys()):
+        change = f"{(after[metric] - before[metric]) / before[metric]:+.1%}" if before[metric] else "-"
+        print(f"{metric:<70}{before[metric]:>12.4g}{after[metric]:>12.4g}{change:>10}", file=sys.stderr)
+
+
+def run(args: argparse.Namespace) -> dict:
+    torch.manual_seed(SEED)
+    fonts = load_fonts(args.fonts)
+    kanji_list = load_kanji(args.kanji)
+
+    if args.real_model:
+        from encoder import load_model
+        extractor, encoder = load_model()
+    else:
+        extractor, encoder = stand_in_feature_extractor(), StandInEncoder()
+
+    drawings = load_drawings(args.drawings) if args.drawings else synthetic_drawings(fonts, kanji_list)
+    rendered = list(generate_images_for_font(next(iter(fonts.values())), kanji_list).values())
+
+    results = {}
+    print("Rendering", file=sys.stderr)
+    results["render"] = bench_render(fonts, kanji_list, args.repeats)
+    print("Embedding", file=sys.stderr)
+    results["embed"] = bench_embed(extractor, encoder, rendered, args.batch_sizes, args.threads, args.repeats)
+    print("Inserting and searching", file=sys.stderr)
+    results["insert"], results["search"] = bench_insert_and_search(kanji_list, args.points, args.queries)
+    print("Measuring recall", file=sys.stderr)
+    results["recall"] = bench_recall(extractor, encoder, fonts, kanji_list, drawings)
+
+    return {
+        "metadata": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "encoder": MODEL if args.real_model else "stand-in",
+            "quantization": EMBEDDING_QUANTIZATION,
+            "font_size": FONT_SIZE,
+            "fonts": list(fonts),
+            "kanji": len(kanji_list),
+            "drawings": str(args.drawings) if args.drawings else "synthetic",
+            "seed": SEED,
+        },
+        "results": results,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", type=Path, help="Write the JSON to this file instead of stdout")
+    parser.add_argument("--compare", type=Path, help="Print the change of every metric against a previous output")
+    parser.add_argument("--real-model", action="store_true", help="Use the model from config.py instead of the stand-in encoder")
+    parser.add_argument("--drawings", type=Path, help="Folder of labelled `test_{kanji}*.png` drawings, synthetic ones by default")
+    parser.add_argument("--fonts", type=int, default=4, help="Maximum number of fonts to index")
+    parser.add_argument("--kanji", type=int, default=128, help="Maximum number of kanji per font")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--threads", type=int, nargs="+", default=sorted({1, torch.get_num_threads()}))
+    parser.add_argument("--points", type=int, default=10_000, help="Number of (random) points inserted for the insert / search benchmarks")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    # Keep stdout for the JSON, the progress messages of the project's own functions go to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        args.output.write_text(output, encoding="UTF-8")
+    else:
+        print(output)
+
+    if args.compare:
+        compare(json.loads(args.compare.read_text(encoding="UTF-8")), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
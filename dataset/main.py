@@ -1,85 +1,43 @@
-"""Convert torch embeddings .pt files into a .parquet dataset
+"""Convert the embedding store (see src/embedding_store.py) into a .parquet dataset
 
 Note: I am aware that it currently does not works with HuggingFace `datasets`.
 I don't care, and you can load with just about any Arrow-compliant library like pola.rs or even pandas.
 See: https://github.com/huggingface/datasets/issues/5706
+
+The file is written one font at a time through a `ParquetWriter`, so memory usage stays around the size of the largest font.
+Each font is its own row group with statistics on `font` and `kanji`, see `dataset/reader.py` to read only some fonts back.
 """
 
 
+import os
+import sys
+import json
 from pathlib import Path
 
-import torch
-import polars as pl
+import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
 # import datasets
 
-# Polars columns:
-    # - font : pl.Enum
-    # - character : pl.String
-    # - embedding : pl.List(pl.Float32)
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+from quantization import check_mode, fit_scale, quantize  # noqa
+from embedding_store import EmbeddingStore  # noqa
 
 # Arrow Columns:
     # "font": pa.dictionary(pa.uint8(), pa.string()),
     # "kanji": pa.string(),
     # "embedding": pa.list_(pa.float32(), EMBEDDING_SIZE),
 
-
-# the `embedding` should be a pl.Array(pl.Float32, EMBEDDING_SIZE) but they do not support writing it to files yet 
 # I kinda wish I could use Utf16 instead of Utf8 for the `kanji` column, but it is not supported by arrow nor polars
 
 EMBEDDING_SIZE = 768
 
-EMBEDDINGS_FOLDER = Path.cwd() / "data" / "generated" / "embeddings"
-
-
-# Data format:
-# sub-folders with the name of each font
-# # batch_{i}.pt => pytorch stacked tensor containing a batch of embeddings, represented as a tensor of shape (n, EMBEDDING_SIZE)
-# # batch_{i}.txt => labels for these tensors
-# E.g.
-# embeddings/KaiseiTokumin-Regular/batch_0.pt -> (3, EMBEDDING_SIZE) tensor
-# embeddings/KaiseiTokumin-Regular/batch_0.txt -> "猫\n狐\n狼"
-data = []
-for font_folder in EMBEDDINGS_FOLDER.iterdir():
-    for tensor_file in font_folder.glob("*.pt"):
-        tensor = torch.load(tensor_file, weights_only=True)
-        labels = tensor_file.with_suffix(".txt").read_text("UTF-8").splitlines()
-        assert len(tensor) == len(labels)
-        data.append((font_folder, labels, tensor))
-
-kanji = pl.concat([pl.Series("kanji", batch[1]) for batch in data])
-
-# EmbeddingArray = pl.Array(pl.Float32, EMBEDDING_SIZE)
-# tensors = pl.concat([pl.Series("embedding", batch[2].numpy(), dtype=EmbeddingArray) for batch in data])
-# pyo3_runtime.PanicException: not yet implemented: Writing FixedSizeList to parquet not yet implemented
-EmbeddingList = pl.List(pl.Float32)
-tensors = pl.concat([pl.Series("embedding", batch[2].numpy(), dtype=EmbeddingList) for batch in data])
-
-FontEnum = pl.Enum(folder.name for folder in EMBEDDINGS_FOLDER.iterdir())
-fonts = pl.concat([pl.repeat(batch[0].name, len(batch[1]), dtype=FontEnum, eager=True) for batch in data])
-
-df = pl.DataFrame(
-    {
-        "font": fonts,
-        "kanji": kanji,
-        "embedding": tensors,
-    }
-)
-
-del data
+# Optionally store compact codes instead of float32: `float16`, `int8` (per-dimension scale in the file metadata) or `binary` (sign bits)
+QUANTIZATION = os.getenv("KANJI_EMBEDDING_QUANTIZATION") or None
+check_mode(QUANTIZATION)
 
 DATASET_PATH = Path.cwd() / "dataset" / "kanji_embeddings.parquet"
 
-# df.write_parquet(DATASET_PATH, statistics=True)
-table = df.to_arrow()
-del df
-table = table.cast(pa.schema({
-    "font": pa.dictionary(pa.uint8(), pa.string()),
-    "kanji": pa.string(),
-    "embedding": pa.list_(pa.float32(), EMBEDDING_SIZE),
-}))
-
 # compressions = [
 #     'snappy',  # hard to tell the speed since it was the first but 197MB
 #     'gzip',  # rather fast, 159MB
@@ -88,17 +46,69 @@ table = table.cast(pa.schema({
 #     'lz4',  # descent, 173MB
 #     'none',  # fast but 227 MB
 # ]
-# for compression in compressions:
-#     pq.write_table(table, DATASET_PATH.with_stem(DATASET_PATH.stem + compression), compression=compression)
 
 # Note: The font and kanji take < 1 MB, the bulk of the dataset size is in the embeddings
 # To my surprise, it looks like some algorithms are able to compress the embeddings by quite a lot (up to ~30% !)
-
-pq.write_table(table, DATASET_PATH, compression="gzip")
-
-# dataset = datasets.Dataset(table)
-# I refuse to believe that they do not support Enums
-del table
-# dataset.push_to_hub(...)
-
-# test = pl.read_parquet(DATASET_PATH)
\ No newline at end of file
+COMPRESSION = "gzip"
+
+
+def embedding_type(mode: str | None) -> pa.DataType:
+    if mode is None:
+        return pa.list_(pa.float32(), EMBEDDING_SIZE)
+    if mode == "binary":
+        return pa.binary(EMBEDDING_SIZE // 8)
+    return pa.list_(pa.float16() if mode == "float16" else pa.int8(), EMBEDDING_SIZE)
+
+
+def embedding_array(vectors: np.ndarray, mode: str | None, scale: np.ndarray | None) -> pa.Array:
+    """Wraps the (encoded) vectors into a `fixed_size_list` (or `fixed_size_binary`) array without converting each row"""
+    codes = np.ascontiguousarray(vectors, dtype=np.float32) if mode is None else quantize(np.asarray(vectors), mode, scale)
+    if mode == "binary":
+        return pa.Array.from_buffers(embedding_type(mode), len(codes), [None, pa.py_buffer(codes)])
+    return pa.FixedSizeListArray.from_arrays(pa.array(codes.ravel()), EMBEDDING_SIZE)
+
+
+def export(store: EmbeddingStore, path: Path, mode: str | None = QUANTIZATION):
+    fonts = [font_name for font_name in store.fonts if len(store.font_rows(font_name))]
+    font_type = pa.dictionary(pa.uint8(), pa.string())
+    font_dictionary = pa.array(fonts, pa.string())
+
+    metadata = {}
+    scale = None
+    if mode is not None:
+        metadata["embedding_quantization"] = mode
+    if mode == "int8":
+        # The scale covers every font, so it takes a first pass over the (memory-mapped) vectors
+        scale = np.maximum.reduce([fit_scale(vectors) for _, _, vectors in store.iter_fonts()])
+        metadata["embedding_scale"] = json.dumps(scale.tolist())
+
+    schema = pa.schema(
+        {"font": font_type, "kanji": pa.string(), "embedding": embedding_type(mode)},
+        metadata=metadata or None,
+    )
+
+    temporary = path.with_suffix(".tmp")
+    with pq.ParquetWriter(temporary, schema, compression=COMPRESSION, write_statistics=["font", "kanji"]) as writer:
+        # The vectors of each font are views of the memory-mapped file, only one font is ever loaded at once
+        for font_name, labels, vectors in store.iter_fonts():
+            font_ids = pa.array(np.full(len(labels), fonts.index(font_name), dtype=np.uint8))
+            table = pa.Table.from_arrays(
+                [
+                    pa.DictionaryArray.from_arrays(font_ids, font_dictionary),
+                    pa.array(labels, pa.string()),
+                    embedding_array(vectors, mode, scale),
+                ],
+                schema=schema,
+            )
+            writer.write_table(table, row_group_size=len(table))  # One row group per font
+            print(f"Wrote {len(table)} embeddings for font {font_name}")
+    temporary.replace(path)
+
+
+if __name__ == "__main__":
+    # Data format: see src/embedding_store.py, a single memory-mapped (N, EMBEDDING_SIZE) matrix plus the (font, kanji) of each row
+    export(EmbeddingStore(), DATASET_PATH)
+
+    # dataset = datasets.Dataset(table)
+    # I refuse to believe that they do not support Enums
+    # dataset.push_to_hub(...)
@@ -0,0 +1,52 @@
+"""Read the parquet dataset written by dataset/main.py back as a `(N, 768)` float32 NumPy array
+
+Usage:
+    from reader import read_embeddings
+    table, vectors = read_embeddings("dataset/kanji_embeddings.parquet", fonts=["Yomogi-Regular"])
+
+Only the row groups of the requested fonts are read (one row group per font, filtered through the `font` statistics).
+For float32 files, `vectors` is a view over the Arrow buffer of the `embedding` column when a single row group is read
+(e.g. a single font), otherwise the row groups are concatenated once. Quantized files are decoded back to float32.
+"""
+import sys
+import json
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+from quantization import dequantize  # noqa
+
+EMBEDDING_SIZE = 768
+
+
+def embeddings_view(column: pa.ChunkedArray | pa.Array, mode: str | None = None, scale: np.ndarray | None = None) -> np.ndarray:
+    """`(N, EMBEDDING_SIZE)` float32 array of the `embedding` column, zero-copy if it is a single chunk of float32 values"""
+    if isinstance(column, pa.ChunkedArray):
+        column = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+    if mode == "binary":
+        width = column.type.byte_width
+        codes = np.frombuffer(column.buffers()[1], dtype=np.uint8, count=len(column) * width, offset=column.offset * width)
+        return dequantize(codes.reshape(-1, width), mode, scale, EMBEDDING_SIZE)
+    codes = column.flatten().to_numpy(zero_copy_only=mode is None).reshape(len(column), EMBEDDING_SIZE)
+    if mode is None:
+        return codes
+    return dequantize(codes, mode, scale, EMBEDDING_SIZE)
+
+
+def read_embeddings(path: str | Path, fonts: list[str] | None = None, kanji: list[str] | None = None) -> tuple[pa.Table, np.ndarray]:
+    """Returns the table (font, kanji, embedding) and the embeddings as a `(N, EMBEDDING_SIZE)` float32 array.
+    Optionally only for the given fonts and / or kanji"""
+    filters = []
+    if fonts is not None:
+        filters.append(("font", "in", fonts))
+    if kanji is not None:
+        filters.append(("kanji", "in", kanji))
+    table = pq.read_table(path, filters=filters or None, memory_map=True)
+
+    metadata = table.schema.metadata or {}
+    mode = metadata.get(b"embedding_quantization", b"").decode() or None
+    scale = np.array(json.loads(metadata[b"embedding_scale"]), dtype=np.float32) if mode == "int8" else None
+    return table, embeddings_view(table.column("embedding"), mode, scale)
@@ -1,46 +1,173 @@
+"""Top-k accuracy of labelled drawings against the whole parquet dataset
+
+Drawings are named `test_{kanji}*.png` (e.g. `dataset/test_亜.png`), encoded in batches, and scored against every embedding
+of the dataset with one normalized matrix product per (chunk of drawings, font). A kanji's score is its best score in any font,
+the same as the search results once duplicates are removed.
+
+Reports the top-k accuracy overall, per font (ranking only that font's kanji), per kanji,
+and for each calibration setting: none, every `main.py calibrate` profile with drawings, and any `--calibration` offset (.pt) file.
+
+Usage: `py dataset/test.py --drawings dataset -k 1 5 10` from the project root
+"""
+import sys
+import json
+import time
+import argparse
 from pathlib import Path
+
+import numpy as np
 import torch
-from torch import cosine_similarity
-import polars as pl
 from PIL import Image
 
-import sys
-# sys.path.append(str((Path.cwd() / 'src').resolve()))
-sys.path.append(str((Path(__file__) / '../src').resolve()))
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+sys.path.append(str(Path(__file__).resolve().parent))
+from calibration import CalibrationProfiles  # noqa
 from encoder import load_model, get_embeddings  # noqa
+from reader import read_embeddings  # noqa
+
+DATASET_PATH = Path.cwd() / "dataset" / "kanji_embeddings.parquet"
+
+ENCODE_BATCH_SIZE = 64
+# Drawings scored at once, the temporary score matrices are (QUERY_CHUNK_SIZE, number of kanji) float32
+QUERY_CHUNK_SIZE = 1024
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def load_drawings(folder: Path) -> tuple[list[str], list[Path]]:
+    files = sorted(folder.glob("test_*.png"))
+    return [file.stem.split("_")[1] for file in files], files
+
+
+def encode_drawings(files: list[Path]) -> np.ndarray:
+    extractor, encoder = load_model()
+    batches = []
+    for i in range(0, len(files), ENCODE_BATCH_SIZE):
+        images = [Image.open(file, "r").convert("L") for file in files[i : i + ENCODE_BATCH_SIZE]]
+        batches.append(get_embeddings(extractor, encoder, images).numpy())
+    return np.concatenate(batches)
+
+
+def load_calibrations(extra_files: list[Path]) -> dict[str, np.ndarray]:
+    settings = {"none": None}
+    profiles = CalibrationProfiles()
+    for name in profiles.names:
+        if profiles.count(name):
+            settings[f"profile:{name}"] = profiles.offset(name)
+    for file in extra_files:
+        settings[file.stem] = torch.load(file, weights_only=True).numpy()
+    return settings
+
+
+class Corpus:
+    """The dataset embeddings (normalized), grouped by font, with each kanji mapped to a column of the score matrices"""
+    def __init__(self, path: Path):
+        table, vectors = read_embeddings(path)
+        fonts = np.asarray(table.column("font").to_pylist())
+        kanji = table.column("kanji").to_pylist()
+        self.kanji = list(dict.fromkeys(kanji))
+        kanji_ids = {k: i for i, k in enumerate(self.kanji)}
+        self.kanji_ids = np.array([kanji_ids[k] for k in kanji], dtype=np.int64)
+        self.vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        self.fonts = {font: np.flatnonzero(fonts == font) for font in dict.fromkeys(fonts.tolist())}
+
+    def __len__(self):
+        return len(self.kanji_ids)
+
+
+def rank_labels(corpus: Corpus, queries: np.ndarray, labels: np.ndarray) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Returns the rank (0 = best) of each query's label among every kanji, and among the kanji of each font (-1 if the font does not have it)"""
+    ranks = np.empty(len(queries), dtype=np.int64)
+    font_ranks = {font: np.full(len(queries), -1, dtype=np.int64) for font in corpus.fonts}
+    for start in range(0, len(queries), QUERY_CHUNK_SIZE):
+        chunk = _normalize(queries[start : start + QUERY_CHUNK_SIZE])
+        chunk_labels = labels[start : start + QUERY_CHUNK_SIZE]
+        rows = np.arange(len(chunk))
+        best = np.full((len(chunk), len(corpus.kanji)), -np.inf, dtype=np.float32)
+        for font, font_rows in corpus.fonts.items():
+            scores = chunk @ corpus.vectors[font_rows].T
+            ids = corpus.kanji_ids[font_rows]
+            # Each kanji appears at most once per font, so the fancy-indexed assignment has no conflicts
+            best[:, ids] = np.maximum(best[:, ids], scores)
+
+            column_of = np.full(len(corpus.kanji), -1, dtype=np.int64)
+            column_of[ids] = np.arange(len(ids))
+            columns = column_of[chunk_labels]
+            has_label = columns >= 0
+            label_scores = scores[rows[has_label], columns[has_label]]
+            font_ranks[font][start : start + len(chunk)][has_label] = (scores[has_label] > label_scores[:, None]).sum(axis=1)
+
+        label_scores = best[rows, chunk_labels]
+        ranks[start : start + len(chunk)] = (best > label_scores[:, None]).sum(axis=1)
+    return ranks, font_ranks
 
-lazy_df = pl.scan_parquet("dataset/kanji_embeddings.parquet")
 
-data = lazy_df.group_by("font").head().collect()
+def accuracy(ranks: np.ndarray, ks: list[int]) -> dict[str, float]:
+    return {f"top{k}": float((ranks < k).mean()) if len(ranks) else float("nan") for k in ks}
 
-font_labels = data.get_column("font")
-kanji_labels = data.get_column("kanji")
-tensors = torch.as_tensor(data.get_column("embedding"))
 
-# test_image_files = list((Path.cwd() / "dataset").glob("test_*.png"))
-test_image_files = list(Path(__file__).parent.glob("test_*.png"))
+def evaluate(drawings: Path, dataset: Path, ks: list[int], calibration_files: list[Path]) -> dict:
+    labels, files = load_drawings(drawings)
+    if not files:
+        raise Exception(f"Could not find any `test_{{kanji}}*.png` drawing in {drawings.resolve()}")
+    start = time.perf_counter()
+    corpus = Corpus(dataset)
+    print(f"Loaded {len(corpus)} embeddings of {len(corpus.kanji)} kanji in {len(corpus.fonts)} fonts ({time.perf_counter() - start:.1f}s)")
 
-_test_labels = [file.stem.split("_")[1] for file in test_image_files]
-test_images = [Image.open(file, 'r') for file in test_image_files]
+    known = [label in corpus.kanji for label in labels]
+    if not all(known):
+        print(f"Ignoring {len(known) - sum(known)} drawings of kanji missing from the dataset")
+    labels = [label for label, ok in zip(labels, known) if ok]
+    files = [file for file, ok in zip(files, known) if ok]
+    kanji_ids = {k: i for i, k in enumerate(corpus.kanji)}
+    label_ids = np.array([kanji_ids[label] for label in labels], dtype=np.int64)
 
-extractor, model = load_model()
-test_embeddings = get_embeddings(extractor, model, test_images)
+    start = time.perf_counter()
+    embeddings = encode_drawings(files)
+    print(f"Encoded {len(files)} drawings ({time.perf_counter() - start:.1f}s)")
 
-def transform(tensor):
-    return tensor * 0.5 + 0.5
+    report = {}
+    for setting, offset in load_calibrations(calibration_files).items():
+        start = time.perf_counter()
+        queries = embeddings if offset is None else embeddings - offset
+        ranks, font_ranks = rank_labels(corpus, queries, label_ids)
+        per_kanji = {}
+        for label in dict.fromkeys(labels):
+            per_kanji[label] = accuracy(ranks[label_ids == kanji_ids[label]], ks)
+        report[setting] = {
+            "drawings": len(labels),
+            "overall": accuracy(ranks, ks),
+            "per_font": {font: accuracy(font_rank[font_rank >= 0], ks) for font, font_rank in font_ranks.items()},
+            "per_kanji": per_kanji,
+            "seconds": time.perf_counter() - start,
+        }
+    return report
 
-def score(a, b):
-    return cosine_similarity(transform(a), transform(b), dim=0)
 
-guesses = [
-    (label, score(embeddings, reference_embedding), kanji, font)
-    for label, embeddings in zip(_test_labels, test_embeddings)
-    for font, kanji, reference_embedding in zip(font_labels, kanji_labels, tensors)
-]
+def print_report(report: dict, ks: list[int], worst: int = 10):
+    columns = "".join(f"{f'top{k}':>8}" for k in ks)
+    for setting, results in report.items():
+        print(f"\n== Calibration: {setting} ({results['drawings']} drawings, scored in {results['seconds']:.2f}s)")
+        print(f"{'':<30}{columns}")
+        print(f"{'overall':<30}" + "".join(f"{value:>8.3f}" for value in results["overall"].values()))
+        for font, values in sorted(results["per_font"].items(), key=lambda item: -item[1][f"top{ks[0]}"]):
+            print(f"{font:<30}" + "".join(f"{value:>8.3f}" for value in values.values()))
+        hardest = sorted(results["per_kanji"].items(), key=lambda item: item[1][f"top{ks[-1]}"])[:worst]
+        print(f"Hardest kanji: " + ", ".join(f"{kanji} ({values[f'top{ks[-1]}']:.2f})" for kanji, values in hardest))
 
-guesses.sort(key=lambda t: (t[0], -t[1]))
 
-print(*guesses[:10], sep='\n')
-half = len(guesses) // 2
-print(*guesses[half:half+10], sep='\n')
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drawings", type=Path, default=Path(__file__).parent, help="Folder of `test_{kanji}*.png` drawings")
+    parser.add_argument("--dataset", type=Path, default=DATASET_PATH)
+    parser.add_argument("-k", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--calibration", type=Path, nargs="*", default=[], help="Extra calibration offsets (.pt) to compare")
+    parser.add_argument("--output", type=Path, help="Also write the full report as JSON")
+    args = parser.parse_args()
 
+    report = evaluate(args.drawings, args.dataset, sorted(args.k), args.calibration)
+    print_report(report, sorted(args.k))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="UTF-8")
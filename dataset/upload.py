@@ -1,18 +1,41 @@
+"""Upload the parquet dataset (see dataset/main.py) to Qdrant
+
+Streams the file one record batch at a time, decoding the embedding column straight from the Arrow buffers
+into a contiguous (rows, 768) float32 array, with `UPLOAD_WORKERS` upserts in flight at once (retried with exponential backoff).
+The offset of the last row uploaded (with every row before it uploaded too) is saved to `UPLOAD_CHECKPOINT_FILE`,
+running the script again after an interruption resumes from there. Delete the checkpoint file to upload everything again.
+"""
 import os
+import sys
+import json
+import time
 import uuid
+import random
 import pathlib
-import polars as pl
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 from qdrant_client import QdrantClient, models
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parent))
+from reader import embeddings_view  # noqa
+
 STANDARD_KANJI_SET_FILE = pathlib.Path.cwd() / "kanji_joyo.txt"
 EMBEDDINGS_PARQUET_FILE = pathlib.Path.cwd() / "dataset/kanji_embeddings.parquet"
+UPLOAD_CHECKPOINT_FILE = EMBEDDINGS_PARQUET_FILE.with_suffix(".upload.json")
 
 DATABASE_LOCATION = os.getenv("QDRANT_URL", 'localhost')
 DATABASE_API_KEY = os.getenv("QDRANT_API_KEY")
 
+# Same as `src/config.py`, the point ids depend on it
+MODEL = "kha-white/manga-ocr-base"
 MODEL_EMBEDDING_SIZE = 768
 BATCH_SIZE = 256
+UPLOAD_WORKERS = int(os.getenv("KANJI_UPLOAD_WORKERS", "4"))
+UPLOAD_RETRIES = 5
 
 def verify_paths():
     if not STANDARD_KANJI_SET_FILE.is_file():
@@ -28,8 +51,20 @@ def create_connection():
     print(f"Connecting to Qdrant ({DATABASE_LOCATION})")
     return QdrantClient(DATABASE_LOCATION, api_key=DATABASE_API_KEY, timeout=60)
 
+def create_payload_indexes(qdrant: QdrantClient):
+    """Same payload indexes as `database.create_payload_indexes`, skips the fields that already have one"""
+    existing = qdrant.get_collection("kanji").payload_schema
+    for field, schema in [
+        ("kanji", models.PayloadSchemaType.KEYWORD),
+        ("font", models.PayloadSchemaType.KEYWORD),
+        ("is_standard", models.PayloadSchemaType.BOOL),
+    ]:
+        if field in existing:
+            continue
+        qdrant.create_payload_index(collection_name="kanji", field_name=field, field_schema=schema, wait=True)
+
 def create_collection(qdrant: QdrantClient):
-    return qdrant.create_collection(
+    created = qdrant.create_collection(
         collection_name="kanji",
         vectors_config=models.VectorParams(
             size=MODEL_EMBEDDING_SIZE,
@@ -39,31 +74,88 @@ def create_collection(qdrant: QdrantClient):
             indexing_threshold=0,
         ),
     )
+    create_payload_indexes(qdrant)
+    return created
 
 # Create with indexing disabled, then set it to index after we are done inserting records
 
 def index_collection(qdrant: QdrantClient):
+    create_payload_indexes(qdrant)
     qdrant.update_collection(
         collection_name="kanji",
         optimizer_config=models.OptimizersConfigDiff(indexing_threshold=20000),
     )
 
 
-def insert(qdrant: QdrantClient, df: pl.DataFrame, standard_set: set[str]):
-    payload = pl.struct(
-        kanji = pl.col("kanji"),
-        font = pl.col("font"),
-        is_standard = pl.col("kanji").is_in(standard_set),
-    ).alias("payload")
+def read_batches(parquet_file: pq.ParquetFile, start: int):
+    """Yields `(offset, record_batch)` from row `start` onwards, skipping the row groups before it without reading them"""
+    row_groups, offset = [], 0
+    for i in range(parquet_file.metadata.num_row_groups):
+        rows = parquet_file.metadata.row_group(i).num_rows
+        if offset + rows > start or row_groups:
+            row_groups.append(i)
+        else:
+            offset += rows
+    if not row_groups:
+        return
+
+    for batch in parquet_file.iter_batches(BATCH_SIZE, row_groups=row_groups, columns=["font", "kanji", "embedding"]):
+        batch_start, offset = offset, offset + len(batch)
+        # Only the batches of the first row group can start before `start`
+        skipped = min(max(0, start - batch_start), len(batch))
+        if skipped < len(batch):
+            yield batch_start + skipped, batch.slice(skipped)
+
+
+def default_point_id(font_name: str, kanji: str) -> str:
+    # Same ids as `database.default_point_id`, so that this script and `main.py` overwrite each other's points
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{MODEL}/{font_name}/{kanji}"))
+
+
+def insert(qdrant: QdrantClient, batch: pa.RecordBatch, standard_set: set[str], mode: str | None, scale: np.ndarray | None):
+    fonts = batch.column("font").to_pylist()
+    kanji = batch.column("kanji").to_pylist()
+    vectors = embeddings_view(batch.column("embedding"), mode, scale)
+
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            return qdrant.upsert(
+                collection_name="kanji",
+                points=models.Batch(
+                    # Deterministic, so that uploading a batch again (retry or resume) overwrites the points instead of duplicating them
+                    ids=[default_point_id(f, k) for f, k in zip(fonts, kanji)],
+                    vectors=vectors,
+                    payloads=[{"kanji": k, "font": f, "is_standard": k in standard_set} for f, k in zip(fonts, kanji)],
+                ),
+                wait=True,
+            )
+        except Exception as e:
+            if attempt == UPLOAD_RETRIES - 1:
+                raise
+            delay = 2 ** attempt + random.random()
+            print(f"Upload failed ({e!r}), retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+
+
+def _file_identity(path: pathlib.Path) -> dict:
+    stat = path.stat()
+    return {"file": str(path.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def load_checkpoint(path: pathlib.Path) -> int:
+    """Returns the number of rows already uploaded, 0 if there is no checkpoint or it is for another version of the file"""
+    if not UPLOAD_CHECKPOINT_FILE.is_file():
+        return 0
+    checkpoint = json.loads(UPLOAD_CHECKPOINT_FILE.read_text(encoding="UTF-8"))
+    if {key: checkpoint.get(key) for key in ("file", "size", "mtime_ns")} != _file_identity(path):
+        print("Ignoring the upload checkpoint, it is for a different file")
+        return 0
+    return checkpoint["offset"]
+
+def save_checkpoint(path: pathlib.Path, offset: int):
+    temporary = UPLOAD_CHECKPOINT_FILE.with_suffix(".tmp")
+    temporary.write_text(json.dumps({**_file_identity(path), "offset": offset}), encoding="UTF-8")
+    temporary.replace(UPLOAD_CHECKPOINT_FILE)
 
-    return qdrant.upsert(
-        collection_name="kanji",
-        points=models.Batch(
-            ids=[str(uuid.uuid4()) for _ in range(BATCH_SIZE)],
-            vectors=df.get_column("embedding").to_numpy(),
-            payloads=df.select(payload).get_column("payload").to_list(),
-        )
-    )
 
 def get_standard_kanji_set() -> set[str]:
     file = STANDARD_KANJI_SET_FILE
@@ -71,24 +163,50 @@ def get_standard_kanji_set() -> set[str]:
 
 def upload_embeddings():
     qdrant = create_connection()
-    assert create_collection(qdrant), "Failed to create collection"
+    start = load_checkpoint(EMBEDDINGS_PARQUET_FILE)
+    if not qdrant.collection_exists("kanji"):
+        start = 0
+        assert create_collection(qdrant), "Failed to create collection"
 
     standard_set = get_standard_kanji_set()
-    df = pl.read_parquet(EMBEDDINGS_PARQUET_FILE)
-    
-    print(
-        f"Uploading a total of {len(df)} embeddings over {len(df) // BATCH_SIZE} batches of "
-        f"{BATCH_SIZE} for the following fonts: {df.get_column('font').unique(maintain_order=True).to_list()}"
-    )
+    parquet_file = pq.ParquetFile(EMBEDDINGS_PARQUET_FILE)
+    metadata = parquet_file.schema_arrow.metadata or {}
+    mode = metadata.get(b"embedding_quantization", b"").decode() or None
+    scale = np.array(json.loads(metadata[b"embedding_scale"]), dtype=np.float32) if mode == "int8" else None
+    total = parquet_file.metadata.num_rows
+
+    print(f"Uploading {total - start} of the {total} embeddings in batches of {BATCH_SIZE}, {UPLOAD_WORKERS} at once")
+    if mode is not None:
+        print(f"Decoding {mode} quantized embeddings")
+
+    # Batches may finish out of order, the checkpoint only moves past a batch once every batch before it is done
+    finished: dict[int, int] = {}  # offset -> length
+    committed = start
+    with ThreadPoolExecutor(UPLOAD_WORKERS) as executor, tqdm(total=total, initial=start, unit="point") as progress:
+        in_flight = {}
+
+        def collect(done):
+            nonlocal committed
+            for future in done:
+                offset, length = in_flight.pop(future)
+                future.result()
+                finished[offset] = length
+                progress.update(length)
+            while committed in finished:
+                committed += finished.pop(committed)
+            save_checkpoint(EMBEDDINGS_PARQUET_FILE, committed)
+
+        try:
+            for offset, batch in read_batches(parquet_file, start):
+                if len(in_flight) >= 2 * UPLOAD_WORKERS:
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                future = executor.submit(insert, qdrant, batch, standard_set, mode, scale)
+                in_flight[future] = (offset, len(batch))
+            collect(wait(in_flight).done)
+        finally:
+            for future in in_flight:
+                future.cancel()
 
-    _checkpoint = 0
-    for df_slice in tqdm(df.iter_slices(BATCH_SIZE)):
-        _checkpoint += 1
-        if _checkpoint > 0:
-            insert(qdrant, df_slice, standard_set)
-        # if _checkpoint > 50:
-        #     break
-    
     index_collection(qdrant)
 
 
@@ -100,4 +218,4 @@ if __name__ == "__main__":
 
     verify_paths()
 
-    upload_embeddings()
\ No newline at end of file
+    upload_embeddings()
@@ -0,0 +1,117 @@
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from PIL import Image
+import torch
+from transformers import ViTImageProcessor, ViTModel
+
+from config import (
+    BATCHING_MAX_SIZE,
+    BATCHING_MAX_WAIT,
+)
+from encoder import get_embeddings
+
+_STOP = object()
+
+
+class BatchingEncoder:
+    """Groups single image requests from many callers (threads or asyncio tasks) into batched `get_embeddings` calls.
+
+    A background thread waits for the first request, then keeps collecting more until either
+    `max_batch_size` requests are queued or `max_wait` seconds passed since the first one,
+    runs the encoder once for all of them and hands each caller its own row of the result.
+    """
+    def __init__(
+        self,
+        feature_extractor: ViTImageProcessor,
+        encoder: ViTModel,
+        max_batch_size: int = BATCHING_MAX_SIZE,
+        max_wait: float = BATCHING_MAX_WAIT,
+    ):
+        self.feature_extractor = feature_extractor
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches_count = 0
+        self.images_count = 0
+        self._queue: queue.Queue[tuple[Image.Image, Future] | object] = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="BatchingEncoder", daemon=True)
+        self._thread.start()
+
+    def submit(self, image: Image.Image) -> Future:
+        """Queue an image, the returned Future resolves to its embedding (a 1D tensor)"""
+        if self._closed:
+            raise Exception("BatchingEncoder is closed")
+        future = Future()
+        self._queue.put((image, future))
+        return future
+
+    def embed(self, image: Image.Image) -> torch.Tensor:
+        return self.submit(image).result()
+
+    async def embed_async(self, image: Image.Image) -> torch.Tensor:
+        return await asyncio.wrap_future(self.submit(image))
+
+    def close(self):
+        """Stop accepting new images, finish the ones already queued and stop the background thread"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+        # Fail anything submitted concurrently with `close`
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(Exception("BatchingEncoder is closed"))
+
+    def _flush(self, batch: list[tuple[Image.Image, Future]]):
+        # Skip the requests cancelled while waiting in the queue
+        batch = [(image, future) for image, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            tensor = get_embeddings(self.feature_extractor, self.encoder, [image for image, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches_count += 1
+        self.images_count += len(batch)
+        for (_, future), row in zip(batch, tensor):
+            future.set_result(row)
@@ -0,0 +1,138 @@
+"""Named calibration profiles: per user offsets between their drawings' embeddings and the reference font's
+
+Each profile is the running mean of `user embedding - reference embedding` over every drawing confirmed so far, plus their count,
+so adding a drawing costs one encode and an O(MODEL_EMBEDDING_SIZE) update instead of recomputing the mean over every drawing.
+All profiles live in memory as one `(profiles, MODEL_EMBEDDING_SIZE)` matrix, and get saved to `CALIBRATION_PROFILES_FILE`.
+At query time, `apply` subtracts the offset of each query's profile from a whole batch of query vectors at once.
+
+The offset written by older versions (`CALIBRATION_FILE`) is imported as the `default` profile.
+"""
+import io
+import time
+import typing
+import pathlib
+import threading
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    import torch  # Only for type hints, importing it takes a while
+    from embedding_store import EmbeddingStore
+
+from config import (
+    MODEL_EMBEDDING_SIZE,
+    CALIBRATION_FILE,
+    CALIBRATION_IMAGES_FOLDER,
+    CALIBRATION_PROFILES_FILE,
+    CALIBRATION_REFERENCE_FONT,
+    DEFAULT_CALIBRATION_PROFILE,
+)
+
+# Minimum interval in seconds between two writes when saving without `force`
+SAVE_INTERVAL = 10
+
+
+class CalibrationProfiles:
+    def __init__(self, path: pathlib.Path = CALIBRATION_PROFILES_FILE):
+        self.path = path
+        self.names: list[str] = []
+        self.means = np.zeros((0, MODEL_EMBEDDING_SIZE), dtype=np.float32)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._rows: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._last_save = time.monotonic()
+        self._dirty = False
+
+        if path.is_file():
+            with np.load(path) as data:
+                self.names = data["names"].tolist()
+                self.means = data["means"]
+                self.counts = data["counts"]
+            self._rows = {name: row for row, name in enumerate(self.names)}
+        elif CALIBRATION_FILE.is_file():
+            import torch
+            print(f"Importing {CALIBRATION_FILE} as the `{DEFAULT_CALIBRATION_PROFILE}` calibration profile")
+            offset = torch.load(CALIBRATION_FILE, weights_only=True).numpy()
+            count = max(len(list(CALIBRATION_IMAGES_FOLDER.glob("*.png"))), 1)  # Roughly how many drawings the mean is over
+            self._row(DEFAULT_CALIBRATION_PROFILE)
+            self.means[0], self.counts[0] = offset, count
+
+    def __contains__(self, name: str):
+        return name in self._rows
+
+    def _row(self, name: str) -> int:
+        row = self._rows.get(name)
+        if row is None:
+            row = self._rows[name] = len(self.names)
+            self.names.append(name)
+            self.means = np.concatenate([self.means, np.zeros((1, MODEL_EMBEDDING_SIZE), dtype=np.float32)])
+            self.counts = np.concatenate([self.counts, np.zeros(1, dtype=np.int64)])
+        return row
+
+    def count(self, name: str) -> int:
+        row = self._rows.get(name)
+        return 0 if row is None else int(self.counts[row])
+
+    def offset(self, name: str | None = None) -> np.ndarray:
+        """The profile's offset, zeros for profiles without any drawing yet"""
+        row = self._rows.get(name or DEFAULT_CALIBRATION_PROFILE)
+        return np.zeros(MODEL_EMBEDDING_SIZE, dtype=np.float32) if row is None else self.means[row].copy()
+
+    def apply(self, vectors: "np.ndarray | torch.Tensor", names: list[str | None]) -> np.ndarray:
+        """Subtract each vector's profile offset, `names[i]` being the profile of `vectors[i]` (None for the default one)"""
+        calibrated = np.array(vectors, dtype=np.float32)
+        with self._lock:
+            rows = np.array([self._rows.get(name or DEFAULT_CALIBRATION_PROFILE, -1) for name in names], dtype=np.int64)
+            known = rows >= 0  # Unknown profiles are left uncalibrated
+            calibrated[known] -= self.means[rows[known]]
+        return calibrated
+
+    def update(self, name: str, delta: "np.ndarray | torch.Tensor") -> int:
+        """Add one `user embedding - reference embedding` sample to the profile, returns its new sample count"""
+        delta = np.asarray(delta, dtype=np.float32)
+        with self._lock:
+            row = self._row(name)
+            self.counts[row] += 1
+            self.means[row] += (delta - self.means[row]) / self.counts[row]
+            self._dirty = True
+            return int(self.counts[row])
+
+    def reset(self, name: str):
+        with self._lock:
+            row = self._row(name)
+            self.means[row] = 0
+            self.counts[row] = 0
+            self._dirty = True
+
+    def save(self, force: bool = True):
+        if not self._dirty or (not force and time.monotonic() - self._last_save < SAVE_INTERVAL):
+            return
+        with self._lock:
+            buffer = io.BytesIO()
+            np.savez(buffer, names=np.array(self.names, dtype=str), means=self.means, counts=self.counts)
+            self._dirty = False
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        # Write then rename, so that a crash while saving does not corrupt the existing profiles
+        temporary = self.path.with_suffix(".tmp")
+        temporary.write_bytes(buffer.getvalue())
+        temporary.replace(self.path)
+        self._last_save = time.monotonic()
+
+
+def reference_embedding(
+    kanji: str,
+    user_embedding: "np.ndarray | torch.Tensor",
+    store: "EmbeddingStore | None" = None,
+    backend=None,
+    font_name: str = CALIBRATION_REFERENCE_FONT,
+) -> np.ndarray:
+    """Embedding of `kanji` in the reference font, from the embedding store if it has it, otherwise from the search backend.
+    The backends only keep normalized vectors (cosine distance), so those get scaled to the norm of the user's embedding"""
+    if store is not None and (font_name, kanji) in store:
+        return np.array(store.get(font_name, kanji), dtype=np.float32)
+    if backend is not None:
+        from database import get_vector
+
+        vector = get_vector(backend, font_name, kanji)
+        if vector is not None:
+            return vector * np.linalg.norm(np.asarray(user_embedding, dtype=np.float32))
+    raise Exception(f"Could not find the embedding of {kanji} in the reference font {font_name}")
@@ -1,6 +1,9 @@
+import os
 from pathlib import Path
 import argparse
 
+from config import SERVER_HOST, SERVER_PORT, DEFAULT_CALIBRATION_PROFILE, REDUCED_DIMENSIONS, REDUCTION_WHITEN, PROTOTYPE_CENTROIDS
+
 parser = argparse.ArgumentParser()
 subparsers = parser.add_subparsers()
 
@@ -10,6 +13,8 @@ subparsers = parser.add_subparsers()
 arg_generate_images = subparsers.add_parser("generate_images")
 arg_generate_images.set_defaults(_name="generate_images")
 
+arg_generate_images.add_argument("--workers", default=os.cpu_count() or 1, type=int, help="Number of processes, 1 to run in the current process")
+
 # arg_generate_images.add_argument("--file", default="kanji.txt", type=Path)
 
 # _fonts_group = arg_generate_images.add_mutually_exclusive_group()
@@ -18,16 +23,29 @@ arg_generate_images.set_defaults(_name="generate_images")
 
 # arg_generate_images.add_argument("-o", "--output", default="images", type=Path)
 
+# FONT COVERAGE (FROM THE CMAP OF EACH FONT)
+arg_font_coverage = subparsers.add_parser("font_coverage")
+arg_font_coverage.set_defaults(_name="font_coverage")
+
+arg_font_coverage.add_argument("--output", type=Path, help="Also save the (kanji x font) coverage matrix as CSV")
+
 # EMBEDDINGS
 arg_generate_embeddings = subparsers.add_parser("generate_embeddings")
 arg_generate_embeddings.set_defaults(_name="generate_embeddings")
 
+arg_generate_embeddings.add_argument("--workers", default=1, type=int, help="Number of processes, each with its own copy of the encoder")
+arg_generate_embeddings.add_argument("--threads", type=int, help="Torch threads per process (defaults to the number of CPUs split between the processes)")
+
 # arg_generate_embeddings.add_argument("--input", default="images", type=Path)
 
 # arg_generate_embeddings.add_argument("--base-model", default="manga-ocr")  # Unused (for now?)
 
 # arg_generate_embeddings.add_argument("-o", "--output", default="embeddings", type=Path)
 
+# CONVERT EMBEDDINGS FROM THE batch_{i}.pt / batch_{i}.txt LAYOUT (E.G. FROM THE NOTEBOOK)
+arg_import_embeddings = subparsers.add_parser("import_embeddings")
+arg_import_embeddings.set_defaults(_name="import_embeddings")
+
 # CREATE DATABASE
 arg_upload_embeddings = subparsers.add_parser("upload_embeddings")
 arg_upload_embeddings.set_defaults(_name="upload_embeddings")
@@ -36,17 +54,84 @@ arg_upload_embeddings.set_defaults(_name="upload_embeddings")
 
 # arg_upload_embeddings.add_argument("--database-location")
 
+# ALL OF THE ABOVE IN A SINGLE PASS, WITHOUT INTERMEDIATE FILES
+arg_build_index = subparsers.add_parser("build_index")
+arg_build_index.set_defaults(_name="build_index")
+
+arg_build_index.add_argument("--write-images", action="store_true", help="Also save the images, as generate_images does")
+arg_build_index.add_argument("--write-embeddings", action="store_true", help="Also save the embeddings, as generate_embeddings does")
+
+# EXPORT THE ENCODER TO ONNX AND COMPARE IT AGAINST PYTORCH
+arg_export_encoder = subparsers.add_parser("export_encoder")
+arg_export_encoder.set_defaults(_name="export_encoder")
+
+arg_export_encoder.add_argument("--no-quantize", action="store_true", help="Do not create the int8 quantized copy")
+arg_export_encoder.add_argument("--compare-only", action="store_true", help="Only compare the previously exported models")
+
 # CREATE AN EMBEDDING BASED ON THE DIFFERENCE BETWEEN THE USER INPUT AND THE REFERENCE
 arg_calibrate = subparsers.add_parser("calibrate")
 arg_calibrate.set_defaults(_name="calibrate")
 
+arg_calibrate.add_argument("--profile", default=DEFAULT_CALIBRATION_PROFILE, help="Name of the calibration profile to update")
+arg_calibrate.add_argument("--image", type=Path, help="Add this single drawing to the profile, instead of rebuilding it from every drawing in the calibration folder")
+arg_calibrate.add_argument("--kanji", help="The kanji drawn in `--image` (defaults to the file name)")
+
+# COMPARE THE QUANTIZED SEARCH AGAINST THE FLOAT32 BASELINE
+arg_quantization_report = subparsers.add_parser("quantization_report")
+arg_quantization_report.set_defaults(_name="quantization_report")
+
+arg_quantization_report.add_argument("--queries", default=1000, type=int)
+arg_quantization_report.add_argument("-k", default=10, type=int)
+
+# FIT THE PCA PROJECTION FOR THE REDUCED FIRST SEARCH PASS
+arg_fit_reduction = subparsers.add_parser("fit_reduction")
+arg_fit_reduction.set_defaults(_name="fit_reduction")
+
+arg_fit_reduction.add_argument("--dimensions", nargs="+", type=int, default=[REDUCED_DIMENSIONS or 128], help="Fit one projection for each")
+arg_fit_reduction.add_argument("--whiten", action="store_true", default=REDUCTION_WHITEN)
+arg_fit_reduction.add_argument("--parquet", type=Path, help="Fit on the parquet dataset instead of the generated embeddings")
+
+# COMPARE THE REDUCED FIRST PASS AGAINST THE FULL SEARCH
+arg_reduction_report = subparsers.add_parser("reduction_report")
+arg_reduction_report.set_defaults(_name="reduction_report")
+
+arg_reduction_report.add_argument("--dimensions", nargs="+", type=int, default=[32, 64, 128, 256])
+arg_reduction_report.add_argument("--whiten", action="store_true", default=REDUCTION_WHITEN)
+arg_reduction_report.add_argument("--queries", default=1000, type=int)
+arg_reduction_report.add_argument("-k", default=10, type=int)
+
+# COMPUTE AND UPLOAD THE PER KANJI PROTOTYPES FOR THE FIRST SEARCH PASS
+arg_build_prototypes = subparsers.add_parser("build_prototypes")
+arg_build_prototypes.set_defaults(_name="build_prototypes")
+
+arg_build_prototypes.add_argument("--centroids", type=int, default=PROTOTYPE_CENTROIDS or 1, help="1 for the mean of every font, more for that many k-means centroids")
+
+# COMPARE THE PROTOTYPE FIRST PASS AGAINST THE FULL SEARCH
+arg_prototype_report = subparsers.add_parser("prototype_report")
+arg_prototype_report.set_defaults(_name="prototype_report")
+
+arg_prototype_report.add_argument("--centroids", nargs="+", type=int, default=[1, 2, 4])
+arg_prototype_report.add_argument("--queries", default=1000, type=int)
+arg_prototype_report.add_argument("-k", default=10, type=int)
+
 # SEARCH DATABASE
 arg_search = subparsers.add_parser("search")
 arg_search.set_defaults(_name="search")
 
 arg_search.add_argument("input", type=Path)
+arg_search.add_argument("--profile", default=DEFAULT_CALIBRATION_PROFILE, help="Calibration profile to apply to the drawings")
+arg_search.add_argument("--standard-only", action="store_true", help="Only search the Jōyō kanji")
+arg_search.add_argument("--fonts", nargs="+", help="Only search these fonts")
+arg_search.add_argument("--exclude-fonts", nargs="+", help="Do not search these fonts")
 # arg_search.add_argument("--database-location")
 
+# KEEP THE MODEL LOADED AND ANSWER SEARCHES OVER HTTP
+arg_serve = subparsers.add_parser("serve")
+arg_serve.set_defaults(_name="serve")
+
+arg_serve.add_argument("--host", default=SERVER_HOST)
+arg_serve.add_argument("--port", default=SERVER_PORT, type=int)
+
 if __name__ == "__main__":
     args = parser.parse_args()
     print(args)
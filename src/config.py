@@ -19,6 +19,11 @@ INPUT_KANJI_FOLDER = INPUTS / 'text'
 GENERATED_IMAGES_FOLDER = GENERATED / 'images'
 GENERATED_EMBEDDINGS_FOLDER = GENERATED / 'embeddings'
 
+# Records what has already been generated / uploaded, see `manifest.py`
+MANIFEST_FILE = GENERATED / 'manifest.json'
+# Characters supported by each font file, see `font_coverage.py`
+FONT_COVERAGE_FOLDER = GENERATED / 'coverage'
+
 # Store the Model itself (it is already cached by Transformers, but I'd rather have it in the project folder)
 # We also discard part of it, namely the Decoder that turns the ViT embeddings into text for the original ocr model
 
@@ -26,19 +31,89 @@ MODELS_FOLDER = ROOT / 'models'
 
 EXTRACTOR_MODEL_PATH = MODELS_FOLDER / "extractor"
 ENCODER_MODEL_PATH = MODELS_FOLDER / "encoder"
+# Created by `main.py export_encoder`
+ONNX_ENCODER_PATH = MODELS_FOLDER / "encoder.onnx"
+ONNX_INT8_ENCODER_PATH = MODELS_FOLDER / "encoder-int8.onnx"
+
+# V Run the encoder with `torch`, or with ONNX Runtime using the exported model: `onnx` or `onnx-int8`
+ENCODER_ENGINE = os.getenv("KANJI_ENCODER_ENGINE", "torch")
 
 # Calibration
 
 CALIBRATION_IMAGES_FOLDER = ROOT / '.testing' / 'calibrate'
-CALIBRATION_FILE = ROOT / '.testing' / 'calibrate' / 'offset.pt'
+CALIBRATION_FILE = ROOT / '.testing' / 'calibrate' / 'offset.pt'  # Written by older versions, imported as the default profile
+# Named calibration profiles, see `calibration.py`
+CALIBRATION_PROFILES_FILE = ROOT / '.testing' / 'calibrate' / 'profiles.npz'
+DEFAULT_CALIBRATION_PROFILE = "default"
+# The font the user's drawings are compared against
+CALIBRATION_REFERENCE_FONT = "Yomogi-Regular"
 
 MODEL = "kha-white/manga-ocr-base"
 
+# One store (see `embedding_store.py`) per model, since embeddings from different models are not comparable
+EMBEDDING_STORE_FOLDER = GENERATED_EMBEDDINGS_FOLDER / MODEL.replace("/", "--")
+
 MODEL_EMBEDDING_SIZE = 768
 MODEL_IMAGE_SIZE = 224
 # Some sizes to try depending on the model: 96, 120, 184, 280
 FONT_SIZE = 184
+# Line width (in pixels of the `MODEL_IMAGE_SIZE` image) of the stroke queries that do not set one, see `strokes.py`
+STROKE_WIDTH = 10
 
 # V can set to `:memory:`, `localhost`, a file, or a cloud URL - see the qdrant docs for more info
 DATABASE_LOCATION = os.getenv("QDRANT_URL", 'localhost')
 DATABASE_API_KEY = os.getenv("QDRANT_API_KEY")
+# V Talk to Qdrant over gRPC (on `DATABASE_GRPC_PORT`) instead of REST, cheaper for large batches of queries
+DATABASE_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "0") == "1"
+DATABASE_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+# Number of connections the async client of `main.py serve` keeps open to Qdrant, at most as many searches at once
+DATABASE_POOL_SIZE = int(os.getenv("KANJI_DATABASE_POOL_SIZE", "16"))
+
+# V Either `qdrant` (uses the database configured above) or `numpy` (loads every embedding in memory, exact search, no server)
+SEARCH_BACKEND = os.getenv("KANJI_SEARCH_BACKEND", "qdrant")
+
+# V Optionally search (and store, in Qdrant / the parquet export) compact codes instead of float32: `float16`, `int8` or `binary`
+EMBEDDING_QUANTIZATION = os.getenv("KANJI_EMBEDDING_QUANTIZATION") or None
+# How many candidates (relative to the search limit) to rescore with the full precision vectors after a quantized search
+QUANTIZATION_RESCORE_OVERSAMPLING = 4.0
+
+# V Optionally pick the search candidates with PCA-reduced vectors of this many dimensions first (see `reduction.py`), e.g. 64 or 128
+REDUCED_DIMENSIONS = int(os.getenv("KANJI_REDUCED_DIMENSIONS") or 0) or None
+# V Whether the projection also rescales each component to unit variance
+REDUCTION_WHITEN = os.getenv("KANJI_REDUCTION_WHITEN", "0") == "1"
+REDUCTION_FOLDER = GENERATED / 'reduction'
+# How many candidates (relative to the search limit) from the reduced first pass to rerank with the full vectors
+REDUCTION_RERANK_OVERSAMPLING = 8.0
+
+# V Optionally search one vector per kanji first (see `prototypes.py`): 1 for the mean over its fonts, more for that many k-means centroids
+PROTOTYPE_CENTROIDS = int(os.getenv("KANJI_PROTOTYPE_CENTROIDS") or 0) or None
+# How many kanji (relative to the search limit) from the prototype first pass to rerank with the embeddings of each of their fonts
+PROTOTYPE_CANDIDATE_OVERSAMPLING = 4.0
+
+# Address for `main.py serve`
+SERVER_HOST = os.getenv("KANJI_SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("KANJI_SERVER_PORT", "8000"))
+# Largest `limit` a search request may ask for
+SERVER_MAX_LIMIT = 500
+# Seconds a client gets to send its whole request, so that slow clients cannot hold a connection (and the shutdown) forever
+SERVER_READ_TIMEOUT = 30
+
+# `BatchingEncoder`: run the encoder once `BATCHING_MAX_SIZE` images are queued, or `BATCHING_MAX_WAIT` seconds after the first one
+BATCHING_MAX_SIZE = 32
+BATCHING_MAX_WAIT = 0.01
+
+# `main.py build_index`: maximum number of batches waiting between two stages of the pipeline
+BUILD_INDEX_QUEUE_SIZE = 2
+
+# Search cache (see `query_cache.py`): entries per tier and time to live in seconds
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 24 * 60 * 60
+# V Optionally also keep the cache in an sqlite file, so that it survives restarts (and is shared between `main.py search` runs)
+QUERY_CACHE_FILE = pathlib.Path(os.environ["KANJI_QUERY_CACHE_FILE"]) if os.getenv("KANJI_QUERY_CACHE_FILE") else None
+
+# V Comma separated list of where to send the timings of each stage (see `metrics.py`): `log`, `json` and / or `prometheus`
+METRICS = [name.strip() for name in os.getenv("KANJI_METRICS", "").split(",") if name.strip()]
+METRICS_TRACE_FILE = GENERATED / 'metrics' / 'trace.json'
+METRICS_PROMETHEUS_FILE = GENERATED / 'metrics' / 'metrics.prom'
+# V Optionally run the commands under the torch profiler, writing its traces in this folder
+TORCH_PROFILE_FOLDER = pathlib.Path(os.environ["KANJI_TORCH_PROFILE"]) if os.getenv("KANJI_TORCH_PROFILE") else None
@@ -1,67 +1,434 @@
+import time
+import typing
 import uuid
+import functools
 import dataclasses
 import pathlib
-import torch
-from qdrant_client import QdrantClient, models
+import numpy as np
+from qdrant_client import QdrantClient, AsyncQdrantClient, models
+
+if typing.TYPE_CHECKING:
+    import torch  # Only for type hints, importing it takes a while
 
 from config import (
     GENERATED_IMAGES_FOLDER,
     DATABASE_LOCATION,
     DATABASE_API_KEY,
+    DATABASE_PREFER_GRPC,
+    DATABASE_GRPC_PORT,
+    DATABASE_POOL_SIZE,
+    MODEL,
     MODEL_EMBEDDING_SIZE,
+    SEARCH_BACKEND,
+    EMBEDDING_QUANTIZATION,
+    QUANTIZATION_RESCORE_OVERSAMPLING,
+    REDUCED_DIMENSIONS,
+    REDUCTION_RERANK_OVERSAMPLING,
+    PROTOTYPE_CENTROIDS,
+    PROTOTYPE_CANDIDATE_OVERSAMPLING,
 )
+from matrix_index import MatrixIndex, MatrixHit, load_matrix_index
+from search_filter import SearchFilter
+from metrics import stage
 
 def create_connection():
-    print(f"Connecting to Qdrant ({DATABASE_LOCATION})")
-    return QdrantClient(DATABASE_LOCATION, api_key=DATABASE_API_KEY, timeout=60)
+    print(f"Connecting to Qdrant ({DATABASE_LOCATION}{', gRPC' if DATABASE_PREFER_GRPC else ''})")
+    return QdrantClient(DATABASE_LOCATION, api_key=DATABASE_API_KEY, timeout=60, prefer_grpc=DATABASE_PREFER_GRPC, grpc_port=DATABASE_GRPC_PORT)
+
+def create_async_connection() -> AsyncQdrantClient:
+    """For the search service: many searches at once over a pool of `DATABASE_POOL_SIZE` connections, without a thread each"""
+    return AsyncQdrantClient(
+        DATABASE_LOCATION,
+        api_key=DATABASE_API_KEY,
+        timeout=60,
+        prefer_grpc=DATABASE_PREFER_GRPC,
+        grpc_port=DATABASE_GRPC_PORT,
+        pool_size=DATABASE_POOL_SIZE,
+    )
+
+def create_search_backend() -> QdrantClient | MatrixIndex:
+    """Returns either a Qdrant connection or an in-process `MatrixIndex`, depending on `SEARCH_BACKEND`"""
+    if SEARCH_BACKEND == "qdrant":
+        return create_connection()
+    if SEARCH_BACKEND == "numpy":
+        return load_matrix_index()
+    raise Exception(f'Unknown search backend "{SEARCH_BACKEND}", expected "qdrant" or "numpy"')
+
+# Name of the PCA-reduced vector in collections created with `REDUCED_DIMENSIONS` set, next to the unnamed full vector
+REDUCED_VECTOR = "reduced"
+# Collection of the per kanji prototypes (see `prototypes.py`), searched first when `PROTOTYPE_CENTROIDS` is set
+PROTOTYPE_COLLECTION = "kanji_prototypes"
+# Seconds a client keeps the number of fonts of the collection before counting them again (see `_font_count`)
+_FONT_COUNT_TTL = 60
+_font_counts: dict[int, tuple[float, int]] = {}
+# Number of queries sent in each request of a batched search
+SEARCH_BATCH_SIZE = 256
+
+@functools.lru_cache(maxsize=None)
+def _projection():
+    from reduction import load_projection
+    return load_projection()
+
+def _quantization_config():
+    # Qdrant keeps the original vectors on disk next to the quantized ones and can rescore with them
+    if EMBEDDING_QUANTIZATION == "int8":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True),
+        )
+    if EMBEDDING_QUANTIZATION == "binary":
+        return models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=True),
+        )
+    return None
+
+def create_payload_indexes(qdrant: QdrantClient):
+    """Index the payload fields used by `SearchFilter` and the grouped search.
+    Created before inserting anything, the HNSW graph then gets extra links per font and per `is_standard` value,
+    so that filtered searches do not need to scan every matching point. Skips the fields that already have one"""
+    existing = qdrant.get_collection("kanji").payload_schema
+    for field, schema in [
+        ("kanji", models.PayloadSchemaType.KEYWORD),
+        ("font", models.PayloadSchemaType.KEYWORD),
+        ("is_standard", models.PayloadSchemaType.BOOL),
+    ]:
+        if field in existing:
+            continue
+        qdrant.create_payload_index(collection_name="kanji", field_name=field, field_schema=schema, wait=True)
 
 def create_collection(qdrant: QdrantClient):
-    return qdrant.create_collection(
+    vectors_config = models.VectorParams(
+        size=MODEL_EMBEDDING_SIZE,
+        distance=models.Distance.COSINE,
+        # float16 replaces the stored vectors themselves, there is nothing to rescore with
+        datatype=models.Datatype.FLOAT16 if EMBEDDING_QUANTIZATION == "float16" else None,
+        on_disk=True if EMBEDDING_QUANTIZATION in ("int8", "binary") else None,
+    )
+    if REDUCED_DIMENSIONS is not None:
+        # The full vectors are only read to rerank the candidates found with the reduced ones
+        vectors_config = {
+            "": vectors_config,
+            REDUCED_VECTOR: models.VectorParams(size=REDUCED_DIMENSIONS, distance=models.Distance.COSINE),
+        }
+    created = qdrant.create_collection(
         collection_name="kanji",
-        vectors_config=models.VectorParams(
-            size=MODEL_EMBEDDING_SIZE,
-            distance=models.Distance.COSINE,
-        ),
+        vectors_config=vectors_config,
+        quantization_config=_quantization_config(),
         optimizers_config=models.OptimizersConfigDiff(
             indexing_threshold=0,
         ),
     )
+    create_payload_indexes(qdrant)
+    return created
 
 def index_collection(qdrant: QdrantClient):
+    create_payload_indexes(qdrant)  # For collections created before they were added
     qdrant.update_collection(
         collection_name="kanji",
         optimizer_config=models.OptimizersConfigDiff(indexing_threshold=20000),
     )
 
 
-def insert(qdrant: QdrantClient, font_name: str, kanji_dict: dict[str, torch.Tensor], standard_set: set[str]):
-    return qdrant.upload_points(
+def upload_prototypes(qdrant: QdrantClient, kanji_list: list[str], prototypes: np.ndarray, standard_set: set[str]):
+    """Replace `PROTOTYPE_COLLECTION` with the `(kanji, centroids, MODEL_EMBEDDING_SIZE)` prototypes of each kanji of `kanji_list`"""
+    if qdrant.collection_exists(PROTOTYPE_COLLECTION):
+        # Rebuilt from scratch, the previous one may have had another number of centroids
+        qdrant.delete_collection(PROTOTYPE_COLLECTION)
+    qdrant.create_collection(
+        collection_name=PROTOTYPE_COLLECTION,
+        vectors_config=models.VectorParams(size=MODEL_EMBEDDING_SIZE, distance=models.Distance.COSINE),
+    )
+    qdrant.create_payload_index(collection_name=PROTOTYPE_COLLECTION, field_name="is_standard", field_schema=models.PayloadSchemaType.BOOL, wait=True)
+    with stage("database.insert_prototypes", len(kanji_list)):
+        qdrant.upload_points(
+            collection_name=PROTOTYPE_COLLECTION,
+            points=[
+                models.PointStruct(
+                    id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{MODEL}/prototype/{kanji}/{centroid}")),
+                    vector=vector.tolist(),
+                    payload={"kanji": kanji, "is_standard": kanji in standard_set, "centroid": centroid},
+                )
+                for kanji, kanji_prototypes in zip(kanji_list, prototypes)
+                for centroid, vector in enumerate(kanji_prototypes)
+            ],
+            batch_size=256,
+        )
+
+
+def default_point_id(font_name: str, kanji: str) -> str:
+    # Deterministic, so that uploading the same (font, kanji) again overwrites the point instead of duplicating it
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{MODEL}/{font_name}/{kanji}"))
+
+
+def insert(
+    qdrant: QdrantClient | MatrixIndex,
+    font_name: str,
+    kanji_dict: dict[str, "torch.Tensor"],
+    standard_set: set[str],
+    ids: list[str] | None = None,
+):
+    with stage("database.insert", len(kanji_dict)):
+        if isinstance(qdrant, MatrixIndex):
+            return qdrant.insert(font_name, kanji_dict, standard_set)
+        if ids is None:
+            ids = [default_point_id(font_name, kanji) for kanji in kanji_dict]
+        return qdrant.upload_points(
+            collection_name="kanji",
+            points=[
+                models.PointStruct(
+                    id=point_id,
+                    vector=vector,
+                    payload={
+                        "kanji": kanji,
+                        "is_standard": kanji in standard_set,
+                        "font": font_name,
+                    },
+                )
+                for point_id, kanji, vector in zip(ids, kanji_dict, _point_vectors(list(kanji_dict.values())))
+            ],
+            batch_size=256,
+        )
+
+
+def _point_vectors(embeddings: list["torch.Tensor"]) -> list:
+    """The vectors to store for each point: the embedding itself, or with `REDUCED_DIMENSIONS` also its projection"""
+    projection = _projection()
+    if projection is None:
+        return embeddings
+    full = np.stack([np.asarray(embedding, dtype=np.float32) for embedding in embeddings])
+    return [{"": vector.tolist(), REDUCED_VECTOR: reduced.tolist()} for vector, reduced in zip(full, projection.project(full))]
+
+
+def delete_font(qdrant: QdrantClient, font_name: str):
+    """Remove every point of the given font"""
+    return qdrant.delete(
         collection_name="kanji",
-        points=[
-            models.PointStruct(
-                id=str(uuid.uuid4()),
-                vector=embedding,
-                payload={
-                    "kanji": kanji,
-                    "is_standard": kanji in standard_set,
-                    "font": font_name,
-                },
-            )
-            for kanji, embedding in kanji_dict.items()
-        ],
-        batch_size=256,
+        points_selector=models.FilterSelector(
+            filter=models.Filter(
+                must=[models.FieldCondition(key="font", match=models.MatchValue(value=font_name))],
+            ),
+        ),
     )
 
 
-def search_vector(qdrant: QdrantClient, query_vector: torch.Tensor, limit: int=10):
-    hits = qdrant.search(
+def get_vector(qdrant: QdrantClient | MatrixIndex, font_name: str, kanji: str) -> np.ndarray | None:
+    """The stored vector of the (font, kanji), normalized since the collection uses the cosine distance. None if there is none"""
+    if isinstance(qdrant, MatrixIndex):
+        for row, payload in enumerate(qdrant.payloads):
+            if payload["font"] == font_name and payload["kanji"] == kanji:
+                return qdrant.matrix[row].copy()
+        return None
+    points, _ = qdrant.scroll(
         collection_name="kanji",
-        # query_vector=query_vector,
-        query_vector=query_vector.numpy(),
-        limit=limit,
-        with_payload=True,
+        scroll_filter=models.Filter(
+            must=[
+                models.FieldCondition(key="font", match=models.MatchValue(value=font_name)),
+                models.FieldCondition(key="kanji", match=models.MatchValue(value=kanji)),
+            ],
+        ),
+        limit=1,
+        with_vectors=True,
     )
-    return hits
+    if not points:
+        return None
+    vector = points[0].vector
+    return np.asarray(vector[""] if isinstance(vector, dict) else vector, dtype=np.float32)
+
+
+def collection_fingerprint(qdrant: QdrantClient | MatrixIndex) -> str:
+    """Changes whenever points are added to, removed from or overwritten in the collection (used to invalidate cached results).
+    Re-uploading a font keeps the same point ids and count, so it also includes what the manifest recorded as uploaded"""
+    if isinstance(qdrant, MatrixIndex):
+        dimensions = qdrant.projection.dimensions if qdrant.projection is not None else None
+        return f"numpy/{len(qdrant)}/{qdrant.revision}/{qdrant.quantization}/{dimensions}/{qdrant.prototype_centroids}"
+    from manifest import Manifest, point_stage
+
+    info = qdrant.get_collection("kanji")
+    uploaded = Manifest().digest(point_stage(DATABASE_LOCATION, "kanji"))
+    fingerprint = f"qdrant/{DATABASE_LOCATION}/{info.points_count}/{uploaded}/{EMBEDDING_QUANTIZATION}/{REDUCED_DIMENSIONS}"
+    if PROTOTYPE_CENTROIDS is not None:
+        fingerprint += f"/prototypes/{qdrant.get_collection(PROTOTYPE_COLLECTION).points_count}"
+    return fingerprint
+
+def _search_params():
+    if EMBEDDING_QUANTIZATION not in ("int8", "binary"):
+        return None
+    return models.SearchParams(
+        quantization=models.QuantizationSearchParams(
+            rescore=True,
+            oversampling=QUANTIZATION_RESCORE_OVERSAMPLING,
+        ),
+    )
+
+def _qdrant_filter(search_filter: SearchFilter | None, kanji: list[str] | None = None) -> models.Filter | None:
+    """`kanji` restricts the search to the candidates of the prototype first pass"""
+    if search_filter is None and kanji is None:
+        return None
+    search_filter = search_filter or SearchFilter()
+    must, must_not = [], []
+    if kanji is not None:
+        must.append(models.FieldCondition(key="kanji", match=models.MatchAny(any=kanji)))
+    if search_filter.standard_only:
+        must.append(models.FieldCondition(key="is_standard", match=models.MatchValue(value=True)))
+    if search_filter.fonts is not None:
+        must.append(models.FieldCondition(key="font", match=models.MatchAny(any=list(search_filter.fonts))))
+    if search_filter.exclude_fonts:
+        must_not.append(models.FieldCondition(key="font", match=models.MatchAny(any=list(search_filter.exclude_fonts))))
+    return models.Filter(must=must or None, must_not=must_not or None)
+
+def _query_request(query_vector: "torch.Tensor | np.ndarray", limit: int, search_filter: SearchFilter | None, kanji: list[str] | None = None) -> models.QueryRequest:
+    query = np.asarray(query_vector, dtype=np.float32)
+    query_filter = _qdrant_filter(search_filter, kanji)
+    prefetch, params = None, _search_params()
+    if _projection() is not None:
+        # Candidates from the reduced vectors, then Qdrant reranks them with the full vectors
+        prefetch = models.Prefetch(
+            query=_projection().project(query[None])[0].tolist(),
+            using=REDUCED_VECTOR,
+            limit=int(limit * REDUCTION_RERANK_OVERSAMPLING),
+            filter=query_filter,
+            params=params,
+        )
+        params = None
+    return models.QueryRequest(query=query.tolist(), prefetch=prefetch, filter=query_filter, params=params, limit=limit, with_payload=True)
+
+def _best_per_kanji(points: list, limit: int) -> list:
+    best = {}
+    for point in points:
+        best.setdefault(point.payload["kanji"], point)
+        if len(best) == limit:
+            break
+    return list(best.values())
+
+# The Qdrant calls are described as `(method name, arguments, function parsing the response)`,
+# so that the synchronous and the asynchronous clients share everything but the call itself
+
+def _prototype_call(query_vectors: "torch.Tensor | np.ndarray", limit: int, search_filter: SearchFilter | None):
+    """First pass over `PROTOTYPE_COLLECTION`, parses into the best `limit * PROTOTYPE_CANDIDATE_OVERSAMPLING` distinct kanji of each query.
+    Only `standard_only` applies to the prototypes, the fonts get filtered when reranking"""
+    candidates = max(limit, int(limit * PROTOTYPE_CANDIDATE_OVERSAMPLING))
+    query_filter = None
+    if search_filter is not None and search_filter.standard_only:
+        query_filter = models.Filter(must=[models.FieldCondition(key="is_standard", match=models.MatchValue(value=True))])
+    requests = [
+        models.QueryRequest(query=np.asarray(query_vector, dtype=np.float32).tolist(), filter=query_filter, limit=candidates * PROTOTYPE_CENTROIDS, with_payload=["kanji"])
+        for query_vector in query_vectors
+    ]
+    parse = lambda responses: [[point.payload["kanji"] for point in _best_per_kanji(response.points, candidates)] for response in responses]
+    return "query_batch_points", dict(requests=requests), parse
+
+# A grouped search that has to fetch points before grouping them needs the number of fonts (the most points a kanji can have):
+# the best `limit` distinct kanji are always within the best `limit * fonts` points
+
+def _font_count_call():
+    return "facet", dict(key="font", limit=100_000, exact=True), lambda response: max(len(response.hits), 1)
+
+def _cached_font_count(qdrant) -> int | None:
+    cached = _font_counts.get(id(qdrant))
+    if cached is not None and time.monotonic() - cached[0] < _FONT_COUNT_TTL:
+        return cached[1]
+    return None
+
+def _font_count(qdrant: QdrantClient) -> int:
+    """Number of distinct fonts in the collection, from a facet over the indexed `font` field, recounted every `_FONT_COUNT_TTL` seconds"""
+    count = _cached_font_count(qdrant)
+    if count is None:
+        method, arguments, parse = _font_count_call()
+        count = parse(getattr(qdrant, method)(collection_name="kanji", **arguments))
+        _font_counts[id(qdrant)] = (time.monotonic(), count)
+    return count
+
+async def _font_count_async(qdrant: AsyncQdrantClient) -> int:
+    count = _cached_font_count(qdrant)
+    if count is None:
+        method, arguments, parse = _font_count_call()
+        count = parse(await getattr(qdrant, method)(collection_name="kanji", **arguments))
+        _font_counts[id(qdrant)] = (time.monotonic(), count)
+    return count
+
+def _search_call(query_vector: "torch.Tensor | np.ndarray", limit: int, search_filter: SearchFilter | None, group_by_kanji: bool, kanji: list[str] | None = None, fonts: int = 1):
+    if group_by_kanji:
+        # Grouped by Qdrant itself, instead of fetching every font of each kanji and removing the duplicates here.
+        # With a projection, the prefetched candidates still have to contain `limit` distinct kanji
+        request = _query_request(query_vector, limit * fonts if _projection() is not None else limit, search_filter, kanji)
+        arguments = dict(
+            query=request.query, prefetch=request.prefetch, query_filter=request.filter, search_params=request.params,
+            group_by="kanji", group_size=1, limit=limit, with_payload=True,
+        )
+        return "query_points_groups", arguments, lambda response: [group.hits[0] for group in response.groups]
+    request = _query_request(query_vector, limit, search_filter, kanji)
+    # `query_points` replaces `search`, which recent versions of qdrant-client removed
+    arguments = dict(
+        query=request.query, prefetch=request.prefetch, query_filter=request.filter, search_params=request.params,
+        limit=limit, with_payload=True,
+    )
+    return "query_points", arguments, lambda response: response.points
+
+def _search_batch_call(query_vectors: "torch.Tensor | np.ndarray", limit: int, search_filter: SearchFilter | None, group_by_kanji: bool, kanji: list[list[str]] | None = None, fonts: int = 1):
+    # Qdrant has no batched version of the grouped search, so those fetch enough points to group them here
+    fetch = limit * fonts if group_by_kanji else limit
+    kanji = kanji or [None] * len(query_vectors)
+    requests = [_query_request(query_vector, fetch, search_filter, candidates) for query_vector, candidates in zip(query_vectors, kanji)]
+    if group_by_kanji:
+        return "query_batch_points", dict(requests=requests), lambda responses: [_best_per_kanji(response.points, limit) for response in responses]
+    return "query_batch_points", dict(requests=requests), lambda responses: [response.points for response in responses]
+
+def search_vector(
+    qdrant: QdrantClient | MatrixIndex,
+    query_vector: "torch.Tensor | np.ndarray",
+    limit: int=10,
+    search_filter: SearchFilter | None = None,
+    group_by_kanji: bool = False,
+):
+    """Returns the best `limit` points, or with `group_by_kanji` the best point of each of the best `limit` distinct kanji"""
+    with stage("database.search"):
+        if isinstance(qdrant, MatrixIndex):
+            return qdrant.search_vector(query_vector, limit, search_filter, "kanji" if group_by_kanji else None)
+        kanji = None
+        if PROTOTYPE_CENTROIDS is not None:
+            method, arguments, parse = _prototype_call([query_vector], limit, search_filter)
+            kanji = parse(getattr(qdrant, method)(collection_name=PROTOTYPE_COLLECTION, **arguments))[0]
+        fonts = _font_count(qdrant) if group_by_kanji and _projection() is not None else 1
+        method, arguments, parse = _search_call(query_vector, limit, search_filter, group_by_kanji, kanji, fonts)
+        return parse(getattr(qdrant, method)(collection_name="kanji", **arguments))
+
+def search_batch(
+    qdrant: QdrantClient | MatrixIndex,
+    query_vectors: "torch.Tensor | np.ndarray",
+    limit: int=10,
+    search_filter: SearchFilter | None = None,
+    group_by_kanji: bool = False,
+) -> list[list]:
+    """Same as `search_vector` for each of the query vectors, in one request per `SEARCH_BATCH_SIZE` queries"""
+    with stage("database.search_batch", len(query_vectors)):
+        if isinstance(qdrant, MatrixIndex):
+            return qdrant.search_batch(query_vectors, limit, search_filter, "kanji" if group_by_kanji else None)
+        results = []
+        fonts = _font_count(qdrant) if group_by_kanji else 1
+        for start in range(0, len(query_vectors), SEARCH_BATCH_SIZE):
+            batch, kanji = query_vectors[start : start + SEARCH_BATCH_SIZE], None
+            if PROTOTYPE_CENTROIDS is not None:
+                method, arguments, parse = _prototype_call(batch, limit, search_filter)
+                kanji = parse(getattr(qdrant, method)(collection_name=PROTOTYPE_COLLECTION, **arguments))
+            method, arguments, parse = _search_batch_call(batch, limit, search_filter, group_by_kanji, kanji, fonts)
+            results += parse(getattr(qdrant, method)(collection_name="kanji", **arguments))
+        return results
+
+async def search_vector_async(
+    qdrant: AsyncQdrantClient,
+    query_vector: "torch.Tensor | np.ndarray",
+    limit: int=10,
+    search_filter: SearchFilter | None = None,
+    group_by_kanji: bool = False,
+):
+    """`search_vector` through the async client"""
+    with stage("database.search"):
+        kanji = None
+        if PROTOTYPE_CENTROIDS is not None:
+            method, arguments, parse = _prototype_call([query_vector], limit, search_filter)
+            kanji = parse(await getattr(qdrant, method)(collection_name=PROTOTYPE_COLLECTION, **arguments))[0]
+        fonts = await _font_count_async(qdrant) if group_by_kanji and _projection() is not None else 1
+        method, arguments, parse = _search_call(query_vector, limit, search_filter, group_by_kanji, kanji, fonts)
+        return parse(await getattr(qdrant, method)(collection_name="kanji", **arguments))
 
 @dataclasses.dataclass
 class SearchResult:
@@ -70,16 +437,17 @@ class SearchResult:
     image_path: pathlib.Path
     score: float
 
-def format_search_results(hits: list[models.ScoredPoint]) -> list[SearchResult]:
+def format_search_results(hits: list[models.ScoredPoint] | list[MatrixHit]) -> list[SearchResult]:
     formatted = []
-    for point in hits:
-        kanji, font = point.payload["kanji"], point.payload["font"]
-        formatted.append(SearchResult(
-            kanji = kanji,
-            font = font,
-            image_path = GENERATED_IMAGES_FOLDER / font / f"{kanji}.png",
-            score = point.score,
-        ))
+    with stage("database.format_results", len(hits)):
+        for point in hits:
+            kanji, font = point.payload["kanji"], point.payload["font"]
+            formatted.append(SearchResult(
+                kanji = kanji,
+                font = font,
+                image_path = GENERATED_IMAGES_FOLDER / font / f"{kanji}.png",
+                score = point.score,
+            ))
     # assert sorted(formatted, key=lambda result: result.score, reverse=True) == formatted
     return formatted
 
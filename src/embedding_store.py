@@ -0,0 +1,182 @@
+"""A single contiguous file of embeddings per model, replacing the per-batch `batch_{i}.pt` / `batch_{i}.txt` files
+
+Layout (under `EMBEDDING_STORE_FOLDER`):
+- `vectors.f32`: Raw float32 `(count, dimensions)` row-major matrix, memory-mapped when read
+- `index.json`: Number of dimensions, list of fonts and the (font, kanji) of each row
+
+Readers only pay for the pages of the matrix they actually touch,
+and rows can be looked up by (font, kanji) in O(1) through an in-memory dictionary.
+`add` only writes the vectors, the index gets rewritten by `flush` (e.g. once per font), so that a build does not rewrite it for every batch.
+Rows added after the last `flush` are dropped from the vectors file the next time the store is opened and written to.
+"""
+import json
+import typing
+import pathlib
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    import torch  # Only for type hints, importing it takes a while
+
+from config import (
+    EMBEDDING_STORE_FOLDER,
+    MODEL_EMBEDDING_SIZE,
+)
+
+# Rows copied at once when compacting the file
+_CHUNK_SIZE = 16384
+
+
+class EmbeddingStore:
+    def __init__(self, folder: pathlib.Path = EMBEDDING_STORE_FOLDER, dimensions: int = MODEL_EMBEDDING_SIZE):
+        self.folder = folder
+        self.vectors_file = folder / "vectors.f32"
+        self.index_file = folder / "index.json"
+        self.dimensions = dimensions
+        self.fonts: list[str] = []
+        self.font_ids: list[int] = []
+        self.kanji: list[str] = []
+        self._rows: dict[tuple[str, str], int] = {}
+        self._vectors: np.memmap | None = None
+        self._unsaved = False
+
+        if self.index_file.is_file():
+            index = json.loads(self.index_file.read_text(encoding="UTF-8"))
+            assert index["dimensions"] == dimensions, f"The embedding store at {folder} has {index['dimensions']} dimensions, expected {dimensions}"
+            self.fonts = index["fonts"]
+            self.font_ids = index["font_ids"]
+            self.kanji = index["kanji"]
+            self._rows = {(self.fonts[f], k): row for row, (f, k) in enumerate(zip(self.font_ids, self.kanji))}
+
+    def __len__(self):
+        return len(self.kanji)
+
+    def __contains__(self, font_and_kanji: tuple[str, str]):
+        return font_and_kanji in self._rows
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """The whole `(N, dimensions)` matrix, memory-mapped read-only (zero-copy)"""
+        if self._vectors is None:
+            if len(self) == 0:
+                return np.empty((0, self.dimensions), dtype=np.float32)
+            self._vectors = np.memmap(self.vectors_file, dtype=np.float32, mode="r", shape=(len(self), self.dimensions))
+        return self._vectors
+
+    @property
+    def revision(self) -> str:
+        """Changes whenever the saved index or the vectors file get written"""
+        files = [file for file in (self.index_file, self.vectors_file) if file.is_file()]
+        return ":".join(f"{file.stat().st_mtime_ns}-{file.stat().st_size}" for file in files)
+
+    def font_of(self, row: int) -> str:
+        return self.fonts[self.font_ids[row]]
+
+    def row(self, font_name: str, kanji: str) -> int:
+        return self._rows[(font_name, kanji)]
+
+    def get(self, font_name: str, kanji: str) -> np.ndarray:
+        return self.vectors[self.row(font_name, kanji)]
+
+    def font_rows(self, font_name: str) -> np.ndarray:
+        """Row numbers of every embedding of the given font, in insertion order"""
+        if font_name not in self.fonts:
+            return np.empty(0, dtype=np.int64)
+        font_id = self.fonts.index(font_name)
+        return np.flatnonzero(np.asarray(self.font_ids) == font_id)
+
+    def iter_fonts(self):
+        """Yields `(font_name, kanji_list, vectors)` for each font, the vectors being a `(n, dimensions)` array"""
+        for font_name in self.fonts:
+            rows = self.font_rows(font_name)
+            if len(rows):
+                # Rows of the same font are usually contiguous, in which case this is a view rather than a copy
+                if rows[-1] - rows[0] + 1 == len(rows):
+                    vectors = self.vectors[rows[0] : rows[-1] + 1]
+                else:
+                    vectors = self.vectors[rows]
+                yield font_name, [self.kanji[row] for row in rows], vectors
+
+    def add(self, font_name: str, labels: list[str], tensor: "torch.Tensor | np.ndarray"):
+        """Store the embeddings of `labels` for the font, overwriting the ones already stored for the same (font, kanji).
+        They are only recorded in the index file by the next `flush`"""
+        vectors = np.ascontiguousarray(np.asarray(tensor, dtype=np.float32))
+        assert vectors.shape == (len(labels), self.dimensions), f"Expected a {(len(labels), self.dimensions)} tensor, got {vectors.shape}"
+        if font_name not in self.fonts:
+            self.fonts.append(font_name)
+        font_id = self.fonts.index(font_name)
+
+        latest = {kanji: i for i, kanji in enumerate(labels)}  # If a kanji is repeated, the last one wins
+        existing = [(i, self._rows[(font_name, kanji)]) for kanji, i in latest.items() if (font_name, kanji) in self._rows]
+        new = [i for kanji, i in latest.items() if (font_name, kanji) not in self._rows]
+        self._vectors = None
+        self.folder.mkdir(exist_ok=True, parents=True)
+
+        if existing:
+            writable = np.memmap(self.vectors_file, dtype=np.float32, mode="r+", shape=(len(self), self.dimensions))
+            for i, row in existing:
+                writable[row] = vectors[i]
+            writable.flush()
+            del writable
+
+        if new:
+            with open(self.vectors_file, "ab") as file:
+                # Drop anything written after the last saved index (e.g. by a run that crashed before saving it)
+                file.truncate(len(self) * self.dimensions * 4)
+                file.write(vectors[new].tobytes())
+            for i in new:
+                self._rows[(font_name, labels[i])] = len(self.kanji)
+                self.font_ids.append(font_id)
+                self.kanji.append(labels[i])
+        self._unsaved = True
+
+    def flush(self):
+        """Write the index if anything was added since it was last saved"""
+        if self._unsaved:
+            self.save_index()
+
+    def remove_font(self, font_name: str):
+        """Delete every embedding of the font, compacting the file"""
+        rows = self.font_rows(font_name)
+        if not len(rows):
+            return
+        keep = np.setdiff1d(np.arange(len(self)), rows)
+        temporary = self.vectors_file.with_suffix(".tmp")
+        with open(temporary, "wb") as file:
+            for start in range(0, len(keep), _CHUNK_SIZE):
+                file.write(np.ascontiguousarray(self.vectors[keep[start : start + _CHUNK_SIZE]]).tobytes())
+        self._vectors = None
+        temporary.replace(self.vectors_file)
+
+        self.font_ids = [self.font_ids[row] for row in keep]
+        self.kanji = [self.kanji[row] for row in keep]
+        self._rows = {(self.fonts[f], k): row for row, (f, k) in enumerate(zip(self.font_ids, self.kanji))}
+        self.save_index()
+
+    def save_index(self):
+        index = {
+            "dimensions": self.dimensions,
+            "fonts": self.fonts,
+            "font_ids": self.font_ids,
+            "kanji": self.kanji,
+        }
+        temporary = self.index_file.with_suffix(".tmp")
+        temporary.write_text(json.dumps(index, ensure_ascii=False), encoding="UTF-8")
+        temporary.replace(self.index_file)
+        self._unsaved = False
+
+
+def import_batch_files(store: EmbeddingStore, embeddings_folder: pathlib.Path):
+    """Add the `{font}/batch_{i}.pt` + `{font}/batch_{i}.txt` files of the older layout (e.g. generated by the notebook) to the store"""
+    import torch
+
+    for folder in embeddings_folder.iterdir():
+        if not folder.is_dir() or folder == store.folder:
+            continue
+        tensor_files = list(folder.glob("batch_*.pt"))
+        for file in tensor_files:
+            tensor = torch.load(file, weights_only=True)
+            labels = file.with_suffix(".txt").read_text("UTF-8").splitlines()
+            assert len(tensor) == len(labels)
+            store.add(folder.name, labels, tensor)
+        store.flush()
+        print(f"Imported {len(tensor_files)} batches of embeddings for font {folder.name}")
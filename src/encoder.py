@@ -1,4 +1,5 @@
 from PIL import Image
+import numpy as np
 import torch
 from torch.nn.functional import cosine_similarity
 from transformers import (
@@ -12,16 +13,19 @@ from config import (
     MODEL_EMBEDDING_SIZE,
     EXTRACTOR_MODEL_PATH,
     ENCODER_MODEL_PATH,
+    ENCODER_ENGINE,
 )
+from metrics import stage
 
 # Didn't want to hardcode within this file, and may have to use elsewhere
 assert MODEL == "kha-white/manga-ocr-base", "Other models are not natively supported, \
     you may have to change a lot of things to get it to work"
 assert MODEL_EMBEDDING_SIZE == 768, "The only model embedding size supported is 768"
 
-def load_model() -> tuple[ViTImageProcessor, ViTModel]:
+def load_model(engine: str = ENCODER_ENGINE) -> tuple[ViTImageProcessor, ViTModel]:
     """Load the model based on the config.py file.
     Returns the `feature_extractor` and the `encoder`, in this order.
+    With the `onnx` or `onnx-int8` engines, the `encoder` is an `OnnxEncoder` instead (see `onnx_encoder.py`)
     """
     if EXTRACTOR_MODEL_PATH.is_dir():
         print("Loading local Image Processor")
@@ -31,6 +35,10 @@ def load_model() -> tuple[ViTImageProcessor, ViTModel]:
         feature_extractor: ViTImageProcessor = ViTImageProcessor.from_pretrained(MODEL, requires_grad=False)
         feature_extractor.save_pretrained(EXTRACTOR_MODEL_PATH)
 
+    if engine != "torch":
+        from onnx_encoder import load_onnx_encoder
+        return feature_extractor, load_onnx_encoder(engine)
+
     if ENCODER_MODEL_PATH.is_dir():
         print("Loading local ViT Encoder Model")
         model = ViTModel.from_pretrained(ENCODER_MODEL_PATH)
@@ -49,12 +57,41 @@ def load_model() -> tuple[ViTImageProcessor, ViTModel]:
     return feature_extractor, model
 
 
+def preprocess_greyscale(feature_extractor: ViTImageProcessor, images: list[Image.Image]) -> torch.Tensor:
+    """Same `pixel_values` as `feature_extractor([image.convert("RGB") for image in images])`, for greyscale (mode `L`) images.
+
+    Stacks the images into a single uint8 array and rescales, normalizes and replicates the channel
+    for the whole batch at once, instead of converting and processing each image separately.
+    Only the images that are not already at the model's size go through PIL to be resized.
+    """
+    size = (feature_extractor.size["width"], feature_extractor.size["height"])
+    arrays = []
+    for image in images:
+        if feature_extractor.do_resize and image.size != size:
+            image = image.resize(size, feature_extractor.resample)
+        arrays.append(np.asarray(image))
+    pixels = torch.from_numpy(np.stack(arrays)).to(torch.float32)[:, None]  # (N, 1, H, W)
+
+    if feature_extractor.do_rescale:
+        pixels = pixels * feature_extractor.rescale_factor
+    if feature_extractor.do_normalize:
+        mean = torch.tensor(feature_extractor.image_mean, dtype=torch.float32)[None, :, None, None]
+        std = torch.tensor(feature_extractor.image_std, dtype=torch.float32)[None, :, None, None]
+        return (pixels - mean) / std  # Broadcasting replicates the single channel into the 3 RGB channels
+    return pixels.expand(-1, 3, -1, -1).contiguous()
+
+
 def get_embeddings(feature_extractor: ViTImageProcessor, encoder: ViTModel, images: list[Image.Image]) -> torch.Tensor:
     """Processes the images and returns their Embeddings"""
-    images_rgb = [image.convert("RGB") for image in images]
     with torch.inference_mode():
-        pixel_values: torch.Tensor = feature_extractor(images_rgb, return_tensors="pt")["pixel_values"]
-        return encoder(pixel_values.to(encoder.device))["pooler_output"].cpu()
+        with stage("encoder.preprocess", len(images)):
+            if all(image.mode == "L" for image in images):
+                pixel_values = preprocess_greyscale(feature_extractor, images)
+            else:
+                images_rgb = [image.convert("RGB") for image in images]
+                pixel_values: torch.Tensor = feature_extractor(images_rgb, return_tensors="pt")["pixel_values"]
+        with stage("encoder.forward", len(images)):
+            return encoder(pixel_values.to(encoder.device))["pooler_output"].cpu()
 
 
 def compare_vectors(vec_a: torch.Tensor, vec_b: torch.Tensor):
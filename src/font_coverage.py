@@ -0,0 +1,146 @@
+"""Which characters each font file has a glyph for, read from its `cmap` table instead of rendering them
+
+Drawing a character missing from the font either gives an empty image (caught by `check_has_text` after rendering it),
+or with some fonts the visible .notdef "tofu" box, which would then get embedded as if it was the kanji.
+The cmap is only parsed once per font file: the supported code points get cached under `FONT_COVERAGE_FOLDER` (`{hash of the font file}.json`),
+so that replacing or editing the font rebuilds it, and the fonts folder can be read-only.
+"""
+import json
+import struct
+import pathlib
+import functools
+import numpy as np
+
+from config import FONT_COVERAGE_FOLDER
+from manifest import file_hash
+
+# Increase whenever the cached format or the way it is built changes
+COVERAGE_VERSION = 1
+
+# (platform, encoding) of the Unicode cmap subtables, the full repertoire ones (format 12) are preferred over the BMP only ones (format 4)
+_FULL_UNICODE = {(0, 4), (0, 6), (3, 10)}
+_BMP_UNICODE = {(0, 0), (0, 1), (0, 2), (0, 3), (3, 1)}
+
+
+def _table_offsets(data: bytes) -> dict[bytes, int]:
+    offset = 0
+    if data[:4] == b"ttcf":  # Font collection, only the first font is used
+        offset = struct.unpack_from(">I", data, 12)[0]
+    (tables_count,) = struct.unpack_from(">H", data, offset + 4)
+    tables = {}
+    for i in range(tables_count):
+        tag, _, table_offset, _ = struct.unpack_from(">4sIII", data, offset + 12 + 16 * i)
+        tables[tag] = table_offset
+    return tables
+
+
+def _format_12(data: bytes, offset: int) -> np.ndarray:
+    (groups_count,) = struct.unpack_from(">I", data, offset + 12)
+    groups = np.frombuffer(data, dtype=">u4", count=3 * groups_count, offset=offset + 16).reshape(-1, 3).astype(np.int64)
+    code_points = []
+    for start, end, glyph in groups:
+        if glyph == 0:  # Only the first code point of the group maps to .notdef
+            start += 1
+        code_points.append(np.arange(start, end + 1))
+    return np.concatenate(code_points) if code_points else np.empty(0, dtype=np.int64)
+
+
+def _format_4(data: bytes, offset: int) -> np.ndarray:
+    (segments_count,) = struct.unpack_from(">H", data, offset + 6)
+    segments_count //= 2
+
+    def array(index: int) -> np.ndarray:
+        # endCode, (reservedPad), startCode, idDelta and idRangeOffset follow each other after the 14 bytes header
+        start = offset + 14 + 2 * segments_count * index + (2 if index > 0 else 0)
+        return np.frombuffer(data, dtype=">u2", count=segments_count, offset=start).astype(np.int64)
+
+    ends, starts, deltas, range_offsets = array(0), array(1), array(2), array(3)
+    range_offsets_start = offset + 16 + 6 * segments_count
+    code_points = []
+    for i, (start, end, delta, range_offset) in enumerate(zip(starts, ends, deltas, range_offsets)):
+        if start == 0xFFFF:
+            continue
+        characters = np.arange(start, end + 1)
+        if range_offset == 0:
+            glyphs = (characters + delta) & 0xFFFF
+        else:
+            # idRangeOffset is relative to its own position in the file
+            glyph_offset = range_offsets_start + 2 * i + range_offset
+            glyphs = np.frombuffer(data, dtype=">u2", count=len(characters), offset=glyph_offset).astype(np.int64)
+            glyphs = np.where(glyphs != 0, (glyphs + delta) & 0xFFFF, 0)
+        code_points.append(characters[glyphs != 0])
+    return np.concatenate(code_points) if code_points else np.empty(0, dtype=np.int64)
+
+
+def read_cmap(font_file: pathlib.Path) -> np.ndarray:
+    """Sorted code points that the font maps to an actual glyph (anything but .notdef)"""
+    data = font_file.read_bytes()
+    cmap = _table_offsets(data).get(b"cmap")
+    if cmap is None:
+        raise Exception(f"The font {font_file} does not have a cmap table")
+    (subtables_count,) = struct.unpack_from(">H", data, cmap + 2)
+    best = None
+    for i in range(subtables_count):
+        platform, encoding, subtable = struct.unpack_from(">HHI", data, cmap + 4 + 8 * i)
+        (table_format,) = struct.unpack_from(">H", data, cmap + subtable)
+        if table_format == 12 and (platform, encoding) in _FULL_UNICODE:
+            best = (12, cmap + subtable)
+            break
+        if table_format == 4 and (platform, encoding) in _BMP_UNICODE and best is None:
+            best = (4, cmap + subtable)
+    if best is None:
+        raise Exception(f"The font {font_file} does not have a Unicode cmap (format 4 or 12)")
+    table_format, offset = best
+    code_points = _format_12(data, offset) if table_format == 12 else _format_4(data, offset)
+    return np.unique(code_points)
+
+
+def coverage_file(font_hash: str) -> pathlib.Path:
+    return FONT_COVERAGE_FOLDER / f"{font_hash}.json"
+
+
+@functools.lru_cache(maxsize=None)
+def load_coverage(font_file: pathlib.Path) -> np.ndarray:
+    """The code points supported by the font, from the cache if it has them for this version of the file, otherwise from its cmap"""
+    font_file = pathlib.Path(font_file)
+    font_hash = file_hash(font_file)
+    cache = coverage_file(font_hash)
+    if cache.is_file():
+        cached = json.loads(cache.read_text(encoding="UTF-8"))
+        if cached.get("version") == COVERAGE_VERSION:
+            return np.concatenate([np.arange(start, end + 1) for start, end in cached["ranges"]] or [np.empty(0, dtype=np.int64)])
+
+    code_points = read_cmap(font_file)
+    # Stored as (inclusive) ranges of consecutive code points, CJK fonts mostly cover whole blocks
+    breaks = np.flatnonzero(np.diff(code_points) != 1)
+    starts = np.concatenate([code_points[:1], code_points[breaks + 1]])
+    ends = np.concatenate([code_points[breaks], code_points[-1:]])
+    ranges = [[int(start), int(end)] for start, end in zip(starts, ends)]
+    try:
+        cache.parent.mkdir(exist_ok=True, parents=True)
+        temporary = cache.with_suffix(".tmp")
+        temporary.write_text(json.dumps({"version": COVERAGE_VERSION, "font": font_file.name, "ranges": ranges}), encoding="UTF-8")
+        temporary.replace(cache)
+    except OSError as e:
+        print(f"Could not cache the coverage of the font {font_file.name} ({e}), it will be read from its cmap again next time")
+    return code_points
+
+
+def supported_mask(font_file: pathlib.Path, kanji_list: list[str]) -> np.ndarray:
+    """Whether the font has a glyph for every character of each entry of `kanji_list`"""
+    code_points = load_coverage(pathlib.Path(font_file))
+    if all(len(kanji) == 1 for kanji in kanji_list):
+        return np.isin(np.fromiter(map(ord, kanji_list), dtype=np.int64, count=len(kanji_list)), code_points)
+    supported = set(code_points.tolist())
+    return np.array([all(ord(character) in supported for character in kanji) for kanji in kanji_list], dtype=bool)
+
+
+def split_supported(font_file: pathlib.Path, kanji_list: list[str]) -> tuple[list[str], list[str]]:
+    """Returns the kanji the font supports and the ones it does not, both in the original order"""
+    mask = supported_mask(font_file, kanji_list)
+    return [kanji for kanji, ok in zip(kanji_list, mask) if ok], [kanji for kanji, ok in zip(kanji_list, mask) if not ok]
+
+
+def coverage_matrix(font_files: dict[str, pathlib.Path], kanji_list: list[str]) -> np.ndarray:
+    """`(fonts, kanji)` boolean matrix, in the order of `font_files` and `kanji_list`"""
+    return np.stack([supported_mask(font_file, kanji_list) for font_file in font_files.values()]) if font_files else np.zeros((0, len(kanji_list)), dtype=bool)
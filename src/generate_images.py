@@ -1,3 +1,5 @@
+import functools
+import pathlib
 import numpy as np
 from PIL import Image, ImageFont, ImageDraw
 
@@ -7,6 +9,7 @@ from config import (
     MODEL_IMAGE_SIZE,
     FONT_SIZE,
 )
+from font_coverage import split_supported
 
 def get_standard_kanji_set() -> set[str]:
     file = INPUT_KANJI_FOLDER / "kanji_joyo.txt"
@@ -27,24 +30,45 @@ def draw_kanji(font: ImageFont.FreeTypeFont, kanji: str):
     return image
 
 def check_has_text(image: Image):
-    "Verifies if the image contain anything at all"
+    "Verifies if the image contain anything at all (for glyphs in the font's cmap that are empty anyway)"
     _arr = np.asarray(image)
     if _arr.min() == _arr.max():
         return False
     return True
 
 
+def list_font_files() -> dict[str, pathlib.Path]:
+    """Returns a dictionary of `font_name -> font file path`"""
+    return {font_file.stem: font_file for font_file in INPUT_FONTS_FOLDER.glob("**/*.ttf")}
+
 def list_fonts() -> dict[str, ImageFont.FreeTypeFont]:
     """Returns a dictionary of `font_name -> ImageFont`"""
     return {
-        font_file.stem: ImageFont.truetype(font_file, FONT_SIZE)
-        for font_file in INPUT_FONTS_FOLDER.glob("**/*.ttf")
+        font_name: ImageFont.truetype(font_file, FONT_SIZE)
+        for font_name, font_file in list_font_files().items()
     }
 
+@functools.lru_cache(maxsize=None)
+def _load_font(font_file: pathlib.Path) -> ImageFont.FreeTypeFont:
+    # FreeType fonts cannot be pickled, so each worker process loads (and keeps) its own
+    return ImageFont.truetype(font_file, FONT_SIZE)
+
+def _font_file(font: ImageFont.FreeTypeFont) -> pathlib.Path | None:
+    """The file the font was loaded from, None for fonts loaded from bytes (e.g. `ImageFont.load_default`)"""
+    path = getattr(font, "path", None)
+    if isinstance(path, (str, pathlib.Path)) and pathlib.Path(path).is_file():
+        return pathlib.Path(path)
+    return None
+
 def generate_images_for_font(font: ImageFont.FreeTypeFont, kanji_list: list[str]) -> dict[str, Image.Image]:
     """Returns a dictionary of `kanji -> Image`"""
     out = {}
     _bad = []
+    font_file = _font_file(font)
+    if font_file is not None:
+        # Characters missing from the font's cmap are skipped without drawing them (see `font_coverage.py`),
+        # other fonts only rely on `check_has_text`
+        kanji_list, _bad = split_supported(font_file, kanji_list)
     for kanji in kanji_list:
         image = draw_kanji(font, kanji)
         if check_has_text(image):
@@ -55,6 +79,20 @@ def generate_images_for_font(font: ImageFont.FreeTypeFont, kanji_list: list[str]
         print(f"Font {font.getname()} does not seems to support {_bad}, skipping them for this font")
     return out
 
+def save_images_for_font(font_file: pathlib.Path, kanji_list: list[str], out_folder: pathlib.Path) -> tuple[list[str], list[str]]:
+    """Draws and saves one image per kanji (meant to run in a worker process), `kanji_list` being already filtered with `split_supported`.
+    Returns the list of kanji saved and the list of kanji that drew nothing"""
+    font = _load_font(font_file)
+    saved, bad = [], []
+    for kanji in kanji_list:
+        image = draw_kanji(font, kanji)
+        if check_has_text(image):
+            image.save(out_folder / f"{kanji}.png")
+            saved.append(kanji)
+        else:
+            bad.append(kanji)
+    return saved, bad
+
 if __name__ == "__main__":
     from config import ROOT
     font_name, font = list(list_fonts().items())[0]
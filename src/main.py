@@ -1,43 +1,27 @@
-# TODO Move the imports to the functions that need them to avoid importing unnecessary things?
+# Each command imports what it needs within its function, so that e.g. `--help` or `upload_embeddings`
+# do not have to pay for importing torch and transformers (see `benchmarks/import_time.py`)
 
+import os
 import typing
+import collections
 from pathlib import Path
 
-from tqdm import tqdm
-from PIL import Image
-import torch
-
 from config import (
     GENERATED_IMAGES_FOLDER,
     GENERATED_EMBEDDINGS_FOLDER,
-    MODEL_EMBEDDING_SIZE,
     CALIBRATION_IMAGES_FOLDER,
-    CALIBRATION_FILE,
+    DEFAULT_CALIBRATION_PROFILE,
 )
 
-from generate_images import (
-    get_standard_kanji_set,
-    load_kanji_list,
-    list_fonts,
-    generate_images_for_font,
-)
-from encoder import (
-    load_model,
-    get_embeddings,
-)
-from database import (
-    create_connection,
-    create_collection,
-    index_collection,
-    insert,
-    search_vector,
-    format_search_results,
-)
+if typing.TYPE_CHECKING:
+    from search_filter import SearchFilter
 
 T = typing.TypeVar("T")
 
 GENERATE_IMAGES_BATCH_SIZE = 64
+GENERATE_IMAGES_WORKERS = os.cpu_count() or 1
 GENERATE_EMBEDDINGS_BATCH_SIZE = 256
+GENERATE_EMBEDDINGS_WORKERS = 1
 
 def batched(original: list[T], group_size: int) -> list[list[T]]:
     groups = []
@@ -47,120 +31,425 @@ def batched(original: list[T], group_size: int) -> list[list[T]]:
     return groups
 
 
-def generate_images():
-    fonts = list_fonts()
-    print(f"Using the {len(fonts)} following fonts: {fonts.keys()}")
+def generate_images(workers: int = GENERATE_IMAGES_WORKERS):
+    """Draw every kanji missing from the manifest in every font, sharded by (font, chunk of kanji) over `workers` processes"""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from tqdm import tqdm
+    from generate_images import load_kanji_list, list_font_files, save_images_for_font
+    from font_coverage import split_supported
+    from manifest import Manifest
+
+    manifest = Manifest()
+    font_files = list_font_files()
+    print(f"Using the {len(font_files)} following fonts: {font_files.keys()}")
 
     kanji_list = load_kanji_list()
-    kanji_batches = batched(kanji_list, GENERATE_IMAGES_BATCH_SIZE)
-    print(f"Processing a total of {len(kanji_list)} Kanji in {len(kanji_batches)} batches of {GENERATE_IMAGES_BATCH_SIZE}")
+    print(f"Processing a total of {len(kanji_list)} Kanji in batches of {GENERATE_IMAGES_BATCH_SIZE}, using {workers} processes")
 
-    for font_name in tqdm(fonts):
-        font = fonts[font_name]
+    shards = []
+    for font_name, font_file in font_files.items():
+        key = manifest.register_font(font_name, font_file)
         out_folder = GENERATED_IMAGES_FOLDER / font_name
         out_folder.mkdir(exist_ok=True, parents=True)
-        print(f"Generating images for {font_name}")
-
-        for kanji_batch in tqdm(kanji_batches):
-            images = generate_images_for_font(font, kanji_batch)
-            for kanji, img in images.items():
-                img.save(out_folder / f"{kanji}.png")
-
+        missing = manifest.missing(key, "unsupported", manifest.missing(key, "image", kanji_list))
+        if len(missing) < len(kanji_list):
+            print(f"Skipping {len(kanji_list) - len(missing)} Kanji already drawn for font {font_name}")
+        missing, unsupported_kanji = split_supported(font_file, missing)
+        if unsupported_kanji:
+            # Known from the font's cmap, no need to draw them
+            manifest.mark(key, "unsupported", unsupported_kanji)
+            print(f"Font {font_name} does not have a glyph for {len(unsupported_kanji)} Kanji, skipping them")
+        shards += [(font_name, font_file, kanji_batch, out_folder) for kanji_batch in batched(missing, GENERATE_IMAGES_BATCH_SIZE)]
+    manifest.save()
+
+    unsupported = {font_name: [] for font_name in font_files}
+    with tqdm(total=sum(len(shard[2]) for shard in shards), unit="image") as progress:
+        def _collect(font_name, kanji_batch, result):
+            saved, bad = result
+            key = manifest.fonts[font_name]
+            manifest.mark(key, "image", saved)
+            manifest.mark(key, "unsupported", bad)
+            manifest.save(force=False)
+            unsupported[font_name] += bad
+            progress.update(len(kanji_batch))
+
+        try:
+            if workers <= 1:
+                for font_name, font_file, kanji_batch, out_folder in shards:
+                    _collect(font_name, kanji_batch, save_images_for_font(font_file, kanji_batch, out_folder))
+            else:
+                with ProcessPoolExecutor(workers) as executor:
+                    futures = {
+                        executor.submit(save_images_for_font, font_file, kanji_batch, out_folder): (font_name, kanji_batch)
+                        for font_name, font_file, kanji_batch, out_folder in shards
+                    }
+                    for future in as_completed(futures):
+                        _collect(*futures[future], future.result())
+        finally:
+            manifest.save()
+
+    for font_name, bad in unsupported.items():
+        if bad:
+            print(f"Font {font_name} does not seems to support {len(bad)} characters, skipped them for this font")
+
+
+def font_coverage(output: Path | None):
+    """Prints how many of the kanji each font has a glyph for, from their cmap tables (without drawing anything)"""
+    import csv
+    import numpy as np
+    from generate_images import load_kanji_list, list_font_files, get_standard_kanji_set
+    from font_coverage import coverage_matrix
+
+    font_files = list_font_files()
+    kanji_list = list(dict.fromkeys(load_kanji_list()))
+    standard_set = get_standard_kanji_set()
+    standard = np.array([kanji in standard_set for kanji in kanji_list], dtype=bool)
+    matrix = coverage_matrix(font_files, kanji_list)
+
+    print(f"{'font':<30}{'kanji':>14}{'joyo':>12}")
+    for font_name, row in zip(font_files, matrix):
+        print(f"{font_name:<30}{f'{row.sum()}/{len(row)}':>14}{f'{row[standard].sum()}/{standard.sum()}':>12}")
+    uncovered = [kanji for kanji, covered in zip(kanji_list, matrix.any(axis=0)) if not covered]
+    if uncovered:
+        print(f"{len(uncovered)} Kanji are not supported by any font: {''.join(uncovered[:100])}{'...' if len(uncovered) > 100 else ''}")
+
+    if output is not None:
+        with output.open("w", encoding="UTF-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["kanji", *font_files])
+            writer.writerows([kanji, *map(int, column)] for kanji, column in zip(kanji_list, matrix.T))
+        print(f"Saved the (kanji x font) coverage matrix to {output}")
+
+
+def generate_embeddings(workers: int = GENERATE_EMBEDDINGS_WORKERS, threads: int | None = None):
+    """Generate the embeddings of every image recorded in the manifest that does not has one yet.
+    With more than one worker, the batches get encoded by that many processes with `threads` torch threads each (see `parallel_embeddings.py`)"""
+    from tqdm import tqdm
+    from generate_images import list_font_files
+    from embedding_store import EmbeddingStore
+    from manifest import Manifest
+    from metrics import stage
+
+    manifest = Manifest()
+    fonts = {
+        font_name: manifest.register_font(font_name, font_file)
+        for font_name, font_file in list_font_files().items()
+        if (GENERATED_IMAGES_FOLDER / font_name).is_dir()
+    }
+    print(f"Generating embeddings for the following fonts: {tuple(fonts)}")
+
+    store = EmbeddingStore()
+    shards = []
+    for font_name, key in fonts.items():
+        if not manifest.get(key, "embedding"):
+            # Anything already stored is either from an older version of the font or was not recorded, start over
+            store.remove_font(font_name)
+        missing = manifest.missing(key, "embedding", sorted(manifest.get(key, "image")))
+        print(f"Found {len(missing)} images without embeddings for font {font_name}")
+        shards += [(font_name, kanji_batch) for kanji_batch in batched(missing, GENERATE_EMBEDDINGS_BATCH_SIZE)]
+    if not shards:
+        return
+
+    if workers <= 1:
+        from PIL import Image
+        from encoder import load_model, get_embeddings
+
+        extractor, encoder = load_model()
+
+        def embed_shards():
+            for font_name, _labels in shards:
+                with stage("main.load_images", len(_labels)):
+                    images = [Image.open(GENERATED_IMAGES_FOLDER / font_name / f"{kanji}.png", "r") for kanji in _labels]
+                yield font_name, _labels, get_embeddings(extractor, encoder, images)
+        results = embed_shards()
+    else:
+        from parallel_embeddings import embed_shards
+
+        threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        print(f"Encoding {len(shards)} batches with {workers} processes of {threads} threads each")
+        results = embed_shards(shards, workers, threads)
+
+    # Only recorded in the manifest once the store saved its index, so that the manifest never lists embeddings the store lost
+    pending = []
+
+    def checkpoint():
+        store.flush()
+        for font_name, _labels in pending:
+            manifest.mark(fonts[font_name], "embedding", _labels)
+        pending.clear()
+        manifest.save()
+
+    # The workers return the shards in completion order, mixing the fonts, so each font is only saved once its last shard arrived
+    remaining = collections.Counter(font_name for font_name, _ in shards)
+    try:
+        for font_name, _labels, tensor in tqdm(results, total=len(shards)):
+            with stage("main.store_embeddings", len(_labels)):
+                store.add(font_name, _labels, tensor)
+            pending.append((font_name, _labels))
+            remaining[font_name] -= 1
+            if not remaining[font_name]:
+                checkpoint()  # Once per font, also records the shards of the other fonts that arrived so far
+    finally:
+        checkpoint()
+
+
+def create_calibration_vector(profile: str = DEFAULT_CALIBRATION_PROFILE, image_file: Path | None = None, kanji: str | None = None):
+    """Rebuild the calibration profile from every drawing in the calibration folder (each named after its kanji),
+    or only add a single drawing to it (see `calibration.py`)"""
+    from PIL import Image
+    from encoder import load_model, get_embeddings
+    from embedding_store import EmbeddingStore
+    from calibration import CalibrationProfiles, reference_embedding
 
-def generate_embeddings():
     extractor, encoder = load_model()
-    image_folders = list(GENERATED_IMAGES_FOLDER.iterdir())
-    print(f"Generating embeddings for the following fonts: {tuple(folder.name for folder in image_folders)}")
-
-    for folder in tqdm(image_folders):
-        font_embeddings_folder = GENERATED_EMBEDDINGS_FOLDER / folder.name
-        font_embeddings_folder.mkdir(exist_ok=True, parents=True)
-        image_files = list(folder.glob("*.png"))
-        print(f"Found {len(image_files)} images for font {folder.name}")
+    store = EmbeddingStore()
+    profiles = CalibrationProfiles()
 
-        batches = batched(list(image_files), GENERATE_EMBEDDINGS_BATCH_SIZE)
-        for i, batch in enumerate(tqdm(batches)):
-            _labels = [file.stem for file in batch]
-            images = [Image.open(file, "r") for file in batch]
-            tensor_out_file = font_embeddings_folder / f"batch_{i}.pt"
-            labels_out_file = font_embeddings_folder / f"batch_{i}.txt"
-
-            tensor = get_embeddings(extractor, encoder, images)
+    if image_file is None:
+        samples = [(file, file.stem) for file in CALIBRATION_IMAGES_FOLDER.glob("*.png")]
+        profiles.reset(profile)
+    else:
+        samples = [(image_file, kanji or image_file.stem)]
 
-            labels_out_file.write_text("\n".join(_labels), encoding="UTF-8")
-            torch.save(tensor, tensor_out_file)
+    for batch in batched(samples, GENERATE_EMBEDDINGS_BATCH_SIZE):
+        user_tensor = get_embeddings(extractor, encoder, [Image.open(file, 'r') for file, _ in batch])
+        for (_, label), user_embedding in zip(batch, user_tensor.numpy()):
+            profiles.update(profile, user_embedding - reference_embedding(label, user_embedding, store))
 
+    profiles.save()
+    print(f"The calibration profile {profile} is now the mean of {profiles.count(profile)} drawings")
 
-def create_calibration_vector():
-    extractor, encoder = load_model()
-    REFERENCE_FONT = "Yomogi-Regular"
-    deltas = []  # (User - Font)
 
-    font_folder = GENERATED_EMBEDDINGS_FOLDER / REFERENCE_FONT
+def import_embeddings():
+    """Convert embeddings in the older `batch_{i}.pt` / `batch_{i}.txt` layout (e.g. from the notebook) into the embedding store"""
+    from embedding_store import EmbeddingStore, import_batch_files
 
-    for image_file in CALIBRATION_IMAGES_FOLDER.glob("*.png"):
-        user_image = Image.open(image_file, 'r')
-        user_tensor = get_embeddings(extractor, encoder, [user_image])
-        font_embed = torch.load(font_folder / f"{image_file.stem}.pt", weights_only=True)
-        deltas.append(user_tensor[0] - font_embed)
-
-    torch.save(torch.mean(torch.stack(deltas), 0), CALIBRATION_FILE)
+    import_batch_files(EmbeddingStore(), GENERATED_EMBEDDINGS_FOLDER)
 
 
 def upload_embeddings():
+    """Upload every embedding in the embedding store that is not in the database yet"""
+    from tqdm import tqdm
+    from generate_images import get_standard_kanji_set, list_font_files
+    from embedding_store import EmbeddingStore
+    from config import DATABASE_LOCATION
+    from manifest import Manifest, point_stage
+    from database import create_connection, create_collection, index_collection, insert, delete_font
+    from query_cache import clear_results
+
+    manifest = Manifest()
     qdrant = create_connection()
-    assert create_collection(qdrant), "Failed to create collection"
+    uploaded = point_stage(DATABASE_LOCATION, "kanji")
+    if not qdrant.collection_exists("kanji"):
+        if not create_collection(qdrant):
+            raise Exception("Failed to create collection")
+        # Nothing recorded as uploaded can be in a collection that did not exist
+        manifest.reset_all(uploaded)
 
     standard_kanji_set = get_standard_kanji_set()
-    font_tensors_folders = list(GENERATED_EMBEDDINGS_FOLDER.iterdir())
-    print(f"Uploading embeddings for the following fonts: {tuple(folder.name for folder in font_tensors_folders)}")
-
-    _checkpoint = 0
-    for folder in tqdm(font_tensors_folders):
-        tensor_files = list(folder.glob("*.pt"))
-        print(f"Found {len(tensor_files)} batches of tensors for font {folder.name}")
-
-        for file in tqdm(tensor_files):
-            _checkpoint += 1
-            if _checkpoint > 0:
-                tensor = torch.load(file, weights_only=True)
-                labels = file.with_suffix(".txt").read_text("UTF-8").splitlines()
-                embeddings = {label: embedding for label, embedding in zip(labels, tensor)}
-
-                insert(qdrant, folder.name, embeddings, standard_kanji_set)
-    
+    store = EmbeddingStore()
+    font_files = list_font_files()
+    print(f"Uploading embeddings for the following fonts: {tuple(store.fonts)}")
+
+    try:
+        for font_name, labels, vectors in tqdm(store.iter_fonts(), total=len(store.fonts)):
+            # Embeddings imported from batch files may not have a matching font file, fall back to the font name
+            key = manifest.register_font(font_name, font_files[font_name]) if font_name in font_files else font_name
+            if not manifest.get(key, uploaded):
+                # Points of an older version of the font (or uploaded without recording them) would be left behind otherwise
+                delete_font(qdrant, font_name)
+            pending = set(manifest.missing(key, uploaded, labels))
+            print(f"Uploading {len(pending)} of the {len(labels)} embeddings for font {font_name}")
+
+            rows = [i for i, kanji in enumerate(labels) if kanji in pending]
+            for batch in tqdm(batched(rows, GENERATE_EMBEDDINGS_BATCH_SIZE)):
+                embeddings = {labels[i]: vectors[i] for i in batch}
+                # Same ids as `build_index` and `dataset/upload.py`, so that the entry points overwrite each other's points
+                insert(qdrant, font_name, embeddings, standard_kanji_set)
+                manifest.mark(key, uploaded, list(embeddings))
+                manifest.save(force=False)
+    finally:
+        manifest.save()
+        # Also covers the fonts deleted above
+        clear_results()
+
     index_collection(qdrant)
 
 
-def _search_files(files: list[Path]):
-    qdrant = create_connection()
+def export_encoder(quantize: bool, compare_only: bool):
+    from onnx_encoder import export_encoder, compare_engines
+    from encoder import load_model
+
+    extractor, encoder = load_model("torch")
+    if not compare_only:
+        export_encoder(encoder, quantize)
+    compare_engines(extractor, encoder)
+
+
+def _report_queries(index, count: int):
+    """Corpus embeddings with some noise, so that they are not exactly equal to their own stored vector"""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    queries = index.matrix[rng.choice(len(index), min(count, len(index)), replace=False)]
+    return queries + rng.normal(scale=0.5 * queries.std(), size=queries.shape).astype(np.float32)
+
+
+def _timed_search(index, queries, k: int, group_by: str | None = None):
+    """Returns the ids of the top `k` hits of each query and the time it took to search all of them"""
+    import time
+    import numpy as np
+
+    start = time.perf_counter()
+    hits = index.search_batch(queries, k, group_by=group_by)
+    elapsed = time.perf_counter() - start
+    return np.array([[hit.id for hit in query_hits] for query_hits in hits]), elapsed
+
+
+def quantization_report(queries_count: int, k: int):
+    """Compares each quantization mode of the in-process index against the exact float32 search"""
+    from quantization import QUANTIZATION_MODES, recall_at_k
+    from matrix_index import load_matrix_index
+
+    index = load_matrix_index().with_quantization(None).with_projection(None).with_prototypes(None)
+    queries = _report_queries(index, queries_count)
+
+    exact_ids, exact_time = _timed_search(index, queries, k)
+    print(f"{'mode':<10}{'bytes':>14}{'ratio':>8}{f'recall@{k}':>12}{'ms/query':>10}")
+    print(f"{'float32':<10}{index.matrix.nbytes:>14}{1:>8.2f}{1:>12.4f}{1000 * exact_time / len(queries):>10.3f}")
+    for mode in QUANTIZATION_MODES:
+        quantized = index.with_quantization(mode)
+        size = quantized.memory_footprint()[mode]
+        ids, elapsed = _timed_search(quantized, queries, k)
+        print(f"{mode:<10}{size:>14}{size / index.matrix.nbytes:>8.2f}{recall_at_k(ids, exact_ids):>12.4f}{1000 * elapsed / len(queries):>10.3f}")
+
+
+def _reduction_corpus(parquet: Path | None):
+    """Every generated embedding (memory-mapped), or every embedding of the parquet dataset (see `dataset/main.py`)"""
+    if parquet is None:
+        from embedding_store import EmbeddingStore
+        return EmbeddingStore().vectors
+    import sys
+    sys.path.append(str(Path(__file__).resolve().parent.parent / "dataset"))
+    from reader import read_embeddings
+    return read_embeddings(parquet)[1]
+
+
+def fit_reduction(dimensions: list[int], whiten: bool, parquet: Path | None):
+    """Fits the PCA projection to each number of dimensions and saves them under `REDUCTION_FOLDER`"""
+    from reduction import fit_projection, projection_path
+
+    vectors = _reduction_corpus(parquet)
+    if len(vectors) == 0:
+        raise Exception("No embeddings to fit the projection on, run `generate_embeddings` first or pass `--parquet`")
+    for count in dimensions:
+        projection = fit_projection(vectors, count, whiten)
+        path = projection_path(count, whiten)
+        projection.save(path)
+        print(f"Saved the projection to {count} dimensions ({projection.metadata['explained_variance']:.1%} of the variance) to {path}")
+
+
+def reduction_report(dimensions: list[int], whiten: bool, queries_count: int, k: int):
+    """Compares the reduced first pass (reranked with the full vectors) of the in-process index against the full search"""
+    from quantization import recall_at_k
+    from reduction import fit_projection
+    from matrix_index import load_matrix_index
+
+    index = load_matrix_index().with_quantization(None).with_projection(None).with_prototypes(None)
+    queries = _report_queries(index, queries_count)
+
+    exact_ids, exact_time = _timed_search(index, queries, k)
+    print(f"{'dimensions':<12}{'variance':>10}{'bytes':>14}{f'recall@{k}':>12}{'ms/query':>10}")
+    print(f"{index.matrix.shape[1]:<12}{1:>10.3f}{index.matrix.nbytes:>14}{1:>12.4f}{1000 * exact_time / len(queries):>10.3f}")
+    for count in dimensions:
+        # Fitted on the index itself, so that the report does not depend on the saved projections
+        reduced = index.with_projection(fit_projection(index.matrix, count, whiten))
+        size = reduced.memory_footprint()[f"pca{count}"]
+        ids, elapsed = _timed_search(reduced, queries, k)
+        variance = reduced.projection.metadata["explained_variance"]
+        print(f"{count:<12}{variance:>10.3f}{size:>14}{recall_at_k(ids, exact_ids):>12.4f}{1000 * elapsed / len(queries):>10.3f}")
+
+
+def build_prototypes(centroids: int):
+    """Computes the prototypes of every kanji from the generated embeddings, and uploads them to Qdrant for the prototype first pass"""
+    import numpy as np
+    from embedding_store import EmbeddingStore
+    from generate_images import get_standard_kanji_set
+    from prototypes import fit_prototypes
+    from database import create_connection, upload_prototypes, PROTOTYPE_COLLECTION
+    from query_cache import clear_results
+
+    store = EmbeddingStore()
+    if len(store) == 0:
+        raise Exception("No embeddings to build the prototypes from, run `generate_embeddings` first")
+    kanji_list, group_ids = np.unique(store.kanji, return_inverse=True)
+    prototypes = fit_prototypes(store.vectors, group_ids, centroids)
+    upload_prototypes(create_connection(), kanji_list.tolist(), prototypes, get_standard_kanji_set())
+    clear_results()
+    print(f"Uploaded {len(kanji_list)} x {centroids} prototypes (from {len(store)} embeddings) to the {PROTOTYPE_COLLECTION} collection, set KANJI_PROTOTYPE_CENTROIDS={centroids} to search them")
+
+
+def prototype_report(centroids: list[int], queries_count: int, k: int):
+    """Compares the prototype first pass (reranked with every font of the candidate kanji) of the in-process index against the full search"""
+    from quantization import recall_at_k
+    from matrix_index import load_matrix_index
+
+    index = load_matrix_index().with_quantization(None).with_projection(None).with_prototypes(None)
+    queries = _report_queries(index, queries_count)
+
+    # Distinct kanji, as `search` returns them
+    exact_ids, exact_time = _timed_search(index, queries, k, "kanji")
+    print(f"{'centroids':<12}{'vectors':>10}{'bytes':>14}{f'recall@{k}':>12}{'ms/query':>10}")
+    print(f"{'-':<12}{len(index):>10}{index.matrix.nbytes:>14}{1:>12.4f}{1000 * exact_time / len(queries):>10.3f}")
+    for count in centroids:
+        prototypes = index.with_prototypes(count)
+        size = prototypes.memory_footprint()[f"prototypes{count}"]
+        vectors = prototypes.prototypes.shape[0] * count
+        ids, elapsed = _timed_search(prototypes, queries, k, "kanji")
+        print(f"{count:<12}{vectors:>10}{size:>14}{recall_at_k(ids, exact_ids):>12.4f}{1000 * elapsed / len(queries):>10.3f}")
+
+
+def _search_files(files: list[Path], profile: str = DEFAULT_CALIBRATION_PROFILE, search_filter: "SearchFilter | None" = None):
+    from PIL import Image
+    from encoder import load_model
+    from database import create_search_backend, collection_fingerprint, search_batch, format_search_results
+    from calibration import CalibrationProfiles
+    from query_cache import QueryCache
+    from strokes import load_strokes
+    from metrics import stage
+
+    qdrant = create_search_backend()
     extractor, encoder = load_model()
-
-    if CALIBRATION_FILE.is_file():
-        print("Loading Calibration file")
-        calibration_vector = torch.load(CALIBRATION_FILE, weights_only=True)
-        # An offset to approach the user's embeddings to that of the font
-        # (Ideally you would probably want to try something akin to a lora,
-        # but this worked descently for me and is very light to "train")
-    else:
-        calibration_vector = torch.zeros(MODEL_EMBEDDING_SIZE)
-
-    images = [Image.open(file, "r").convert("L") for file in files]
-    tensor = get_embeddings(extractor, encoder, images)
-
-    for file, vector in zip(files, tensor):
-        results = search_vector(qdrant, (vector - calibration_vector), limit=50)
-
-        formatted = format_search_results(results)
+    cache = QueryCache(collection_fingerprint(qdrant))
+
+    profiles = CalibrationProfiles()
+
+    with stage("main.decode_images", len(files)):
+        # Strokes (.json) get rasterized straight away instead of going through an image file
+        images = [load_strokes(file.read_bytes()) if file.suffix == ".json" else Image.open(file, "r").convert("L") for file in files]
+    with stage("main.embed_queries", len(files)):
+        tensor = cache.get_embeddings(extractor, encoder, images)
+    queries = profiles.apply(tensor, [profile] * len(files))
+
+    # Every query (not cached yet) goes to the database in a single batched request
+    with stage("main.search", len(files)):
+        results = cache.get_results_batch(
+            queries, 50,
+            lambda missing: [format_search_results(hits) for hits in search_batch(qdrant, missing, limit=50, search_filter=search_filter, group_by_kanji=True)],
+            search_filter=search_filter, group_by_kanji=True,
+        )
+    for file, formatted in zip(files, results):
         print(f"Search Results for {file.stem}:")
-        print('\t'.join(dict.fromkeys(result.kanji for result in formatted)), end='\n')
+        print('\t'.join(result.kanji for result in formatted), end='\n')
 
 
-def search_path(path: Path):
+def search_path(path: Path, profile: str = DEFAULT_CALIBRATION_PROFILE, standard_only: bool = False, fonts: list[str] | None = None, exclude_fonts: list[str] | None = None):
+    from search_filter import SearchFilter
+    search_filter = SearchFilter.create(standard_only, fonts, exclude_fonts)
     if path.is_file():
-        _search_files([path])
+        _search_files([path], profile, search_filter)
     elif path.is_dir():
-        _search_files(list(path.glob("*.png")))
+        _search_files(sorted([*path.glob("*.png"), *path.glob("*.json")]), profile, search_filter)
     else:
         raise Exception(f'Could not find a file nor a folder at Path "{path.resolve()}"')
 
@@ -168,13 +457,35 @@ def search_path(path: Path):
 if __name__ == "__main__":
     from cli import parser
     args = parser.parse_args()
+
+    def build_index(*args):
+        from pipeline import build_index
+        build_index(*args)
+
+    def run_server(*args):
+        from server import run_server
+        run_server(*args)
+
     functions = {
-        "generate_images": generate_images,
-        "generate_embeddings": generate_embeddings,
+        "generate_images": lambda : generate_images(args.workers),
+        "font_coverage": lambda : font_coverage(args.output),
+        "generate_embeddings": lambda : generate_embeddings(args.workers, args.threads),
+        "import_embeddings": import_embeddings,
         "upload_embeddings": upload_embeddings,
-        "calibrate": create_calibration_vector,
-        "search": lambda : search_path(args.input),
+        "build_index": lambda : build_index(args.write_images, args.write_embeddings),
+        "calibrate": lambda : create_calibration_vector(args.profile, args.image, args.kanji),
+        "export_encoder": lambda : export_encoder(not args.no_quantize, args.compare_only),
+        "quantization_report": lambda : quantization_report(args.queries, args.k),
+        "fit_reduction": lambda : fit_reduction(args.dimensions, args.whiten, args.parquet),
+        "reduction_report": lambda : reduction_report(args.dimensions, args.whiten, args.queries, args.k),
+        "build_prototypes": lambda : build_prototypes(args.centroids),
+        "prototype_report": lambda : prototype_report(args.centroids, args.queries, args.k),
+        "search": lambda : search_path(args.input, args.profile, args.standard_only, args.fonts, args.exclude_fonts),
+        "serve": lambda : run_server(args.host, args.port),
     }
     if not hasattr(args, '_name') or args._name not in functions:
         raise Exception("Command not found")
-    functions[args._name]()
+
+    from metrics import torch_profiler
+    with torch_profiler(args._name):
+        functions[args._name]()
@@ -0,0 +1,106 @@
+"""Keeps track of what has already been generated, so that each command only has to process what is missing
+
+Everything is grouped by a key made of the font file hash and every setting that affects the output
+(model, image size, font size), so changing any of them (or editing the font file) invalidates the old records.
+Within each group, the manifest records which kanji already have an image, an embedding and a point in Qdrant,
+as well as the kanji that the font does not support. The points are recorded per Qdrant location and collection (see `point_stage`),
+so that uploading to another server or to a recreated collection starts over.
+"""
+import json
+import time
+import hashlib
+import pathlib
+
+from config import (
+    MANIFEST_FILE,
+    MODEL,
+    MODEL_IMAGE_SIZE,
+    FONT_SIZE,
+)
+
+STAGES = ("image", "unsupported", "embedding")
+
+# Minimum interval in seconds between two writes when saving without `force`
+SAVE_INTERVAL = 10
+
+
+def file_hash(path: pathlib.Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def group_key(font_hash: str) -> str:
+    return f"{font_hash}:{MODEL}:{MODEL_IMAGE_SIZE}:{FONT_SIZE}"
+
+
+def point_stage(location: str, collection: str) -> str:
+    """Name of the stage recording the points uploaded to that collection of that Qdrant server"""
+    return f"point:{location}/{collection}"
+
+
+class Manifest:
+    def __init__(self, path: pathlib.Path = MANIFEST_FILE):
+        self.path = path
+        self.fonts: dict[str, str] = {}  # font_name -> group key
+        self.groups: dict[str, dict[str, set[str]]] = {}
+        self._last_save = time.monotonic()
+        if path.is_file():
+            data = json.loads(path.read_text(encoding="UTF-8"))
+            self.fonts = data["fonts"]
+            self.groups = {
+                key: {stage: set(kanji) for stage, kanji in stages.items()}
+                for key, stages in data["groups"].items()
+            }
+
+    def save(self, force: bool = True):
+        if not force and time.monotonic() - self._last_save < SAVE_INTERVAL:
+            return
+        data = {
+            "fonts": self.fonts,
+            "groups": {
+                key: {stage: sorted(kanji) for stage, kanji in stages.items()}
+                for key, stages in self.groups.items()
+            },
+        }
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        # Write then rename, so that a crash while saving does not corrupt the existing manifest
+        temporary = self.path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(data, ensure_ascii=False), encoding="UTF-8")
+        temporary.replace(self.path)
+        self._last_save = time.monotonic()
+
+    def register_font(self, font_name: str, font_file: pathlib.Path) -> str:
+        """Hash the font file and returns its group key. Drops the records of its previous version if it changed"""
+        key = group_key(file_hash(font_file))
+        previous = self.fonts.get(font_name)
+        if previous is not None and previous != key:
+            print(f"Font {font_name} or the settings changed since the last run, regenerating everything for it")
+            self.groups.pop(previous, None)
+        self.fonts[font_name] = key
+        return key
+
+    def get(self, key: str, stage: str) -> set[str]:
+        return self.groups.setdefault(key, {}).setdefault(stage, set())
+
+    def missing(self, key: str, stage: str, kanji_list: list[str]) -> list[str]:
+        done = self.get(key, stage)
+        return [kanji for kanji in kanji_list if kanji not in done]
+
+    def mark(self, key: str, stage: str, kanji_list: list[str]):
+        self.get(key, stage).update(kanji_list)
+
+    def reset(self, key: str, stage: str):
+        self.groups.setdefault(key, {})[stage] = set()
+
+    def digest(self, stage: str) -> str:
+        """Changes whenever the kanji recorded for the stage change, for any font or version of a font"""
+        digest = hashlib.blake2b(digest_size=16)
+        for key in sorted(self.groups):
+            kanji = self.groups[key].get(stage)
+            if kanji:
+                digest.update(json.dumps([key, sorted(kanji)], ensure_ascii=False).encode())
+        return digest.hexdigest()
+
+    def reset_all(self, stage: str):
+        """Forget the stage for every font, e.g. the points of a collection that was just (re)created"""
+        for stages in self.groups.values():
+            stages.pop(stage, None)
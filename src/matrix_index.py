@@ -0,0 +1,378 @@
+import typing
+import dataclasses
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    import torch  # Only for type hints, importing it takes a while
+    from reduction import Projection
+
+from config import (
+    MODEL_EMBEDDING_SIZE,
+    EMBEDDING_QUANTIZATION,
+    QUANTIZATION_RESCORE_OVERSAMPLING,
+    REDUCTION_RERANK_OVERSAMPLING,
+    PROTOTYPE_CENTROIDS,
+    PROTOTYPE_CANDIDATE_OVERSAMPLING,
+)
+from embedding_store import EmbeddingStore
+from quantization import check_mode, fit_scale, quantize, approximate_scores
+from search_filter import SearchFilter
+from prototypes import fit_prototypes, member_table
+
+# Upper bound on the number of rows gathered at once when reranking the prototype candidates
+_RERANK_CHUNK_ROWS = 1 << 16
+
+@dataclasses.dataclass
+class MatrixHit:
+    """Mimics the parts of `qdrant_client.models.ScoredPoint` used by `format_search_results`"""
+    id: int
+    payload: dict
+    score: float
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    "L2-normalize each row, leaving all-zero rows untouched"
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the column indices and the values of the `k` highest scores of each row, best first"""
+    if k < scores.shape[1]:
+        # argpartition gets the (unsorted) top `k` in linear time, then only those get sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+class MatrixIndex:
+    """In-process brute force cosine search, an alternative to a Qdrant server.
+
+    Every embedding is kept normalized in one contiguous `(N, MODEL_EMBEDDING_SIZE)` float32 matrix,
+    so that a search is a single matmul followed by a top-k selection.
+
+    If `quantization` is set, the search runs over the compact codes instead (see `quantization.py`),
+    then the best `limit * rescore_oversampling` candidates get rescored with the full precision vectors.
+
+    If `projection` is set, the candidates are picked with the PCA-reduced vectors instead (see `reduction.py`), quantized or not,
+    then the best `limit * rerank_oversampling` get reranked with the full vectors.
+
+    If `prototype_centroids` is set, the search picks the best `limit * prototype_oversampling` kanji with their prototypes first
+    (see `prototypes.py`), then scores every font of only those kanji with the full vectors.
+    The prototypes then go through the same `projection` and `quantization` as the vectors, for that first pass only.
+
+    Filtered searches score every point the same way, then mask out the points not matching the filter before the top-k,
+    so they cost about the same as unfiltered ones. The masks are computed once per filter.
+    """
+    def __init__(
+        self,
+        quantization: str | None = EMBEDDING_QUANTIZATION,
+        rescore_oversampling: float = QUANTIZATION_RESCORE_OVERSAMPLING,
+        projection: "Projection | None" = None,
+        rerank_oversampling: float = REDUCTION_RERANK_OVERSAMPLING,
+        prototype_centroids: int | None = PROTOTYPE_CENTROIDS,
+        prototype_oversampling: float = PROTOTYPE_CANDIDATE_OVERSAMPLING,
+    ):
+        check_mode(quantization)
+        self.quantization = quantization
+        self.rescore_oversampling = rescore_oversampling
+        self.projection = projection
+        self.rerank_oversampling = rerank_oversampling
+        self.prototype_centroids = prototype_centroids
+        self.prototype_oversampling = prototype_oversampling
+        self.payloads: list[dict] = []
+        self.revision = ""  # Of the embeddings it was loaded from, see `database.collection_fingerprint`
+        self._matrix = np.empty((0, MODEL_EMBEDDING_SIZE), dtype=np.float32)
+        self._pending: list[np.ndarray] = []
+        self._codes: np.ndarray | None = None
+        self._scale: np.ndarray | None = None
+        self._reduced: np.ndarray | None = None
+        self._prototypes: np.ndarray | None = None
+        self._prototype_codes: np.ndarray | None = None
+        self._prototype_scale: np.ndarray | None = None
+        self._members: np.ndarray | None = None
+        self._masks: dict[SearchFilter, np.ndarray] = {}
+        self._groups: dict[str, tuple[np.ndarray, int]] = {}
+
+    def __len__(self):
+        return len(self.payloads)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        # Inserts are buffered and only concatenated once, when they are first needed
+        if self._pending:
+            self._matrix = np.concatenate([self._matrix, *self._pending])
+            self._pending.clear()
+            self._codes = None
+            self._reduced = None
+            self._prototypes = None
+            self._prototype_codes = None
+            self._members = None
+            self._masks.clear()
+            self._groups.clear()
+        return self._matrix
+
+    @property
+    def reduced(self) -> np.ndarray:
+        """The (normalized) projection of every vector, only for indexes with a `projection`"""
+        matrix = self.matrix
+        if self._reduced is None:
+            self._reduced = _normalize(self.projection.project(matrix))
+        return self._reduced
+
+    @property
+    def codes(self) -> np.ndarray:
+        vectors = self.matrix if self.projection is None else self.reduced
+        if self._codes is None:
+            self._scale = fit_scale(vectors) if self.quantization == "int8" else None
+            self._codes = quantize(vectors, self.quantization, self._scale)
+        return self._codes
+
+    @property
+    def prototypes(self) -> np.ndarray:
+        """`(kanji, prototype_centroids, MODEL_EMBEDDING_SIZE)` prototypes, in the order of `_group_ids("kanji")`"""
+        matrix = self.matrix
+        if self._prototypes is None:
+            group_ids, _ = self._group_ids("kanji")
+            self._prototypes = fit_prototypes(matrix, group_ids, self.prototype_centroids)
+        return self._prototypes
+
+    @property
+    def prototype_codes(self) -> np.ndarray:
+        """The prototypes as scored by the first pass: `(kanji * prototype_centroids, ...)`, projected and / or quantized like `codes`"""
+        prototypes = self.prototypes
+        if self._prototype_codes is None:
+            vectors = prototypes.reshape(-1, prototypes.shape[2])
+            if self.projection is not None:
+                vectors = _normalize(self.projection.project(vectors))
+            if self.quantization is not None:
+                self._prototype_scale = fit_scale(vectors) if self.quantization == "int8" else None
+                vectors = quantize(vectors, self.quantization, self._prototype_scale)
+            self._prototype_codes = vectors
+        return self._prototype_codes
+
+    @property
+    def members(self) -> np.ndarray:
+        """`(kanji, most fonts of a kanji)` rows of every font of each kanji, padded with -1"""
+        self.matrix
+        if self._members is None:
+            self._members = member_table(self._group_ids("kanji")[0])
+        return self._members
+
+    def _with(self, **changes) -> "MatrixIndex":
+        other = MatrixIndex(**{
+            "quantization": self.quantization,
+            "rescore_oversampling": self.rescore_oversampling,
+            "projection": self.projection,
+            "rerank_oversampling": self.rerank_oversampling,
+            "prototype_centroids": self.prototype_centroids,
+            "prototype_oversampling": self.prototype_oversampling,
+            **changes,
+        })
+        other.payloads = self.payloads
+        other.revision = self.revision
+        other._matrix = self.matrix
+        return other
+
+    def with_quantization(self, quantization: str | None) -> "MatrixIndex":
+        """Returns another index over the same vectors and payloads (without copying them), using a different quantization"""
+        return self._with(quantization=quantization)
+
+    def with_projection(self, projection: "Projection | None") -> "MatrixIndex":
+        """Returns another index over the same vectors and payloads (without copying them), using a different projection"""
+        return self._with(projection=projection)
+
+    def with_prototypes(self, centroids: int | None) -> "MatrixIndex":
+        """Returns another index over the same vectors and payloads (without copying them), with a different number of prototypes per kanji"""
+        return self._with(prototype_centroids=centroids)
+
+    def memory_footprint(self) -> dict[str, int]:
+        """Size in bytes of the full precision matrix and of the (reduced) vectors or codes searched through first"""
+        footprint = {"float32": self.matrix.nbytes}
+        if self.projection is not None:
+            footprint[f"pca{self.projection.dimensions}"] = self.reduced.nbytes
+        if self.quantization is not None:
+            footprint[self.quantization] = self.codes.nbytes
+        if self.prototype_centroids is not None:
+            footprint[f"prototypes{self.prototype_centroids}"] = self.prototypes.nbytes
+            if self.quantization is not None or self.projection is not None:
+                footprint[f"prototype_codes{self.prototype_centroids}"] = self.prototype_codes.nbytes
+        return footprint
+
+    def insert(self, font_name: str, kanji_dict: dict[str, "torch.Tensor"], standard_set: set[str]):
+        if not kanji_dict:
+            return
+        vectors = np.stack([np.asarray(embedding, dtype=np.float32) for embedding in kanji_dict.values()])
+        self._pending.append(_normalize(vectors))
+        self.payloads.extend(
+            {
+                "kanji": kanji,
+                "is_standard": kanji in standard_set,
+                "font": font_name,
+            }
+            for kanji in kanji_dict
+        )
+
+    def _approximate_scores(self, queries: np.ndarray) -> np.ndarray:
+        """Scores of the first pass, over the reduced vectors and / or the codes"""
+        if self.projection is not None:
+            queries = _normalize(self.projection.project(queries))
+            if self.quantization is None:
+                return queries @ self.reduced.T
+        return approximate_scores(queries, self.codes, self.quantization, self._scale)
+
+    def _prototype_scores(self, queries: np.ndarray) -> np.ndarray:
+        """`(queries, kanji)` scores of the first pass, the best over the prototypes of each kanji"""
+        codes = self.prototype_codes
+        if self.projection is not None:
+            queries = _normalize(self.projection.project(queries))
+        if self.quantization is None:
+            scores = queries @ codes.T
+        else:
+            scores = approximate_scores(queries, codes, self.quantization, self._prototype_scale)
+        return scores.reshape(len(queries), -1, self.prototype_centroids).max(axis=2)
+
+    def _mask(self, search_filter: SearchFilter | None) -> np.ndarray | None:
+        """Boolean array of the rows matching the filter, None if there is no filter"""
+        if search_filter is None:
+            return None
+        self.matrix  # Flushes the pending inserts (and the outdated masks)
+        mask = self._masks.get(search_filter)
+        if mask is None:
+            mask = self._masks[search_filter] = np.fromiter(map(search_filter.matches, self.payloads), dtype=bool, count=len(self.payloads))
+        return mask
+
+    def _group_ids(self, group_by: str) -> tuple[np.ndarray, int]:
+        """The group of each row (by value of the `group_by` payload field), and how many rows the largest group has"""
+        self.matrix
+        if group_by not in self._groups:
+            _, ids, counts = np.unique([payload[group_by] for payload in self.payloads], return_inverse=True, return_counts=True)
+            self._groups[group_by] = ids, int(counts.max(initial=1))
+        return self._groups[group_by]
+
+    def search_batch(
+        self,
+        query_vectors: "torch.Tensor | np.ndarray",
+        limit: int=10,
+        search_filter: SearchFilter | None = None,
+        group_by: str | None = None,
+    ) -> list[list[MatrixHit]]:
+        """Search for multiple query vectors at once, returns one list of hits (best first) per query.
+
+        With `group_by` (a payload field, e.g. "kanji"), returns the best hit of each of the best `limit` groups instead"""
+        queries = _normalize(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        matrix = self.matrix
+        mask = self._mask(search_filter)
+        if self.prototype_centroids is not None and group_by in (None, "kanji"):
+            return self._search_prototypes(queries, limit, mask, group_by)
+        available = len(matrix) if mask is None else int(mask.sum())
+        fetch = limit
+        if group_by is not None:
+            group_ids, largest_group = self._group_ids(group_by)
+            # The best point of each of the best `limit` groups is always within the best `limit * largest group` points
+            fetch = limit * largest_group
+        fetch = min(available, fetch)
+        if fetch <= 0:
+            return [[] for _ in queries]
+
+        if self.quantization is None and self.projection is None:
+            top, top_scores = _top_k(_masked(queries @ matrix.T, mask), fetch)
+        else:
+            oversampling = self.rescore_oversampling if self.projection is None else self.rerank_oversampling
+            candidates_count = min(available, max(fetch, int(fetch * oversampling)))
+            candidates, _ = _top_k(_masked(self._approximate_scores(queries), mask), candidates_count)
+            rescored = np.einsum("qd,qkd->qk", queries, matrix[candidates])
+            order, top_scores = _top_k(rescored, fetch)
+            top = np.take_along_axis(candidates, order, axis=1)
+
+        if group_by is not None:
+            top, top_scores = _best_per_group(top, top_scores, group_ids, limit)
+        return [
+            [MatrixHit(id=int(i), payload=self.payloads[i], score=float(score)) for i, score in zip(row, row_scores)]
+            for row, row_scores in zip(top, top_scores)
+        ]
+
+    def _search_prototypes(self, queries: np.ndarray, limit: int, mask: np.ndarray | None, group_by: str | None) -> list[list[MatrixHit]]:
+        """First pass over the prototypes of each kanji, then only the fonts of the best kanji get scored with their own vectors"""
+        matrix = self.matrix
+        if len(matrix) == 0:
+            return [[] for _ in queries]
+        members = self.members
+        scores = self._prototype_scores(queries)
+        if mask is not None:
+            # Only the fonts matching the filter get reranked, kanji without any are left out of the first pass
+            members = np.where((members >= 0) & mask[np.maximum(members, 0)], members, -1)
+            scores[:, ~(members >= 0).any(axis=1)] = -np.inf
+        available = int((members >= 0).any(axis=1).sum())
+        candidates_count = min(available, max(limit, int(limit * self.prototype_oversampling)))
+        if candidates_count <= 0:
+            return [[] for _ in queries]
+        candidates, _ = _top_k(scores, candidates_count)
+
+        rows = members[candidates]  # (queries, candidate kanji, fonts)
+        row_scores = np.empty(rows.shape, dtype=np.float32)
+        # Queries of a batch mostly share candidates, so each chunk scores the union of its candidates' rows with a single matmul
+        chunk = max(1, _RERANK_CHUNK_ROWS // rows[0].size)
+        for start in range(0, len(queries), chunk):
+            chunk_rows = rows[start : start + chunk]
+            union, positions = np.unique(np.maximum(chunk_rows, 0), return_inverse=True)
+            chunk_scores = queries[start : start + chunk] @ matrix[union].T
+            chunk_scores = np.take_along_axis(chunk_scores, positions.reshape(len(chunk_rows), -1), axis=1).reshape(chunk_rows.shape)
+            row_scores[start : start + chunk] = np.where(chunk_rows >= 0, chunk_scores, -np.inf)
+
+        if group_by == "kanji":
+            # Best font of each candidate kanji
+            best = row_scores.argmax(axis=2)[..., None]
+            rows, row_scores = np.take_along_axis(rows, best, axis=2), np.take_along_axis(row_scores, best, axis=2)
+        rows, row_scores = rows.reshape(len(queries), -1), row_scores.reshape(len(queries), -1)
+        top, top_scores = _top_k(row_scores, min(limit, rows.shape[1]))
+        top = np.take_along_axis(rows, top, axis=1)
+        return [
+            [MatrixHit(id=int(i), payload=self.payloads[i], score=float(score)) for i, score in zip(row, row_top_scores) if score != -np.inf]
+            for row, row_top_scores in zip(top, top_scores)
+        ]
+
+    def search_vector(
+        self,
+        query_vector: "torch.Tensor | np.ndarray",
+        limit: int=10,
+        search_filter: SearchFilter | None = None,
+        group_by: str | None = None,
+    ) -> list[MatrixHit]:
+        return self.search_batch(query_vector, limit, search_filter, group_by)[0]
+
+
+def _masked(scores: np.ndarray, mask: np.ndarray | None) -> np.ndarray:
+    """Sets the scores of the rows outside the mask to -inf, in place"""
+    if mask is not None:
+        scores[:, ~mask] = -np.inf
+    return scores
+
+
+def _best_per_group(top: np.ndarray, top_scores: np.ndarray, group_ids: np.ndarray, limit: int) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    """Keeps the first (best) row of each group in each row of `top` (sorted best first), up to `limit` groups"""
+    rows, scores = [], []
+    for row, row_scores in zip(top, top_scores):
+        _, first = np.unique(group_ids[row], return_index=True)
+        first = np.sort(first)[:limit]
+        rows.append(row[first])
+        scores.append(row_scores[first])
+    return rows, scores
+
+def load_matrix_index(store: EmbeddingStore | None = None) -> MatrixIndex:
+    """Load every embedding from the embedding store (generated by `main.py generate_embeddings`) into a `MatrixIndex`"""
+    from generate_images import get_standard_kanji_set
+    from reduction import load_projection
+
+    store = store or EmbeddingStore()
+    index = MatrixIndex(projection=load_projection())
+    index.revision = store.revision
+    standard_set = get_standard_kanji_set()
+    for font_name, labels, vectors in store.iter_fonts():
+        index.insert(font_name, dict(zip(labels, vectors)), standard_set)
+    print(f"Loaded {len(index)} embeddings into the in-process index")
+    return index
@@ -0,0 +1,226 @@
+"""Wall time, CPU time and item counts per stage (image decode, preprocessing, encoder forward, database calls, ...)
+
+Wrap a stage with `with stage("encoder.forward", items=len(images)):`, the recorded events go to the sinks listed in `METRICS`:
+- `log`: One line per event
+- `json`: Every event in `METRICS_TRACE_FILE` (Chrome trace format, open it with https://ui.perfetto.dev or chrome://tracing)
+- `prometheus`: Totals per stage in the Prometheus text format, in `METRICS_PROMETHEUS_FILE` on exit (and `GET /metrics` for `main.py serve`)
+
+Without any sink, `stage` returns a shared no-op context manager, so it only costs a function call (well under a microsecond).
+Set `TORCH_PROFILE_FOLDER` to also run the commands under the torch profiler, with each stage as a `record_function` range.
+"""
+import os
+import json
+import time
+import atexit
+import pathlib
+import threading
+import contextlib
+import dataclasses
+
+from config import (
+    METRICS,
+    METRICS_TRACE_FILE,
+    METRICS_PROMETHEUS_FILE,
+    TORCH_PROFILE_FOLDER,
+)
+
+_NULL = contextlib.nullcontext()
+
+
+@dataclasses.dataclass
+class StageEvent:
+    name: str
+    start: float  # Unix timestamp, in seconds
+    wall: float
+    cpu: float  # Process CPU time, so it includes torch's worker threads (and any other thread running at the same time)
+    items: int
+    thread: int
+
+
+@dataclasses.dataclass
+class StageTotals:
+    calls: int = 0
+    items: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+    max_wall: float = 0.0
+
+
+class LogSink:
+    def record(self, event: StageEvent):
+        print(f"[metrics] {event.name}: {1000 * event.wall:.2f} ms wall, {1000 * event.cpu:.2f} ms cpu, {event.items} items")
+
+    def close(self):
+        pass
+
+
+class JsonTraceSink:
+    def __init__(self, file: pathlib.Path = METRICS_TRACE_FILE):
+        self.file = file
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, event: StageEvent):
+        trace_event = {
+            "name": event.name,
+            "ph": "X",
+            "ts": event.start * 1e6,
+            "dur": event.wall * 1e6,
+            "pid": os.getpid(),
+            "tid": event.thread,
+            "args": {"items": event.items, "cpu_ms": 1000 * event.cpu},
+        }
+        with self._lock:
+            self.events.append(trace_event)
+
+    def close(self):
+        if not self.events:
+            return
+        self.file.parent.mkdir(exist_ok=True, parents=True)
+        self.file.write_text(json.dumps({"traceEvents": self.events}), encoding="UTF-8")
+        print(f"Wrote {len(self.events)} trace events to {self.file}")
+
+
+class PrometheusSink:
+    """The totals are kept for every sink anyway, this one only writes them out on exit (e.g. for node_exporter's textfile collector)"""
+    def __init__(self, file: pathlib.Path | None = METRICS_PROMETHEUS_FILE):
+        self.file = file
+
+    def record(self, event: StageEvent):
+        pass
+
+    def close(self):
+        if self.file is not None and _totals:
+            self.file.parent.mkdir(exist_ok=True, parents=True)
+            self.file.write_text(render_prometheus(), encoding="UTF-8")
+
+
+SINKS = {
+    "log": LogSink,
+    "json": JsonTraceSink,
+    "prometheus": PrometheusSink,
+}
+
+_sinks: list = []
+_totals: dict[str, StageTotals] = {}
+_lock = threading.Lock()
+_torch_profiling = False
+
+
+def add_sink(sink):
+    """Any object with `record(event: StageEvent)` and `close()` methods"""
+    if not _sinks:
+        atexit.register(close)
+    _sinks.append(sink)
+
+
+def configure(names: list[str] = METRICS):
+    for name in names:
+        if name not in SINKS:
+            raise Exception(f'Unknown metrics sink "{name}", expected one of {tuple(SINKS)}')
+        add_sink(SINKS[name]())
+
+
+def enabled() -> bool:
+    return bool(_sinks)
+
+
+def close():
+    while _sinks:
+        _sinks.pop().close()
+
+
+class _Stage:
+    __slots__ = ("name", "items", "start", "wall_start", "cpu_start", "torch_range")
+
+    def __init__(self, name: str, items: int):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.torch_range = None
+        if _torch_profiling:
+            import torch
+            self.torch_range = torch.profiler.record_function(self.name)
+            self.torch_range.__enter__()
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        if self.torch_range is not None:
+            self.torch_range.__exit__(*exc_info)
+        record(StageEvent(self.name, self.start, wall, cpu, self.items, threading.get_ident()))
+
+
+def stage(name: str, items: int = 1):
+    """Context manager timing the code within it as one call of the stage `name`, processing `items` items"""
+    if not _sinks and not _torch_profiling:
+        return _NULL
+    return _Stage(name, items)
+
+
+def record(event: StageEvent):
+    with _lock:
+        stage_totals = _totals.setdefault(event.name, StageTotals())
+        stage_totals.calls += 1
+        stage_totals.items += event.items
+        stage_totals.wall += event.wall
+        stage_totals.cpu += event.cpu
+        stage_totals.max_wall = max(stage_totals.max_wall, event.wall)
+    for sink in _sinks:
+        sink.record(event)
+
+
+def totals() -> dict[str, StageTotals]:
+    with _lock:
+        return {name: dataclasses.replace(stage_totals) for name, stage_totals in _totals.items()}
+
+
+def render_prometheus() -> str:
+    metrics = [
+        ("kanji_stage_calls_total", "counter", "Number of times each stage ran", "calls"),
+        ("kanji_stage_items_total", "counter", "Number of items (images, points, queries) processed by each stage", "items"),
+        ("kanji_stage_seconds_total", "counter", "Wall time spent in each stage", "wall"),
+        ("kanji_stage_cpu_seconds_total", "counter", "Process CPU time spent in each stage", "cpu"),
+        ("kanji_stage_max_seconds", "gauge", "Longest wall time of a single call of each stage", "max_wall"),
+    ]
+    current = totals()
+    lines = []
+    for metric, kind, description, field in metrics:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, stage_totals in sorted(current.items()):
+            lines.append(f'{metric}{{stage="{name}"}} {getattr(stage_totals, field)}')
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def torch_profiler(name: str, folder: pathlib.Path | None = TORCH_PROFILE_FOLDER):
+    """Run the code within it under the torch profiler if `folder` is set, writing a Chrome trace there and printing a summary"""
+    global _torch_profiling
+    if folder is None:
+        yield
+        return
+
+    import torch
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    folder.mkdir(exist_ok=True, parents=True)
+    with torch.profiler.profile(activities=activities, record_shapes=True) as profiler:
+        _torch_profiling = True
+        try:
+            yield
+        finally:
+            _torch_profiling = False
+    trace_file = folder / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    profiler.export_chrome_trace(str(trace_file))
+    print(profiler.key_averages().table(sort_by="cpu_time_total", row_limit=15))
+    print(f"Wrote the torch profiler trace to {trace_file}")
+
+
+configure()
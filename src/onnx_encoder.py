@@ -0,0 +1,119 @@
+"""Run the ViT encoder through ONNX Runtime instead of PyTorch, optionally with int8 (dynamic) quantized weights
+
+Requires the optional `onnx` and `onnxruntime` packages (`onnxscript` too for recent versions of torch).
+"""
+import time
+import pathlib
+import itertools
+from PIL import Image
+import torch
+from transformers import ViTImageProcessor, ViTModel
+
+from config import (
+    GENERATED_IMAGES_FOLDER,
+    MODEL_IMAGE_SIZE,
+    ONNX_ENCODER_PATH,
+    ONNX_INT8_ENCODER_PATH,
+)
+
+ENGINES = ("torch", "onnx", "onnx-int8")
+
+
+class _PoolerOutput(torch.nn.Module):
+    """Only exports the output we actually use"""
+    def __init__(self, encoder: ViTModel):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.encoder(pixel_values)["pooler_output"]
+
+
+class OnnxEncoder:
+    """Drop-in replacement for the `ViTModel` as far as `get_embeddings` is concerned"""
+    device = torch.device("cpu")
+
+    def __init__(self, path: pathlib.Path):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # Same thread budget as torch, so that `torch.set_num_threads` (e.g. in `parallel_embeddings.py`) also applies here
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, pixel_values: torch.Tensor) -> dict[str, torch.Tensor]:
+        (pooler_output,) = self.session.run(["pooler_output"], {"pixel_values": pixel_values.numpy()})
+        return {"pooler_output": torch.from_numpy(pooler_output)}
+
+
+def load_onnx_encoder(engine: str) -> OnnxEncoder:
+    path = ONNX_INT8_ENCODER_PATH if engine == "onnx-int8" else ONNX_ENCODER_PATH
+    if not path.is_file():
+        raise Exception(f"Could not find the ONNX encoder at {path}, run `main.py export_encoder` first")
+    print(f"Loading ONNX encoder ({engine})")
+    return OnnxEncoder(path)
+
+
+def export_encoder(encoder: ViTModel, quantize: bool = True):
+    """Export the encoder to `ONNX_ENCODER_PATH`, and a dynamically quantized (int8 weights) copy to `ONNX_INT8_ENCODER_PATH`"""
+    encoder = encoder.cpu().eval()
+    dummy = torch.zeros(1, 3, MODEL_IMAGE_SIZE, MODEL_IMAGE_SIZE)
+    ONNX_ENCODER_PATH.parent.mkdir(exist_ok=True, parents=True)
+    print(f"Exporting the encoder to {ONNX_ENCODER_PATH}")
+    torch.onnx.export(
+        _PoolerOutput(encoder),
+        (dummy,),
+        str(ONNX_ENCODER_PATH),
+        input_names=["pixel_values"],
+        output_names=["pooler_output"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "pooler_output": {0: "batch"}},
+        opset_version=17,
+        dynamo=False,
+    )
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        print(f"Quantizing the encoder to {ONNX_INT8_ENCODER_PATH}")
+        quantize_dynamic(ONNX_ENCODER_PATH, ONNX_INT8_ENCODER_PATH, weight_type=QuantType.QInt8)
+
+
+def compare_engines(feature_extractor: ViTImageProcessor, encoder: ViTModel, batch_size: int = 16, repeats: int = 5):
+    """Print latency, throughput and the cosine similarity of the `pooler_output` of each engine against PyTorch"""
+    from encoder import preprocess_greyscale
+
+    encoder = encoder.cpu().eval()
+    image_files = list(itertools.islice(GENERATED_IMAGES_FOLDER.glob("*/*.png"), batch_size))
+    if len(image_files) == batch_size:
+        pixel_values = preprocess_greyscale(feature_extractor, [Image.open(file, "r").convert("L") for file in image_files])
+    else:
+        print("Not enough generated images, comparing the engines on random noise instead")
+        generator = torch.Generator().manual_seed(0)
+        pixel_values = torch.rand(batch_size, 1, MODEL_IMAGE_SIZE, MODEL_IMAGE_SIZE, generator=generator).expand(-1, 3, -1, -1) * 2 - 1
+
+    engines = {"torch": encoder}
+    for engine in ENGINES[1:]:
+        try:
+            engines[engine] = load_onnx_encoder(engine)
+        except Exception as e:
+            print(f"Skipping {engine}: {e}")
+
+    def run(model, inputs):
+        with torch.inference_mode():
+            return model(inputs)["pooler_output"]
+
+    reference = run(encoder, pixel_values)
+    print(f"{'engine':<12}{'latency (ms)':>14}{'images/s':>12}{'min cos':>10}{'mean cos':>10}")
+    for name, model in engines.items():
+        run(model, pixel_values[:1])  # Warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            run(model, pixel_values[:1])
+        latency = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            output = run(model, pixel_values)
+        throughput = batch_size * repeats / (time.perf_counter() - start)
+        cosine = torch.nn.functional.cosine_similarity(output, reference, dim=1)
+        print(f"{name:<12}{1000 * latency:>14.2f}{throughput:>12.1f}{cosine.min().item():>10.5f}{cosine.mean().item():>10.5f}")
@@ -0,0 +1,106 @@
+"""Data-parallel embedding generation over several processes, for `main.py generate_embeddings --workers N`
+
+The torch intra-op threads of a single encoder stop scaling after a few cores for ViT-base,
+so each worker process loads its own encoder and only gets `threads` of them (`torch.set_num_threads`).
+Workers pull `(font, labels)` shards from a shared queue, and each decodes the images of its next shards in a loader thread
+while its encoder runs on the current one. Only the parent process writes, so the embedding store and the manifest
+end up exactly as with a single process.
+"""
+import queue
+import threading
+import traceback
+import multiprocessing
+
+import numpy as np
+
+from config import (
+    GENERATED_IMAGES_FOLDER,
+    EXTRACTOR_MODEL_PATH,
+    ENCODER_MODEL_PATH,
+)
+
+# Decoded shards waiting for the encoder in each worker
+PREFETCH_SHARDS = 2
+
+_DONE = None
+# Seconds between two checks that the workers are still alive while waiting for their results
+_POLL_INTERVAL = 5
+
+
+def _load_images(font_name: str, labels: list[str]) -> list:
+    from PIL import Image
+
+    images = []
+    for kanji in labels:
+        image = Image.open(GENERATED_IMAGES_FOLDER / font_name / f"{kanji}.png", "r")
+        image.load()  # `Image.open` is lazy, decode now (PIL releases the GIL while decoding) rather than in the encoder's thread
+        images.append(image)
+    return images
+
+
+def _worker(tasks: multiprocessing.Queue, results: multiprocessing.Queue, threads: int):
+    import torch
+
+    torch.set_num_threads(threads)
+    try:
+        from encoder import load_model, get_embeddings
+        extractor, encoder = load_model()
+    except Exception:
+        results.put(("error", traceback.format_exc()))
+        return
+
+    loaded = queue.Queue(maxsize=PREFETCH_SHARDS)
+
+    def loader():
+        for font_name, labels in iter(tasks.get, _DONE):
+            try:
+                loaded.put((font_name, labels, _load_images(font_name, labels), None))
+            except Exception:
+                loaded.put((font_name, labels, None, traceback.format_exc()))
+        loaded.put(_DONE)
+
+    threading.Thread(target=loader, name="ImageLoader", daemon=True).start()
+    for font_name, labels, images, error in iter(loaded.get, _DONE):
+        if error is None:
+            try:
+                results.put(("ok", (font_name, labels, get_embeddings(extractor, encoder, images).numpy())))
+                continue
+            except Exception:
+                error = traceback.format_exc()
+        results.put(("error", f"Failed to embed a batch of font {font_name}:\n{error}"))
+
+
+def embed_shards(shards: list[tuple[str, list[str]]], workers: int, threads: int):
+    """Yields `(font_name, labels, embeddings)` for each `(font_name, labels)` shard, in completion order"""
+    if not EXTRACTOR_MODEL_PATH.is_dir() or not ENCODER_MODEL_PATH.is_dir():
+        # Download and save the model once, rather than every worker downloading it and writing to the same folder
+        from encoder import load_model
+        load_model()
+    # Forking a process that already uses torch threads can deadlock, every worker starts from a fresh interpreter instead
+    context = multiprocessing.get_context("spawn")
+    tasks, results = context.Queue(), context.Queue()
+    for shard in shards:
+        tasks.put(shard)
+    processes = [context.Process(target=_worker, args=(tasks, results, threads), daemon=True) for _ in range(workers)]
+    for process in processes:
+        tasks.put(_DONE)
+        process.start()
+    try:
+        for _ in shards:
+            while True:
+                try:
+                    status, value = results.get(timeout=_POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    if not any(process.is_alive() for process in processes):
+                        raise Exception("Every embedding worker exited before finishing (killed, or out of memory?)")
+            if status == "error":
+                raise Exception(f"An embedding worker failed:\n{value}")
+            font_name, labels, embeddings = value
+            yield font_name, labels, np.asarray(embeddings, dtype=np.float32)
+    finally:
+        for process in processes:
+            process.join(timeout=_POLL_INTERVAL)
+            if process.is_alive():
+                process.terminate()
+                process.join()
@@ -0,0 +1,166 @@
+"""Render -> embed -> upload in a single pass, without going through the disk in between
+
+Each stage runs in its own thread and they are connected by bounded queues,
+so drawing the next batch, running the encoder and uploading the previous batch overlap,
+while at most `BUILD_INDEX_QUEUE_SIZE` batches wait between any two stages.
+"""
+import queue
+import typing
+import threading
+import dataclasses
+
+if typing.TYPE_CHECKING:
+    # Only for type hints, `build_index` imports them itself so that importing this module stays cheap
+    import torch
+    from PIL import Image
+
+from config import (
+    GENERATED_IMAGES_FOLDER,
+    BUILD_INDEX_QUEUE_SIZE,
+    DATABASE_LOCATION,
+)
+
+BUILD_INDEX_BATCH_SIZE = 256
+
+_DONE = object()
+
+
+@dataclasses.dataclass
+class _Batch:
+    font_name: str
+    index: int
+    images: dict[str, "Image.Image"]
+    tensor: "torch.Tensor | None" = None
+
+
+def _run_stage(function, inputs: queue.Queue, outputs: queue.Queue | None, errors: list[Exception]):
+    for item in iter(inputs.get, _DONE):
+        if errors:
+            continue  # A stage failed, only keep draining so that the previous stages do not block
+        try:
+            result = function(item)
+        except Exception as e:
+            errors.append(e)
+            continue
+        if outputs is not None:
+            outputs.put(result)
+    if outputs is not None:
+        outputs.put(_DONE)
+
+
+def build_index(write_images: bool = False, write_embeddings: bool = False):
+    """Generate the images and embeddings for every font and upload them straight to Qdrant.
+    Optionally also writes the same files `generate_images` and `generate_embeddings` would.
+    Records what it wrote and uploaded in the manifest, and only processes the kanji still missing from it
+    (not uploaded yet, or without the image / embedding file asked for), so that neither a rerun nor the other commands redo it."""
+    from tqdm import tqdm
+    from embedding_store import EmbeddingStore
+    from generate_images import get_standard_kanji_set, load_kanji_list, list_font_files, list_fonts, generate_images_for_font
+    from encoder import load_model, get_embeddings
+    from database import create_connection, create_collection, index_collection, insert, delete_font
+    from manifest import Manifest, point_stage
+    from query_cache import clear_results
+
+    manifest = Manifest()
+    uploaded = point_stage(DATABASE_LOCATION, "kanji")
+    qdrant = create_connection()
+    if not qdrant.collection_exists("kanji"):
+        if not create_collection(qdrant):
+            raise Exception("Failed to create collection")
+        manifest.reset_all(uploaded)
+    extractor, encoder = load_model()
+
+    standard_kanji_set = get_standard_kanji_set()
+    fonts = list_fonts()
+    keys = {font_name: manifest.register_font(font_name, font_file) for font_name, font_file in list_font_files().items()}
+    # The stages record from different threads
+    manifest_lock = threading.Lock()
+
+    def record(font_name: str, stage: str, kanji_list: list[str]):
+        with manifest_lock:
+            manifest.mark(keys[font_name], stage, kanji_list)
+            manifest.save(force=False)
+
+    kanji_list = load_kanji_list()
+    print(f"Building the index for {len(kanji_list)} Kanji and the {len(fonts)} following fonts: {fonts.keys()}")
+    font_batches = {}
+    for font_name, key in keys.items():
+        if not manifest.get(key, uploaded):
+            # Points of an older version of the font (or uploaded without recording them) would be left behind otherwise
+            delete_font(qdrant, font_name)
+        missing = set(manifest.missing(key, uploaded, kanji_list))
+        if write_images:
+            missing.update(manifest.missing(key, "image", kanji_list))
+        if write_embeddings:
+            missing.update(manifest.missing(key, "embedding", kanji_list))
+        missing = manifest.missing(key, "unsupported", [kanji for kanji in kanji_list if kanji in missing])
+        print(f"Found {len(missing)} Kanji to process for font {font_name}")
+        font_batches[font_name] = [missing[i : i + BUILD_INDEX_BATCH_SIZE] for i in range(0, len(missing), BUILD_INDEX_BATCH_SIZE)]
+
+    store = EmbeddingStore() if write_embeddings else None
+    # Added to the store but not in its saved index yet, only recorded in the manifest once it is
+    pending = []
+
+    def save_embeddings():
+        store.flush()
+        for font_name, labels in pending:
+            record(font_name, "embedding", labels)
+        pending.clear()
+
+    def embed(batch: _Batch) -> _Batch:
+        batch.tensor = get_embeddings(extractor, encoder, list(batch.images.values()))
+        if write_embeddings:
+            if pending and pending[-1][0] != batch.font_name:
+                save_embeddings()  # Once per font
+            store.add(batch.font_name, list(batch.images), batch.tensor)
+            pending.append((batch.font_name, list(batch.images)))
+        return batch
+
+    progress = tqdm(total=sum(map(len, font_batches.values())), unit="batch")
+
+    def upload(batch: _Batch):
+        insert(qdrant, batch.font_name, dict(zip(batch.images, batch.tensor)), standard_kanji_set)
+        record(batch.font_name, uploaded, list(batch.images))
+        progress.update()
+
+    errors = []
+    to_embed = queue.Queue(maxsize=BUILD_INDEX_QUEUE_SIZE)
+    to_upload = queue.Queue(maxsize=BUILD_INDEX_QUEUE_SIZE)
+    threads = [
+        threading.Thread(target=_run_stage, args=(embed, to_embed, to_upload, errors), name="embed"),
+        threading.Thread(target=_run_stage, args=(upload, to_upload, None, errors), name="upload"),
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Render in the current thread
+    try:
+        for font_name, font in fonts.items():
+            if write_images:
+                (GENERATED_IMAGES_FOLDER / font_name).mkdir(exist_ok=True, parents=True)
+            for i, kanji_batch in enumerate(font_batches[font_name]):
+                if errors:
+                    break
+                images = generate_images_for_font(font, kanji_batch)
+                record(font_name, "unsupported", [kanji for kanji in kanji_batch if kanji not in images])
+                if write_images:
+                    for kanji, img in images.items():
+                        img.save(GENERATED_IMAGES_FOLDER / font_name / f"{kanji}.png")
+                    record(font_name, "image", list(images))
+                if images:
+                    to_embed.put(_Batch(font_name, i, images))
+                else:
+                    progress.update()
+    finally:
+        to_embed.put(_DONE)
+        for thread in threads:
+            thread.join()
+        progress.close()
+        if write_embeddings:
+            save_embeddings()
+        manifest.save()
+        clear_results()
+
+    if errors:
+        raise errors[0]
+    index_collection(qdrant)
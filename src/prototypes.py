@@ -0,0 +1,73 @@
+"""Per kanji prototypes: a few vectors summarizing the embeddings of a kanji over every font, for a first search pass
+
+With one point per (font, kanji), the search cost grows linearly with the number of fonts, even though only the kanji matter to the user.
+The prototypes of a kanji are either the normalized mean of its fonts' embeddings (`centroids=1`),
+or the centroids of a spherical k-means over them, for kanji whose fonts draw them in noticeably different styles.
+The search picks the best `limit * PROTOTYPE_CANDIDATE_OVERSAMPLING` kanji by their best prototype first,
+then reranks only the fonts of those kanji with their own embeddings, which also gives the best matching font of each kanji
+(see `MatrixIndex` and `database.search_vector`).
+
+The in-process index computes them when loaded, `main.py build_prototypes` uploads them to their own Qdrant collection.
+"""
+import numpy as np
+
+# Kanji whose members are gathered at once while fitting
+_CHUNK_SIZE = 4096
+# Spherical k-means iterations, the few fonts of each kanji converge in a handful of them
+_ITERATIONS = 10
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def member_table(group_ids: np.ndarray) -> np.ndarray:
+    """`(groups, largest group)` row numbers of the members of each group, padded with -1"""
+    if len(group_ids) == 0:
+        return np.empty((0, 0), dtype=np.int64)
+    counts = np.bincount(group_ids)
+    order = np.argsort(group_ids, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    table = np.full((len(counts), counts.max(initial=1)), -1, dtype=np.int64)
+    table[group_ids[order], np.arange(len(order)) - np.repeat(starts, counts)] = order
+    return table
+
+
+def _spherical_kmeans(points: np.ndarray, valid: np.ndarray, centroids: int, iterations: int) -> np.ndarray:
+    """`(groups, members, D)` normalized points (zeros where not `valid`) -> `(groups, centroids, D)`, for every group at once"""
+    groups = np.arange(len(points))
+    # Farthest point initialization: the first member, then each time the member least similar to the centroids so far.
+    # Groups with fewer members than centroids end up with duplicated centroids, which does not change their best score
+    chosen = [np.zeros(len(points), dtype=np.int64)]
+    closest = np.einsum("gmd,gd->gm", points, points[groups, 0])
+    for _ in range(1, centroids):
+        chosen.append(np.argmin(np.where(valid, closest, np.inf), axis=1))
+        closest = np.maximum(closest, np.einsum("gmd,gd->gm", points, points[groups, chosen[-1]]))
+    means = points[groups[:, None], np.stack(chosen, axis=1)]
+
+    for _ in range(iterations):
+        assignment = np.einsum("gmd,gkd->gmk", points, means).argmax(axis=2)
+        one_hot = (assignment[..., None] == np.arange(centroids)) & valid[..., None]
+        sums = np.einsum("gmk,gmd->gkd", one_hot.astype(np.float32), points)
+        # Empty clusters keep their previous centroid
+        means = np.where(one_hot.any(axis=1)[..., None], _normalize(sums), means)
+    return means
+
+
+def fit_prototypes(vectors: np.ndarray, group_ids: np.ndarray, centroids: int = 1, iterations: int = _ITERATIONS) -> np.ndarray:
+    """`(groups, centroids, D)` normalized prototypes of each group (kanji) of rows of `vectors`, `group_ids[i]` being the group of row `i`"""
+    if centroids < 1:
+        raise Exception(f"Expected at least one prototype per kanji, got {centroids}")
+    table = member_table(np.asarray(group_ids))
+    prototypes = np.empty((len(table), centroids, vectors.shape[1]), dtype=np.float32)
+    for start in range(0, len(table), _CHUNK_SIZE):
+        members = table[start : start + _CHUNK_SIZE]
+        valid = members >= 0
+        # Gathered from the (possibly memory-mapped) vectors one chunk of kanji at a time
+        points = _normalize(np.asarray(vectors[np.maximum(members, 0).ravel()], dtype=np.float32)).reshape(*members.shape, -1)
+        points *= valid[..., None]
+        if centroids == 1:
+            prototypes[start : start + len(members), 0] = _normalize(points.sum(axis=1))
+        else:
+            prototypes[start : start + len(members)] = _spherical_kmeans(points, valid, centroids, iterations)
+    return prototypes
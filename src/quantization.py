@@ -0,0 +1,80 @@
+"""Compact encodings for the embeddings: float16, scalar int8 and 1-bit sign codes
+
+Only depends on numpy so that it can also be used by the standalone scripts under `dataset/`
+"""
+import numpy as np
+
+QUANTIZATION_MODES = ("float16", "int8", "binary")
+
+# Number of rows scored at once, bounds the size of the temporary float32 copies
+_CHUNK_SIZE = 16384
+
+# Number of bits set for each possible byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def check_mode(mode: str | None):
+    if mode is not None and mode not in QUANTIZATION_MODES:
+        raise Exception(f'Unknown quantization "{mode}", expected one of {QUANTIZATION_MODES} or None')
+
+
+def fit_scale(vectors: np.ndarray) -> np.ndarray:
+    """Per-dimension scale for the int8 codes, mapping the largest absolute value of each dimension to 127"""
+    return (np.maximum(np.abs(vectors).max(axis=0), 1e-12) / 127).astype(np.float32)
+
+
+def quantize(vectors: np.ndarray, mode: str, scale: np.ndarray | None = None) -> np.ndarray:
+    """Encode a `(N, D)` float matrix. `scale` is only used by (and required for) the `int8` mode"""
+    check_mode(mode)
+    if mode == "float16":
+        return vectors.astype(np.float16)
+    if mode == "int8":
+        return np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+    # binary: one bit per dimension, set if the value is positive, 8 dimensions per byte
+    return np.packbits(vectors > 0, axis=-1)
+
+
+def dequantize(codes: np.ndarray, mode: str, scale: np.ndarray | None = None, dimensions: int | None = None) -> np.ndarray:
+    """Approximately reverses `quantize`. Binary codes are decoded into -1 / +1 values"""
+    check_mode(mode)
+    if mode == "float16":
+        return codes.astype(np.float32)
+    if mode == "int8":
+        return codes.astype(np.float32) * scale
+    bits = np.unpackbits(codes, axis=-1, count=dimensions)
+    return bits.astype(np.float32) * 2 - 1
+
+
+def approximate_scores(queries: np.ndarray, codes: np.ndarray, mode: str, scale: np.ndarray | None = None) -> np.ndarray:
+    """Scores `(Q, D)` normalized float32 queries against `(N, ...)` codes of normalized vectors, returns a `(Q, N)` matrix.
+
+    The float16 and int8 scores approximate the cosine similarity,
+    the binary score is `1 - 2 * hamming / D` over the sign bits (the cosine similarity between the ±1 vectors).
+    """
+    check_mode(mode)
+    out = np.empty((len(queries), len(codes)), dtype=np.float32)
+    if mode == "binary":
+        dimensions = queries.shape[1]
+        query_bits = np.packbits(queries > 0, axis=-1)
+        # The XOR materializes (Q, chunk, D / 8) bytes, so use smaller chunks for large batches of queries
+        chunk_size = max(256, _CHUNK_SIZE // len(queries))
+        for start in range(0, len(codes), chunk_size):
+            chunk = codes[start : start + chunk_size]
+            hamming = _POPCOUNT[query_bits[:, None, :] ^ chunk[None, :, :]].sum(axis=-1, dtype=np.int32)
+            out[:, start : start + len(chunk)] = 1 - 2 * hamming / dimensions
+        return out
+
+    if mode == "int8":
+        # Asymmetric: the query stays in full precision, only the stored vectors are quantized
+        queries = queries * scale
+    for start in range(0, len(codes), _CHUNK_SIZE):
+        chunk = codes[start : start + _CHUNK_SIZE]
+        out[:, start : start + len(chunk)] = queries @ chunk.astype(np.float32).T
+    return out
+
+
+def recall_at_k(approximate_ids: np.ndarray, exact_ids: np.ndarray) -> float:
+    """Fraction of the exact top-k ids found by the approximate top-k, averaged over the queries"""
+    k = exact_ids.shape[1]
+    found = sum(len(set(a[:k]) & set(e)) for a, e in zip(approximate_ids, exact_ids))
+    return found / (len(exact_ids) * k)
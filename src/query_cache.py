@@ -0,0 +1,207 @@
+"""Two-tier cache for searches: image -> embedding, then (calibrated) query vector + limit -> results
+
+Both tiers are bounded LRU caches with an optional time to live, and can be backed by an sqlite file to survive restarts.
+Each tier has a namespace made of fingerprints of whatever affects its values (model, collection),
+entries from any other namespace are discarded, so changing any of them invalidates the cache.
+The calibration does not need to be part of it, since the results are keyed by the already calibrated query vector.
+"""
+import time
+import pickle
+import hashlib
+import pathlib
+import sqlite3
+import threading
+import typing
+import collections
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    import torch  # Only for type hints, importing it takes a while
+    from PIL import Image
+    from transformers import ViTImageProcessor
+
+from config import (
+    MODEL,
+    ENCODER_ENGINE,
+    ENCODER_MODEL_PATH,
+    ONNX_ENCODER_PATH,
+    ONNX_INT8_ENCODER_PATH,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    QUERY_CACHE_FILE,
+)
+
+_MISSING = object()
+
+
+def _path_fingerprint(path: pathlib.Path) -> str:
+    """Changes whenever the file (or any file in the folder) is modified"""
+    if path.is_dir():
+        files = [file for file in path.rglob("*") if file.is_file()]
+    elif path.is_file():
+        files = [path]
+    else:
+        return "missing"
+    return ":".join(f"{file.stat().st_mtime_ns}-{file.stat().st_size}" for file in sorted(files))
+
+
+def model_fingerprint() -> str:
+    weights = {"torch": ENCODER_MODEL_PATH, "onnx": ONNX_ENCODER_PATH, "onnx-int8": ONNX_INT8_ENCODER_PATH}[ENCODER_ENGINE]
+    return f"{MODEL}/{ENCODER_ENGINE}/{_path_fingerprint(weights)}"
+
+
+def _digest(*parts: bytes) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def image_key(pixels: np.ndarray) -> str:
+    """Canonical key of a preprocessed (greyscale, resized) uint8 image"""
+    return _digest(str(pixels.shape).encode(), np.ascontiguousarray(pixels, dtype=np.uint8).tobytes())
+
+
+def canonicalize(feature_extractor: "ViTImageProcessor", image: "Image.Image") -> tuple["Image.Image", str]:
+    """Converts the image to greyscale at the model's size (as `get_embeddings` would) and returns it along with its cache key"""
+    size = (feature_extractor.size["width"], feature_extractor.size["height"])
+    image = image.convert("L")
+    if image.size != size:
+        image = image.resize(size, feature_extractor.resample)
+    return image, image_key(np.asarray(image))
+
+
+def query_key(vector: np.ndarray, limit: int, **options) -> str:
+    return _digest(np.ascontiguousarray(vector, dtype=np.float32).tobytes(), repr((limit, sorted(options.items()))).encode())
+
+
+def clear_results(file: pathlib.Path | None = QUERY_CACHE_FILE):
+    """Drop every cached search result, for the commands that change the collection"""
+    if file is None or not file.is_file():
+        return
+    with sqlite3.connect(file) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, namespace TEXT, created REAL, value BLOB)")
+        db.execute("DELETE FROM results")
+    db.close()
+
+
+class LRUCache:
+    """Thread-safe LRU cache with an optional time to live (in seconds) and an optional sqlite backed second tier"""
+    def __init__(self, name: str, namespace: str, maxsize: int = QUERY_CACHE_SIZE, ttl: float | None = QUERY_CACHE_TTL, file: pathlib.Path | None = QUERY_CACHE_FILE):
+        self.name = name
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: collections.OrderedDict[str, tuple[float, object]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if file is not None:
+            file.parent.mkdir(exist_ok=True, parents=True)
+            self._db = sqlite3.connect(file, check_same_thread=False)
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY, namespace TEXT, created REAL, value BLOB)")
+            self._db.execute(f"DELETE FROM {name} WHERE namespace != ?", (namespace,))
+            self._db.commit()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(f"SELECT created, value FROM {self.name} WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    value = pickle.loads(row[1])
+                    self._store(key, row[0], value)
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return default
+
+    def put(self, key: str, value):
+        created = time.time()
+        with self._lock:
+            self._store(key, created, value)
+            if self._db is not None:
+                self._db.execute(
+                    f"INSERT OR REPLACE INTO {self.name} (key, namespace, created, value) VALUES (?, ?, ?, ?)",
+                    (key, self.namespace, created, pickle.dumps(value)),
+                )
+                self._db.commit()
+
+    def _store(self, key: str, created: float, value):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
+
+
+class QueryCache:
+    def __init__(self, collection_fingerprint: str, maxsize: int = QUERY_CACHE_SIZE, ttl: float | None = QUERY_CACHE_TTL, file: pathlib.Path | None = QUERY_CACHE_FILE):
+        model = model_fingerprint()
+        self.embeddings = LRUCache("embeddings", model, maxsize, ttl, file)
+        self.results = LRUCache("results", f"{model}|{collection_fingerprint}", maxsize, ttl, file)
+
+    def get_embeddings(self, feature_extractor: "ViTImageProcessor", encoder, images: list["Image.Image"]) -> "torch.Tensor":
+        """Same as `encoder.get_embeddings`, but only runs the model for the images that are not cached"""
+        import torch
+        from encoder import get_embeddings
+
+        canonical, keys = zip(*(canonicalize(feature_extractor, image) for image in images))
+
+        rows = [self.embeddings.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            tensor = get_embeddings(feature_extractor, encoder, [canonical[i] for i in missing])
+            for i, row in zip(missing, tensor):
+                # A row is a view of the whole batch, which pickling would write out in full for every row
+                rows[i] = row.clone()
+                self.embeddings.put(keys[i], rows[i])
+        return torch.stack(rows)
+
+    def get_results(self, vector, limit: int, search, **options) -> list:
+        """Returns the cached results for the query, or calls `search()` and caches what it returns"""
+        key = query_key(np.asarray(vector), limit, **options)
+        results = self.results.get(key, _MISSING)
+        if results is _MISSING:
+            results = search()
+            self.results.put(key, results)
+        return results
+
+    async def get_results_async(self, vector, limit: int, search, **options) -> list:
+        """Same as `get_results`, with `search` being a coroutine function"""
+        key = query_key(np.asarray(vector), limit, **options)
+        results = self.results.get(key, _MISSING)
+        if results is _MISSING:
+            results = await search()
+            self.results.put(key, results)
+        return results
+
+    def get_results_batch(self, vectors, limit: int, search_batch, **options) -> list[list]:
+        """Returns the results of each query, calling `search_batch(vectors)` once with only the queries that are not cached"""
+        vectors = np.asarray(vectors)
+        keys = [query_key(vector, limit, **options) for vector in vectors]
+        results = [self.results.get(key, _MISSING) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is _MISSING]
+        if missing:
+            for i, result in zip(missing, search_batch(vectors[missing])):
+                results[i] = result
+                self.results.put(keys[i], result)
+        return results
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
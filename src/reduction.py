@@ -0,0 +1,127 @@
+"""PCA projection of the embeddings onto fewer dimensions, for a cheaper first search pass
+
+The glyph embeddings mostly vary along far fewer directions than the 768 of `pooler_output`,
+so the search can first pick `limit * REDUCTION_RERANK_OVERSAMPLING` candidates using the projected vectors,
+then rerank only those with the full vectors (see `MatrixIndex` and `database.search_vector`).
+
+`main.py fit_reduction` fits the projection on the generated embeddings (or the parquet dataset) and saves it under `REDUCTION_FOLDER`,
+`main.py reduction_report` compares the recall and latency of several dimensions against the full search.
+The artifact records the format version and model it was fitted for, and refuses to load for another.
+"""
+import json
+import time
+import pathlib
+import dataclasses
+import numpy as np
+
+from config import (
+    MODEL,
+    MODEL_EMBEDDING_SIZE,
+    REDUCED_DIMENSIONS,
+    REDUCTION_WHITEN,
+    REDUCTION_FOLDER,
+)
+
+# Increase whenever the artifact format or the way it is fitted changes
+REDUCTION_VERSION = 1
+
+# Number of rows accumulated into the covariance at once
+_CHUNK_SIZE = 16384
+
+
+@dataclasses.dataclass
+class Projection:
+    mean: np.ndarray  # (MODEL_EMBEDDING_SIZE,)
+    components: np.ndarray  # (dimensions, MODEL_EMBEDDING_SIZE), by decreasing variance
+    variance: np.ndarray  # (dimensions,) variance along each component
+    whiten: bool
+    metadata: dict
+
+    @property
+    def dimensions(self) -> int:
+        return len(self.components)
+
+    def project(self, vectors: np.ndarray) -> np.ndarray:
+        """`(N, MODEL_EMBEDDING_SIZE)` -> `(N, dimensions)` float32, the vectors get L2-normalized first like when fitting"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+        projected = (vectors - self.mean) @ self.components.T
+        if self.whiten:
+            projected /= np.sqrt(np.maximum(self.variance, 1e-12))
+        return projected
+
+    def save(self, path: pathlib.Path):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        temporary = path.with_suffix(".tmp.npz")
+        np.savez(
+            temporary,
+            mean=self.mean,
+            components=self.components,
+            variance=self.variance,
+            whiten=self.whiten,
+            metadata=json.dumps(self.metadata),
+        )
+        temporary.replace(path)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "Projection":
+        with np.load(path) as data:
+            metadata = json.loads(str(data["metadata"]))
+            if metadata.get("version") != REDUCTION_VERSION or metadata.get("model") != MODEL:
+                raise Exception(
+                    f"{path} was fitted for {metadata.get('model')} (version {metadata.get('version')}), "
+                    f"expected {MODEL} (version {REDUCTION_VERSION}), run `main.py fit_reduction` again"
+                )
+            return cls(data["mean"], data["components"], data["variance"], bool(data["whiten"]), metadata)
+
+
+def fit_projection(vectors: np.ndarray, dimensions: int, whiten: bool = REDUCTION_WHITEN) -> Projection:
+    """PCA over the L2-normalized rows of `vectors` (the searches use the cosine similarity), keeping the top `dimensions` components"""
+    if not 0 < dimensions <= MODEL_EMBEDDING_SIZE:
+        raise Exception(f"Cannot reduce to {dimensions} dimensions, expected between 1 and {MODEL_EMBEDDING_SIZE}")
+    count = len(vectors)
+    total = np.zeros(MODEL_EMBEDDING_SIZE, dtype=np.float64)
+    products = np.zeros((MODEL_EMBEDDING_SIZE, MODEL_EMBEDDING_SIZE), dtype=np.float64)
+    # Accumulated by chunks, so that fitting on the memory-mapped embeddings never loads all of them at once
+    for start in range(0, count, _CHUNK_SIZE):
+        chunk = np.asarray(vectors[start : start + _CHUNK_SIZE], dtype=np.float64)
+        chunk /= np.maximum(np.linalg.norm(chunk, axis=1, keepdims=True), 1e-12)
+        total += chunk.sum(axis=0)
+        products += chunk.T @ chunk
+    mean = total / count
+    covariance = products / count - np.outer(mean, mean)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)  # Ascending order
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues = np.maximum(eigenvalues[order], 0)
+    kept = order[:dimensions]
+    metadata = {
+        "version": REDUCTION_VERSION,
+        "model": MODEL,
+        "dimensions": dimensions,
+        "whiten": whiten,
+        "fitted_on": count,
+        "explained_variance": float(eigenvalues[:dimensions].sum() / max(eigenvalues.sum(), 1e-12)),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    return Projection(
+        mean=mean.astype(np.float32),
+        components=np.ascontiguousarray(eigenvectors[:, kept].T, dtype=np.float32),
+        variance=eigenvalues[:dimensions].astype(np.float32),
+        whiten=whiten,
+        metadata=metadata,
+    )
+
+
+def projection_path(dimensions: int, whiten: bool = REDUCTION_WHITEN) -> pathlib.Path:
+    return REDUCTION_FOLDER / f"pca_{dimensions}{'_whiten' if whiten else ''}.npz"
+
+
+def load_projection(dimensions: int | None = REDUCED_DIMENSIONS, whiten: bool = REDUCTION_WHITEN) -> Projection | None:
+    """The projection configured in `config.py`, None if the reduced first pass is disabled"""
+    if dimensions is None:
+        return None
+    path = projection_path(dimensions, whiten)
+    if not path.is_file():
+        raise Exception(f"Could not find the projection to {dimensions} dimensions at {path}, run `main.py fit_reduction --dimensions {dimensions}` first")
+    return Projection.load(path)
@@ -0,0 +1,25 @@
+import dataclasses
+
+@dataclasses.dataclass(frozen=True)
+class SearchFilter:
+    """Restricts a search to some of the points, based on their payload (see `database.insert`)
+
+    In Qdrant, every field used here has a payload index (see `database.create_payload_indexes`),
+    so filtered searches go through the same HNSW graph instead of falling back to scanning the matches.
+    """
+    standard_only: bool = False
+    fonts: tuple[str, ...] | None = None  # Only these fonts, None for every font
+    exclude_fonts: tuple[str, ...] = ()
+
+    @classmethod
+    def create(cls, standard_only: bool = False, fonts: list[str] | None = None, exclude_fonts: list[str] | None = None) -> "SearchFilter | None":
+        """Returns None if nothing would be filtered out"""
+        search_filter = cls(standard_only, tuple(fonts) if fonts else None, tuple(exclude_fonts or ()))
+        return search_filter if search_filter != cls() else None
+
+    def matches(self, payload: dict) -> bool:
+        if self.standard_only and not payload["is_standard"]:
+            return False
+        if self.fonts is not None and payload["font"] not in self.fonts:
+            return False
+        return payload["font"] not in self.exclude_fonts
@@ -0,0 +1,316 @@
+"""Long-lived search service, keeps the model and the database connection loaded between queries
+
+Endpoints:
+- `GET /health`: The process is up (even while still loading the model)
+- `GET /ready`: 200 once the model and the search backend are loaded, 503 before that
+- `GET /stats`: Hits and misses of the query cache, number of batches and images encoded
+- `GET /metrics`: Time spent in each stage, in the Prometheus text format (requires `KANJI_METRICS` to be set, see `metrics.py`)
+- `POST /search?limit=50&profile=default` (`limit` at most `SERVER_MAX_LIMIT`): The body is an image file (e.g. PNG) of a single drawn character,
+    or its strokes as JSON (see `strokes.py`), rasterized directly at the model's size
+    responds with a JSON list of `SearchResult`, best match first, calibrated with the given profile (see `calibration.py`)
+    Optionally `&distinct=1` to only get the best font of each kanji, `&standard_only=1`,
+    and `&font=...` / `&exclude_font=...` (repeated for multiple fonts) to filter the results (see `search_filter.py`)
+- `POST /calibrate?profile=default&kanji=猫`: The body is a drawing of the kanji, confirmed by the user,
+    adds it to the calibration profile (created if needed) and responds with the number of drawings in it
+"""
+import io
+import json
+import typing
+import signal
+import asyncio
+import dataclasses
+from urllib.parse import urlsplit, parse_qs
+
+if typing.TYPE_CHECKING:
+    from search_filter import SearchFilter
+
+from config import (
+    SERVER_HOST,
+    SERVER_PORT,
+    SERVER_MAX_LIMIT,
+    SERVER_READ_TIMEOUT,
+    DEFAULT_CALIBRATION_PROFILE,
+)
+
+MAX_BODY_SIZE = 10 * 1024 * 1024
+SHUTDOWN_TIMEOUT = 30
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 408: "Request Timeout", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class SearchService:
+    """Holds everything needed to answer a query, loaded once by `load`"""
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.batching_encoder = None
+        self.backend = None
+        self.async_backend = None
+        self.profiles = None
+        self.store = None
+        self.cache = None
+
+    def _load(self):
+        from encoder import load_model
+        from database import create_search_backend, collection_fingerprint
+        from batching import BatchingEncoder
+        from calibration import CalibrationProfiles
+        from embedding_store import EmbeddingStore
+        from query_cache import QueryCache
+
+        self.backend = create_search_backend()
+        # Concurrent requests get encoded together instead of one forward pass each
+        self.batching_encoder = BatchingEncoder(*load_model())
+        self.profiles = CalibrationProfiles()
+        self.store = EmbeddingStore()  # Reference embeddings for the calibration, if they were generated locally
+        self.cache = QueryCache(collection_fingerprint(self.backend))
+
+    async def load(self):
+        try:
+            await asyncio.to_thread(self._load)
+            from matrix_index import MatrixIndex
+            if not isinstance(self.backend, MatrixIndex):
+                from database import create_async_connection
+                # Created within the event loop, the searches then go through its pool of connections instead of a thread each
+                self.async_backend = create_async_connection()
+        except Exception as e:
+            print(f"Failed to load the search service, it will never be ready: {e!r}")
+            raise
+        self.ready.set()
+        print("Search service ready")
+
+    async def close(self):
+        if self.batching_encoder is not None:
+            self.batching_encoder.close()
+        if self.async_backend is not None:
+            await self.async_backend.close()
+        if self.profiles is not None:
+            self.profiles.save()
+
+    def _open_image(self, image_bytes: bytes):
+        """Returns the image as the model will see it and its cache key"""
+        from PIL import Image, UnidentifiedImageError
+        from query_cache import canonicalize
+        from metrics import stage
+        from strokes import is_strokes, load_strokes
+
+        if is_strokes(image_bytes):
+            try:
+                with stage("server.rasterize_strokes"):
+                    image = load_strokes(image_bytes)
+            except Exception as error:
+                raise HTTPError(400, f"Invalid strokes: {error}")
+            return canonicalize(self.batching_encoder.feature_extractor, image)
+        try:
+            with stage("server.decode_image"):
+                image = Image.open(io.BytesIO(image_bytes), "r")
+                return canonicalize(self.batching_encoder.feature_extractor, image)
+        except UnidentifiedImageError:
+            raise HTTPError(400, "The request body is not a valid image")
+
+    async def _search_vector(self, vector, limit: int, profile: str, search_filter: "SearchFilter | None", distinct: bool) -> list[dict]:
+        from database import search_vector, search_vector_async, format_search_results
+
+        async def search():
+            if self.async_backend is not None:
+                hits = await search_vector_async(self.async_backend, query, limit=limit, search_filter=search_filter, group_by_kanji=distinct)
+            else:
+                hits = await asyncio.to_thread(search_vector, self.backend, query, limit, search_filter, distinct)
+            return [
+                {**dataclasses.asdict(result), "image_path": str(result.image_path)}
+                for result in format_search_results(hits)
+            ]
+
+        query = self.profiles.apply(vector[None], [profile])[0]
+        # Not the same values as `main.py search` caches
+        return await self.cache.get_results_async(query, limit, search, output="json", search_filter=search_filter, group_by_kanji=distinct)
+
+    async def _embed(self, image_bytes: bytes):
+        from metrics import stage
+
+        image, key = await asyncio.to_thread(self._open_image, image_bytes)
+        vector = self.cache.embeddings.get(key)
+        if vector is None:
+            with stage("server.embed"):
+                vector = await self.batching_encoder.embed_async(image)
+            self.cache.embeddings.put(key, vector)
+        return vector
+
+    async def search(self, image_bytes: bytes, limit: int, profile: str, search_filter: "SearchFilter | None" = None, distinct: bool = False) -> list[dict]:
+        from metrics import stage
+
+        with stage("server.search"):
+            vector = await self._embed(image_bytes)
+            return await self._search_vector(vector, limit, profile, search_filter, distinct)
+
+    def _calibrate(self, vector, kanji: str, profile: str) -> int:
+        import numpy as np
+        from calibration import reference_embedding
+
+        user_embedding = np.asarray(vector, dtype=np.float32)
+        try:
+            reference = reference_embedding(kanji, user_embedding, self.store, self.backend)
+        except Exception as e:
+            raise HTTPError(404, str(e))
+        count = self.profiles.update(profile, user_embedding - reference)
+        self.profiles.save(force=False)
+        return count
+
+    async def calibrate(self, image_bytes: bytes, kanji: str, profile: str) -> dict:
+        vector = await self._embed(image_bytes)
+        count = await asyncio.to_thread(self._calibrate, vector, kanji, profile)
+        return {"profile": profile, "drawings": count}
+
+    def stats(self) -> dict:
+        return {
+            "cache": self.cache.stats(),
+            "batches": self.batching_encoder.batches_count,
+            "images": self.batching_encoder.images_count,
+        }
+
+
+async def _read_request(reader: asyncio.StreamReader) -> tuple[str, str, bytes]:
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    if not request_line:
+        raise ConnectionResetError
+    try:
+        method, target, _version = request_line.split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "Content-Length must be an integer")
+    if length < 0:
+        raise HTTPError(400, "Content-Length must not be negative")
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413, f"The request body must be at most {MAX_BODY_SIZE} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, body
+
+
+async def _write_response(writer: asyncio.StreamWriter, status: int, content):
+    if isinstance(content, str):  # Already formatted, e.g. `/metrics`
+        body, content_type = content.encode("UTF-8"), "text/plain; version=0.0.4; charset=utf-8"
+    else:
+        body, content_type = json.dumps(content, ensure_ascii=False).encode("UTF-8"), "application/json; charset=utf-8"
+    writer.write(
+        f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+
+
+def _flag(query: dict[str, list[str]], name: str) -> bool:
+    return query.get(name, ["0"])[0].lower() in ("1", "true", "yes")
+
+
+async def _route(service: SearchService, method: str, target: str, body: bytes) -> tuple[int, object]:
+    url = urlsplit(target)
+    if url.path == "/health":
+        return 200, {"status": "ok"}
+    if url.path == "/ready":
+        if service.ready.is_set():
+            return 200, {"status": "ready"}
+        return 503, {"status": "loading"}
+    if url.path == "/stats":
+        if not service.ready.is_set():
+            raise HTTPError(503, "The model is still loading")
+        return 200, service.stats()
+    if url.path == "/metrics":
+        import metrics
+        if not metrics.enabled():
+            raise HTTPError(404, "Metrics are disabled, set KANJI_METRICS (e.g. to `prometheus`)")
+        return 200, metrics.render_prometheus()
+    if url.path == "/search":
+        if method != "POST":
+            raise HTTPError(405, "Use POST with the image as the request body")
+        if not service.ready.is_set():
+            raise HTTPError(503, "The model is still loading")
+        if not body:
+            raise HTTPError(400, "Missing image or strokes in the request body")
+        query = parse_qs(url.query)
+        try:
+            limit = int(query.get("limit", ["50"])[0])
+        except ValueError:
+            raise HTTPError(400, "`limit` must be an integer")
+        if not 1 <= limit <= SERVER_MAX_LIMIT:
+            raise HTTPError(400, f"`limit` must be between 1 and {SERVER_MAX_LIMIT}")
+        from search_filter import SearchFilter
+        search_filter = SearchFilter.create(_flag(query, "standard_only"), query.get("font"), query.get("exclude_font"))
+        profile = query.get("profile", [DEFAULT_CALIBRATION_PROFILE])[0]
+        return 200, await service.search(body, limit, profile, search_filter, _flag(query, "distinct"))
+    if url.path == "/calibrate":
+        if method != "POST":
+            raise HTTPError(405, "Use POST with the drawing as the request body")
+        if not service.ready.is_set():
+            raise HTTPError(503, "The model is still loading")
+        query = parse_qs(url.query)
+        if not body or "kanji" not in query:
+            raise HTTPError(400, "Missing drawing in the request body or `kanji` parameter")
+        return 200, await service.calibrate(body, query["kanji"][0], query.get("profile", [DEFAULT_CALIBRATION_PROFILE])[0])
+    raise HTTPError(404, f"Unknown path {url.path}")
+
+
+async def serve(host: str = SERVER_HOST, port: int = SERVER_PORT):
+    service = SearchService()
+    in_flight: set[asyncio.Task] = set()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        in_flight.add(asyncio.current_task())
+        try:
+            try:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader), SERVER_READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise HTTPError(408, f"The request must be sent within {SERVER_READ_TIMEOUT} seconds")
+                status, content = await _route(service, *request)
+            except HTTPError as e:
+                status, content = e.status, {"error": str(e)}
+            except (ConnectionResetError, asyncio.IncompleteReadError):
+                return
+            except Exception as e:
+                print(f"Error while handling a request: {e!r}")
+                status, content = 500, {"error": "Internal server error"}
+            await _write_response(writer, status, content)
+        finally:
+            in_flight.discard(asyncio.current_task())
+            writer.close()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass  # Windows, Ctrl+C still interrupts it, just not as gracefully
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Listening on http://{host}:{port}")
+    loading = asyncio.create_task(service.load())
+
+    await stop.wait()
+    print("Shutting down, waiting for the requests in progress to finish")
+    server.close()
+    loading.cancel()
+    if in_flight:
+        await asyncio.wait(in_flight, timeout=SHUTDOWN_TIMEOUT)
+    await server.wait_closed()
+    await service.close()
+
+
+def run_server(host: str = SERVER_HOST, port: int = SERVER_PORT):
+    asyncio.run(serve(host, port))
@@ -0,0 +1,141 @@
+"""Queries drawn as strokes instead of images
+
+Drawing UIs already have the strokes as lists of points, which are far smaller than a PNG of the same drawing.
+They get rasterized straight into a `MODEL_IMAGE_SIZE` greyscale image (black on white, like `draw_kanji`),
+without encoding nor decoding any image file. The lines are drawn at `SUPERSAMPLING` times the size then downscaled,
+so that their edges get antialiased like the font rendering.
+
+Format (JSON):
+    {
+        "strokes": [[x0, y0, x1, y1, ...], ...],  # One flat list of coordinates per stroke
+        "pressure": [[p0, p1, ...], ...],  # Optional, one value per point, 0.5 (what mice report) draws at `line_width`
+        "width": 300, "height": 300,  # Optional (both or neither, up to `MAX_CANVAS_SIZE`), size of the canvas the coordinates are in
+        "line_width": 12  # Optional, in the same unit as the coordinates
+    }
+With the canvas size, the canvas gets scaled to the image like an uploaded drawing would,
+otherwise the strokes get centered and scaled to the size of the glyphs in the generated images.
+"""
+import json
+import numpy as np
+from PIL import Image, ImageDraw
+
+from config import (
+    MODEL_IMAGE_SIZE,
+    FONT_SIZE,
+    STROKE_WIDTH,
+)
+
+SUPERSAMPLING = 4
+# Bounds the rasterization cost of a single query
+MAX_STROKE_POINTS = 20_000
+# Range of the canvas `width` and `height`, tinier canvases would scale the coordinates and the lines to huge sizes
+MIN_CANVAS_SIZE = 1
+MAX_CANVAS_SIZE = 10_000
+# Pointer events report 0.5 for devices without pressure support
+DEFAULT_PRESSURE = 0.5
+# Kanji take about this much of the font size, the rest is the padding around them
+_GLYPH_SCALE = 0.9
+
+
+def is_strokes(body: bytes) -> bool:
+    """Whether the request body looks like strokes (JSON) rather than an image file"""
+    return body.lstrip()[:1] == b"{"
+
+
+def _number(data: dict, key: str, low: float = 0, high: float = np.inf) -> float:
+    """The finite and positive number at `key`, between `low` and `high`"""
+    value = data[key]
+    # bool is a subclass of int, but `true` is not a size
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value) or value <= 0 or not low <= value <= high:
+        bounds = "a positive number" if high == np.inf else f"a number between {low} and {high}"
+        raise Exception(f"`{key}` must be {bounds}, got {value!r}")
+    return float(value)
+
+
+def parse_strokes(data: bytes | str | dict) -> dict:
+    """Validates the strokes, returns them as `{"strokes": [(points, 2) arrays], "pressure": [(points,) arrays] | None, ...}`"""
+    if not isinstance(data, dict):
+        data = json.loads(data)
+    strokes = data.get("strokes")
+    if not isinstance(strokes, list) or not strokes:
+        raise Exception("Expected a non-empty list of strokes")
+    try:
+        strokes = [np.asarray(stroke, dtype=np.float32).reshape(-1, 2) for stroke in strokes]
+    except ValueError:
+        raise Exception("Each stroke must be a flat list of numbers, two per point")
+    if any(len(stroke) == 0 for stroke in strokes):
+        raise Exception("Each stroke must have at least one point")
+    if sum(map(len, strokes)) > MAX_STROKE_POINTS:
+        raise Exception(f"The strokes must have at most {MAX_STROKE_POINTS} points in total")
+    if not all(np.isfinite(stroke).all() for stroke in strokes):
+        raise Exception("The coordinates must be finite numbers")
+
+    pressure = data.get("pressure")
+    if pressure is not None:
+        pressure = [np.clip(np.asarray(values, dtype=np.float32).ravel(), 0, 1) for values in pressure]
+        if len(pressure) != len(strokes) or any(len(p) != len(stroke) for p, stroke in zip(pressure, strokes)):
+            raise Exception("`pressure` must have one value per point of each stroke")
+
+    canvas = None
+    if data.get("width") is not None or data.get("height") is not None:
+        if data.get("width") is None or data.get("height") is None:
+            raise Exception("The canvas needs both `width` and `height`, or neither")
+        canvas = tuple(_number(data, key, MIN_CANVAS_SIZE, MAX_CANVAS_SIZE) for key in ("width", "height"))
+    line_width = None if data.get("line_width") is None else _number(data, "line_width")
+    return {"strokes": strokes, "pressure": pressure, "canvas": canvas, "line_width": line_width}
+
+
+def _transform(strokes: list[np.ndarray], canvas: tuple[float, float] | None) -> tuple[np.ndarray, np.ndarray, float]:
+    """Returns the scale (x, y) and offset mapping the coordinates to pixels of the `MODEL_IMAGE_SIZE` image, and the line width scale"""
+    if canvas is not None:
+        scale = np.array([MODEL_IMAGE_SIZE / canvas[0], MODEL_IMAGE_SIZE / canvas[1]], dtype=np.float32)
+        return scale, np.zeros(2, dtype=np.float32), float(np.sqrt(scale[0] * scale[1]))
+    points = np.concatenate(strokes)
+    low, high = points.min(axis=0), points.max(axis=0)
+    extent = float((high - low).max())
+    uniform = FONT_SIZE * _GLYPH_SCALE / extent if extent > 0 else 1.0
+    scale = np.array([uniform, uniform], dtype=np.float32)
+    # Centered like `draw_kanji` centers the glyphs
+    return scale, MODEL_IMAGE_SIZE / 2 - (low + high) / 2 * scale, uniform
+
+
+def rasterize_strokes(
+    strokes: list[np.ndarray],
+    pressure: list[np.ndarray] | None = None,
+    canvas: tuple[float, float] | None = None,
+    line_width: float | None = None,
+) -> Image.Image:
+    """Draws the strokes (`(points, 2)` arrays) into a `MODEL_IMAGE_SIZE` greyscale image, black on white"""
+    scale, offset, width_scale = _transform(strokes, canvas)
+    # A line as wide as the image already covers all of it
+    width = min(STROKE_WIDTH if line_width is None else line_width * width_scale, MODEL_IMAGE_SIZE) * SUPERSAMPLING
+
+    size = MODEL_IMAGE_SIZE * SUPERSAMPLING
+    image = Image.new("L", (size, size), color=255)
+    draw = ImageDraw.Draw(image)
+
+    def dot(point, radius: float):
+        draw.ellipse([point[0] - radius, point[1] - radius, point[0] + radius, point[1] + radius], fill=0)
+
+    for i, stroke in enumerate(strokes):
+        points = (stroke * scale + offset) * SUPERSAMPLING
+        if pressure is None:
+            if len(points) > 1:
+                draw.line(points.ravel().tolist(), fill=0, width=max(round(width), 1))
+            widths = np.full(len(points), width)
+        else:
+            widths = width * pressure[i] / DEFAULT_PRESSURE
+            for j in range(len(points) - 1):
+                segment_width = (widths[j] + widths[j + 1]) / 2
+                draw.line(points[j : j + 2].ravel().tolist(), fill=0, width=max(round(segment_width), 1))
+        # Round caps and joints, about 3 times faster than `joint="curve"`
+        for point, point_width in zip(points, widths):
+            dot(point, point_width / 2)
+
+    # Box filter downscale, averages each SUPERSAMPLING x SUPERSAMPLING block into one antialiased pixel
+    return image.reduce(SUPERSAMPLING)
+
+
+def load_strokes(data: bytes | str | dict) -> Image.Image:
+    """Parses and rasterizes a strokes query (see the module docstring for the format)"""
+    return rasterize_strokes(**parse_strokes(data))